@@ -28,10 +28,24 @@ Storage.prototype.getJob = function(projectName, jobName, onHasJob, onError) {
             batchLength: jobDocument.definition.simulationParameters.batchLength,
             stepDuration: jobDocument.definition.simulationParameters.stepDuration,
             name: jobDocument.name,
-            id: jobDocument._id
+            id: jobDocument._id,
+            ensemble: jobDocument.ensemble || null,
+            ensembleConverged: false
         };
-        fluentMongodb.findOne(client1, 'progresses', {'_id': j.id}, {},
-            onProgressLoaded.bind({}, client1, j), onError );
+        if (j.ensemble !== null) {
+            fluentMongodb.findOne(client1, 'ensembles', {'_id': j.ensemble},
+                {'converged': 1}, onEnsembleLoaded.bind({}, client1, j), onError);
+        } else {
+            fluentMongodb.findOne(client1, 'progresses', {'_id': j.id}, {},
+                onProgressLoaded.bind({}, client1, j), onError );
+        }
+    };
+
+    // Replicas of converged ensembles are not simulated any more.
+    var onEnsembleLoaded = function(client3, job, ensembleDocument) {
+        job.ensembleConverged = ensembleDocument !== null && ensembleDocument.converged;
+        fluentMongodb.findOne(client3, 'progresses', {'_id': job.id}, {},
+            onProgressLoaded.bind({}, client3, job), onError );
     };
 
     var onProgressLoaded = function(client2, job, progressDocument) {
@@ -49,13 +63,34 @@ Storage.prototype.getJob = function(projectName, jobName, onHasJob, onError) {
     };
 
     var spec = {'_id': jobName};
-    var fields = {'name':1, 'definition': 1};
+    var fields = {'name':1, 'definition': 1, 'ensemble': 1};
     var client = this._getDbClient(projectName);
     fluentMongodb.findOne(client, 'jobs', spec, fields,
                           onJobLoaded.bind({}, client), onError);
 };
 
 
+/**
+ * Gets ensemble of replicas of job.
+ *
+ * @param onHasEnsemble {function(Object)} called with object with id,
+ *     replicas and converged fields or with null if there is no ensemble.
+ * @param onError {function(Error)}
+ */
+Storage.prototype.getEnsemble = function(projectName, ensembleName, onHasEnsemble, onError) {
+    var fields = {'replicas': 1, 'converged': 1};
+    var client = this._getDbClient(projectName);
+    fluentMongodb.findOne(client, 'ensembles', {'_id': ensembleName}, fields, function(doc){
+        var ensemble = null;
+        if (doc !== null) {
+            ensemble = {id: doc._id, replicas: doc.replicas, converged: doc.converged};
+        }
+        client.close();
+        process.nextTick(onHasEnsemble.bind({}, ensemble));
+    }, onError);
+};
+
+
 Storage.prototype.saveStatistics = function(statistics, onFinished, onError) {
     if (this.infoDb === null) {
         this.client = this._getDbClient(this.infoDbName);
@@ -21,7 +21,12 @@ var mongodb = require('mongodb'),
 var config = require('config')('Scheduler', {
   dbHost: '192.168.1.5',
   dbPort: 27017,
-  notificationInterval: 5000
+  notificationInterval: 5000,
+  // Maximum time in milliseconds for which waitTask holds request.
+  maxTaskWaitTime: 60000,
+  // Time in milliseconds for which the next batch of simulation is reserved
+  // for worker that has done the previous one and keeps model in memory.
+  affinityTime: 2000
 });
 
 
@@ -45,6 +50,8 @@ var Scheduler = function(){
     this.waitingQueue = [];
     this.waitingActivation = {};
     this.runningTasks = {};
+    // Workers that wait for tasks: workerId -> {taskTypes, response, timer}.
+    this.waitingWorkers = {};
 };
 
 
@@ -76,11 +83,50 @@ Scheduler.prototype.taskExists = function(projectName, jobName, taskType) {
 
 
 
-// Adds required tasks to queue if required.
-Scheduler.prototype.addTask = function(response, projectName, jobName) {
+// Adds required tasks to queue if required. If job name is a name of
+// ensemble then tasks are added for all its replicas, so they are simulated
+// in parallel. If preferredWorker is set then simulation task is reserved for
+// that worker for affinityTime.
+Scheduler.prototype.addTask = function(response, projectName, jobName, preferredWorker) {
+    var handleHasEnsemble = function(ensemble) {
+        if (ensemble === null) {
+            response.error({type: 'JobNotFound'});
+            return;
+        }
+        if (ensemble.converged) {
+            response.error({type: 'AlreadyDone'});
+            return;
+        }
+        // Replicas that are done or already queued are skipped.
+        var pending = ensemble.replicas.length;
+        if (pending === 0) {
+            response.response('success');
+            return;
+        }
+        var onReplicaHandled = function() {
+            pending -= 1;
+            if (pending === 0) {
+                response.response('success');
+            }
+        };
+        var replicaResponse = {response: onReplicaHandled, error: onReplicaHandled};
+        ensemble.replicas.forEach(function(replica) {
+            this.addTask(replicaResponse, projectName, replica);
+        }, this);
+    };
+
     var handleHasJob = function(job){
         if (job === null) {
-            response.error({type: 'JobNotFound'});
+            this.projectStorage.getEnsemble(projectName, jobName,
+                handleHasEnsemble.bind(this), onMongodbError.bind({}, response));
+            return;
+        }
+        if (job.ensembleConverged) {
+            // Tasks of other replicas that are waiting aren't required too.
+            this.waitingQueue = this.waitingQueue.filter(function(task){
+                return task.project !== projectName || task.ensemble !== job.ensemble;
+            });
+            response.error({type: 'EnsembleConverged'});
             return;
         }
 
@@ -88,24 +134,42 @@ Scheduler.prototype.addTask = function(response, projectName, jobName) {
             var a = {
                 project: projectName,
                 job: job.id,
-                type: type
+                type: type,
+                ensemble: job.ensemble
             };
             if (type === taskType.simulation) {
                 a['startState'] = job.done;
                 a['duration'] = job.duration;
                 a['batchLength'] = job.batchLength;
                 a['stepDuration'] = job.stepDuration;
+                if (preferredWorker) {
+                    a['preferredWorker'] = preferredWorker;
+                    a['preferredUntil'] = Date.now() + config.affinityTime;
+                }
             }
             return a;
         };
         if (job.done < job.totalSteps) {
             if (!this.taskExists(projectName, jobName, taskType.simulation)) {
-                this.waitingQueue.push(getTask(taskType.simulation));
+                this.queueTask(getTask(taskType.simulation));
             } else {
                 response.error({type: 'DuplicateTask',
                                 taskType:taskType.simulation});
             }
         } else if (job.fullStatistics === false) {
+            if (this.taskExists(projectName, jobName, taskType.fullStatistics)) {
+                response.error({type: 'DuplicateTask',
+                                    taskType:taskType.fullStatistics});
+                return;
+            }
+            // If nothing is calculated yet then all statistics are calculated
+            // by one task in one pass over cars.
+            if (job.basicStatistics === false && job.idleTimes === false &&
+                    job.throughput === false) {
+                this.queueTask(getTask(taskType.fullStatistics));
+                response.response('success');
+                return;
+            }
             // Statistics are parallel.
             if (this.taskExists(projectName, jobName, taskType.basicStatistics)) {
                 response.error({type: 'DuplicateTask',
@@ -124,13 +188,13 @@ Scheduler.prototype.addTask = function(response, projectName, jobName) {
             }
 
             if (job.basicStatistics === false) {
-                this.waitingQueue.push(getTask(taskType.basicStatistics));
+                this.queueTask(getTask(taskType.basicStatistics));
             }
             if (job.idleTimes === false) {
-                this.waitingQueue.push(getTask(taskType.idleTimes));
+                this.queueTask(getTask(taskType.idleTimes));
             }
             if (job.throughput === false) {
-                this.waitingQueue.push(getTask(taskType.throughput));
+                this.queueTask(getTask(taskType.throughput));
             }
         } else {
             response.error({type: 'AlreadyDone'});
@@ -175,44 +239,130 @@ Scheduler.prototype.abortTask = function(response, projectName, jobName) {
 };
 
 
-Scheduler.prototype.getTask = function(response, workerId, taskTypes){
-    if (this.waitingActivation.hasOwnProperty(workerId) ||
-            this.runningTasks.hasOwnProperty(workerId)) {
-        response.error({type: 'WorkerHasTask'});
-        return;
+/* Adds task to waiting queue and gives it to a worker that waits for it. */
+Scheduler.prototype.queueTask = function(task) {
+    this.waitingQueue.push(task);
+    this._dispatchTasks();
+    // Other workers may take task when reservation ends.
+    if (task.preferredUntil && task.preferredUntil > Date.now()) {
+        setTimeout(this._dispatchTasks.bind(this), task.preferredUntil - Date.now());
     }
+};
+
 
-    var task = null;
+/* Takes task of one of types from waiting queue and makes it waiting
+ * activation by worker. Returns null if there is no such task. */
+Scheduler.prototype._takeTask = function(workerId, taskTypes) {
+    var task = null,
+        now = Date.now();
     for(var i=0, l=this.waitingQueue.length; i<l; ++i) {
         var it = this.waitingQueue[i];
+        // Skip tasks reserved for other workers.
+        if (it.preferredWorker && it.preferredWorker !== workerId &&
+                it.preferredUntil > now) {
+            continue;
+        }
         if (taskTypes.indexOf(it.type) !== -1) {
             task = it;
             this.waitingQueue.splice(i, 1);
             break;
         }
     }
+    if (task === null) {
+        return null;
+    }
+
+    task['empty'] = false;
+    task['databases'] = [{host: this.mongodbAddress[0],
+                          port: this.mongodbAddress[1]}];
+    task['lastUpdate'] = new Date();
+    task['startTime'] = task['lastUpdate'];
+    task['sig'] = task['lastUpdate'].toJSON();
+
+    // Set notification interval only if nothing has set it already.
+    if (!task.hasOwnProperty("notificationInterval")) {
+        task.notificationInterval = config.notificationInterval;
+    }
+
+    this.waitingActivation[workerId] = task;
+    return task;
+};
+
 
+Scheduler.prototype.getTask = function(response, workerId, taskTypes){
+    if (this.waitingActivation.hasOwnProperty(workerId) ||
+            this.runningTasks.hasOwnProperty(workerId)) {
+        response.error({type: 'WorkerHasTask'});
+        return;
+    }
+
+    var task = this._takeTask(workerId, taskTypes);
     if (task === null){
         task = {empty: true};
-    } else {
-        task['empty'] = false;
-        task['databases'] = [{host: this.mongodbAddress[0],
-                              port: this.mongodbAddress[1]}];
-        task['lastUpdate'] = new Date();
-        task['startTime'] = task['lastUpdate'];
-        task['sig'] = task['lastUpdate'].toJSON();
-
-        // Set notification interval only if nothing has set it already.
-        if (!task.hasOwnProperty("notificationInterval")) {
-            task.notificationInterval = config.notificationInterval;
-        }
-
-        this.waitingActivation[workerId] = task;
     }
     response.response(task);
 };
 
 
+/* Like getTask, but if there is no task then response is held until task
+ * appears or timeout in milliseconds expires. If worker hasn't accepted task
+ * given to it, probably because response has been lost, then the same task
+ * is returned. */
+Scheduler.prototype.waitTask = function(response, workerId, taskTypes, timeout) {
+    if (this.runningTasks.hasOwnProperty(workerId)) {
+        response.error({type: 'WorkerHasTask'});
+        return;
+    }
+    if (this.waitingActivation.hasOwnProperty(workerId)) {
+        response.response(this.waitingActivation[workerId]);
+        return;
+    }
+    // Previous request of worker isn't required anymore.
+    this._stopWaiting(workerId);
+
+    var task = this._takeTask(workerId, taskTypes);
+    if (task !== null) {
+        response.response(task);
+        return;
+    }
+
+    var timer = setTimeout(this._stopWaiting.bind(this, workerId),
+                           Math.min(timeout, config.maxTaskWaitTime));
+    this.waitingWorkers[workerId] = {taskTypes: taskTypes, response: response,
+                                     timer: timer};
+};
+
+
+/* Responds with empty task to worker that waits for task. */
+Scheduler.prototype._stopWaiting = function(workerId) {
+    if (this.waitingWorkers.hasOwnProperty(workerId)) {
+        var waiting = this.waitingWorkers[workerId];
+        clearTimeout(waiting.timer);
+        delete this.waitingWorkers[workerId];
+        waiting.response.response({empty: true});
+    }
+};
+
+
+/* Gives tasks from waiting queue to workers that wait for them. */
+Scheduler.prototype._dispatchTasks = function() {
+    for (var workerId in this.waitingWorkers) {
+        if (this.waitingQueue.length === 0) {
+            break;
+        }
+        if (this.waitingWorkers.hasOwnProperty(workerId)) {
+            var waiting = this.waitingWorkers[workerId],
+                task = this._takeTask(workerId, waiting.taskTypes);
+            if (task !== null) {
+                clearTimeout(waiting.timer);
+                delete this.waitingWorkers[workerId];
+                waiting.response.response(task);
+            }
+        }
+    }
+};
+
+
 Scheduler.prototype.acceptTask = function(response, workerId, sig){
     if (workerId in this.waitingActivation) {
         var t = this.waitingActivation[workerId];
@@ -237,9 +387,9 @@ Scheduler.prototype.rejectTask = function(response, workerId, sig) {
         var t = this.waitingActivation[workerId];
         if (t.sig === sig) {
             delete this.waitingActivation[workerId];
-            this.waitingQueue.push(t);
             delete t['sig'];
             delete t['empty'];
+            this.queueTask(t);
             response.response("success");
         } else {
             response.error({type:'InvalidSignature'});
@@ -272,7 +422,7 @@ Scheduler.prototype.taskFinished = function(response, workerId, sig, statistics)
     }
 
     if (startNext) {
-        process.nextTick(this.addTask.bind(this, response, task.project, task.job));
+        process.nextTick(this.addTask.bind(this, response, task.project, task.job, workerId));
     }
 
     // Write statistics
@@ -334,20 +484,20 @@ Scheduler.prototype.getCurrentTasks = function(response) {
 
 Scheduler.prototype.restartTasks = function(response, tasks) {
     var restarted = 0,
+        scheduler = this,
         runningTasks = this.runningTasks,
-        waitingQueue = this.waitingQueue,
         waitingActivation = this.waitingActivation;
     tasks.forEach(function(task){
         // Try running tasks first, then waiting acception.
         if (task.id in runningTasks) {
             var currentTask = runningTasks[task.id];
             delete runningTasks[task.id];
-            waitingQueue.push(currentTask);
+            scheduler.queueTask(currentTask);
             restarted += 1;
         } else if (task.id in waitingActivation) {
             var currentTask = waitingActivation[task.id];
             delete waitingActivation[task.id];
-            waitingQueue.push(currentTask);
+            scheduler.queueTask(currentTask);
             restarted += 1;
         }
     });
@@ -361,6 +511,7 @@ Scheduler.prototype.getStatus = function() {
         "waitingQueue": this.waitingQueue,
         "waitingActivation": this.waitingActivation,
         "runningsTasks": this.runningTasks,
+        "waitingWorkers": Object.keys(this.waitingWorkers),
     };
 }
 
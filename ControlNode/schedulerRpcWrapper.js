@@ -87,6 +87,18 @@ Wrapper.prototype.getTask = function(rpc, workerId){
 };
 
 
+/* Long poll variant of getTask. Timeout is in seconds. */
+Wrapper.prototype.waitTask = function(rpc, workerId, taskTypes, timeout){
+    if (this._checkType(rpc, workerId, "workerId", "string") ||
+        this._checkType(rpc, timeout, "timeout", "number")) {
+        return;
+    }
+    var effTaskTypes = this._parseTaskTypes(taskTypes, rpc);
+    if (effTaskTypes === null) return;
+    this.scheduler.waitTask(rpc, workerId, effTaskTypes, timeout * 1000);
+};
+
+
 Wrapper.prototype.acceptTask = function(rpc, workerId, sig){
     if (this._checkType(rpc, workerId, "workerId", "string") ||
         this._checkType(rpc, sig, "sig", "string") ) {
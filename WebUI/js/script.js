@@ -294,24 +294,30 @@ var kts46 = (function($){
     };
 
 
-    var getStatistics = function(projectName, jobName, cbk) {
-        // var pj = getJobNameByRow(jobRow);
-        $.getJSON(dataPath, {
-            method:'jobStatistics',
-            p: projectName,
-            j: jobName
-        }, cbk);
-    };
-
-
+    /* Shows statistics of all selected jobs. Statistics are requested in one
+     * JSON-RPC batch request, responses are in the same order as calls.
+     */
     var showStatistics = function() {
         var jobs = getSelectedJobs();
         if (jobs.length === 0) return;
-        var jobInfo = getJobNameByRow(jobs[0]);
-        getStatistics(jobInfo.p, jobInfo.j, (function(jobInfo, data){
-            var text = JSON.stringify(data, null, 4); // 4 is amount of spaces.
-            $('#details-content').text( [jobInfo.p, '.', jobInfo.j, '\n',text].join(''));
-        }).bind({}, jobInfo) );
+        var jobInfos = $.map(jobs, getJobNameByRow),
+            calls = $.map(jobInfos, function(jobInfo, i) {
+                return {
+                    "method": "getJobStatistics",
+                    "id": i,
+                    "params": [jobInfo.p, jobInfo.j]
+                };
+            });
+        $.post(jsonRpcPath, JSON.stringify(calls) + "\n", function(responses) {
+            var text = $.map(responses, function(response) {
+                var jobInfo = jobInfos[response.id],
+                    value = response.error === null ? response.result : response.error;
+                // 4 is amount of spaces.
+                return [jobInfo.p, '.', jobInfo.j, '\n',
+                        JSON.stringify(value, null, 4)].join('');
+            });
+            $('#details-content').text(text.join('\n\n'));
+        }, "json");
     };
 
 
@@ -12,8 +12,12 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import errno
+import httplib
 import json
-import urllib2
+import socket
+import threading
+import urlparse
 
 class RPCException(Exception):
     def __init__(self, errorObj):
@@ -21,32 +25,234 @@ class RPCException(Exception):
     def __str__(self):
         return "jsonRpcClient.RPCException: " + json.dumps(self.error)
 
+class ConnectionPool(object):
+    """Thread-safe pool of persistent HTTP/1.1 connections to one server.
+    Connections are taken by threads for the time of request and returned
+    after response is read, so each connection is used by one thread at a
+    time."""
+
+    def __init__(self, address, timeout=None, maxIdle=4):
+        """Creates new pool.
+
+        :param address: URL of JSON-RPC server.
+        :type address: str
+        :param timeout: timeout of socket operations in seconds. Global default
+            timeout is used if it is None.
+        :type timeout: float
+        :param maxIdle: maximum amount of idle connections kept open.
+        :type maxIdle: int"""
+        url = urlparse.urlsplit(address)
+        if url.scheme == 'https':
+            self._connectionClass = httplib.HTTPSConnection
+        else:
+            self._connectionClass = httplib.HTTPConnection
+        self.host = url.hostname
+        self.port = url.port
+        self.path = url.path or '/'
+        if url.query:
+            self.path += '?' + url.query
+        self.timeout = timeout
+        self.maxIdle = maxIdle
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self.timeout is None:
+            return self._connectionClass(self.host, self.port)
+        return self._connectionClass(self.host, self.port, timeout=self.timeout)
+
+    def _acquire(self):
+        "Returns idle connection and True or new connection and False."
+        with self._lock:
+            if len(self._idle) > 0:
+                return self._idle.pop(), True
+        return self._connect(), False
+
+    def _release(self, connection):
+        with self._lock:
+            if len(self._idle) < self.maxIdle:
+                self._idle.append(connection)
+                return
+        connection.close()
+
+    def post(self, body):
+        """Sends body to server and returns body of response. Response is
+        returned even if its HTTP status is an error, because JSON-RPC
+        servers report errors in it. If idle connection turns out to be closed
+        by server before any response has been received then request is sent
+        again with a new connection. Other errors, including timeouts, aren't
+        retried because server may have already performed the call.
+
+        :param body: body of request.
+        :type body: str
+        :rtype: str
+        :raises socket.error: if connection to server failed.
+        :raises httplib.HTTPException: if server response is invalid."""
+        connection, reused = self._acquire()
+        try:
+            try:
+                response = self._request(connection, body)
+            except (socket.error, httplib.HTTPException) as ex:
+                connection.close()
+                if not reused or not ConnectionPool._isStaleConnectionError(ex):
+                    raise
+                # Server closes connections that are idle for a long time.
+                connection = self._connect()
+                response = self._request(connection, body)
+            data = response.read()
+        except:
+            connection.close()
+            raise
+        if response.will_close:
+            connection.close()
+        else:
+            self._release(connection)
+        return data
+
+    @staticmethod
+    def _isStaleConnectionError(ex):
+        """Checks whether error means that server has closed keep-alive
+        connection before request: connection was reset or closed without
+        any bytes of response."""
+        if isinstance(ex, httplib.BadStatusLine):
+            # Python 2.7.4+ uses message, older versions pass empty line.
+            return ex.line in ('', "''") or ex.line.startswith('No status line received')
+        if isinstance(ex, socket.timeout):
+            return False
+        if isinstance(ex, socket.error):
+            return ex.errno in (errno.ECONNRESET, errno.EPIPE)
+        return False
+
+    def _request(self, connection, body):
+        headers = {'Content-Type': 'application/json',
+                   'Connection': 'keep-alive'}
+        connection.request('POST', self.path, body, headers)
+        return connection.getresponse()
+
+    def close(self):
+        "Closes idle connections."
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection in idle:
+            connection.close()
+
 class Client(object):
+    """JSON-RPC client. Methods of server are called as methods of client.
+    Client may be shared between threads: connections to server are kept
+    open in a pool and reused."""
 
-    def __init__(self, address, id=0):
+    def __init__(self, address, id=0, timeout=None):
         self.address = address
         self.id = id
+        self._idLock = threading.Lock()
+        self.pool = ConnectionPool(address, timeout)
 
     def __getattr__(self, name):
-        self.id += 1
-        return MethodCall(self.address, name, self.id)
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return MethodCall(self.address, name, self._nextId(), self.pool)
+
+    def _nextId(self):
+        with self._idLock:
+            self.id += 1
+            return self.id
+
+    def batch(self):
+        """Returns batch that sends several calls to server in one request.
+
+        :rtype: Batch"""
+        return Batch(self)
+
+    def close(self):
+        "Closes idle connections to server."
+        self.pool.close()
 
 class MethodCall(object):
 
-    def __init__(self, address, methodName, id=1):
+    def __init__(self, address, methodName, id=1, pool=None):
         self.address = address
         self.name = methodName
         self.id = id
+        self.pool = pool if pool is not None else ConnectionPool(address)
 
     def __call__(self, *args):
         data = {'method': self.name, 'id': self.id, 'params': args}
-        try:
-            f = urllib2.urlopen(self.address, json.dumps(data))
-        except urllib2.HTTPError as ex:
-            f = ex
-        responseStr = f.read()
+        # Servers read request as a single line.
+        responseStr = self.pool.post(json.dumps(data) + '\n')
         response = json.loads(responseStr)
         if response['error'] is not None:
             raise RPCException(response['error'])
         else:
             return response['result']
+
+class BatchCall(object):
+    "Call of batch. Its result is available after batch is sent."
+
+    def __init__(self, methodName, id, params):
+        self.name = methodName
+        self.id = id
+        self.params = params
+        self.response = None
+
+    def getRequest(self):
+        return {'method': self.name, 'id': self.id, 'params': self.params}
+
+    @property
+    def result(self):
+        """Result of call.
+
+        :raises RPCException: if server returned error or there is no response
+            to call."""
+        if self.response is None:
+            raise RPCException({'type': 'noResponse',
+                                'msg': 'There is no response to call ' + self.name + '.'})
+        if self.response['error'] is not None:
+            raise RPCException(self.response['error'])
+        return self.response['result']
+
+class Batch(object):
+    """Collects calls and sends them to server in one request as a JSON-RPC
+    batch array. Batch is sent when ``with`` block is left without exception
+    or by ``send``::
+
+        with client.batch() as batch:
+            calls = [batch.getJobStatistics(p, j) for p, j in jobs]
+        statistics = [call.result for call in calls]
+    """
+
+    def __init__(self, client):
+        self._client = client
+        self._calls = []
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        def call(*args):
+            batchCall = BatchCall(name, self._client._nextId(), args)
+            self._calls.append(batchCall)
+            return batchCall
+        return call
+
+    def send(self):
+        """Sends collected calls to server and sets responses of them.
+
+        :raises RPCException: if server has rejected the whole batch."""
+        calls, self._calls = self._calls, []
+        if len(calls) == 0:
+            return
+        data = [call.getRequest() for call in calls]
+        responses = json.loads(self._client.pool.post(json.dumps(data) + '\n'))
+        # Invalid batch is answered with a single error response.
+        if isinstance(responses, dict):
+            raise RPCException(responses['error'])
+        responsesById = dict((response['id'], response) for response in responses)
+        for call in calls:
+            call.response = responsesById.get(call.id)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        if excType is None:
+            self.send()
+        return False
@@ -0,0 +1,208 @@
+# Copyright 2010-2011 Anthony Kolesov
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import numpy
+from kts46.model.Car import Car
+
+
+class LoopDetector(object):
+    """Virtual loop detector. Counts cars that cross its position for each lane
+    of the road and each time interval."""
+
+    def __init__(self, id, position, interval=60):
+        """Creates new detector.
+
+        :param id: id of detector.
+        :param position: position of detector on the road.
+        :type position: float
+        :param interval: length of time interval in seconds.
+        :type interval: float"""
+        self.id = id
+        self.position = position
+        self.interval = interval
+        # Number of interval -> line -> amount of cars. Keys are strings so
+        # counts can be saved to database as is.
+        self.counts = {}
+
+    def addCrossing(self, time, line):
+        "Counts car that has crossed detector on specified line at specified time."
+        lanes = self.counts.setdefault(str(int(time // self.interval)), {})
+        line = str(int(line))
+        lanes[line] = lanes.get(line, 0) + 1
+
+    def getResults(self):
+        """Returns dictionary with id, position and interval of detector and
+        list of counts for each interval that has crossings. Each item of
+        counts list contains start time of interval and dictionary with
+        amounts of cars for each lane."""
+        counts = []
+        for key in sorted(self.counts, key=int):
+            counts.append({'time': int(key) * self.interval,
+                           'lanes': self.counts[key]})
+        return {'id': self.id, 'pos': self.position,
+                'interval': self.interval, 'counts': counts}
+
+    def getStateData(self):
+        "Returns state of detector that can be saved to database."
+        return {'id': self.id, 'position': self.position,
+                'interval': self.interval, 'counts': self.counts}
+
+    def load(self, state):
+        "Loads state returned by ``getStateData``."
+        self.id = state['id']
+        self.position = state['position']
+        self.interval = state['interval']
+        self.counts = dict((key, dict(lanes))
+                           for key, lanes in state['counts'].iteritems())
+
+
+class CarStatistics(object):
+    """Calculates statistics of job from a stream of car records in one pass.
+    Records of each car must be added in order of time, records of different
+    cars may be mixed. Only cars that are on the road are kept in memory.
+
+    Statistics are the same as ones calculated by separate methods of
+    :class:`kts46.statisticsServer.StatisticsServer`: travel times, idle times
+    and throughput at the start and at the end of road. Additionally amount of
+    cars that have crossed specified measurement points is counted, and cars
+    are counted by loop detectors.
+
+    Statistics may be calculated during simulation by model, then they are
+    saved with checkpoint of job."""
+
+    def __init__(self, points=(), detectors=None):
+        """Creates new empty statistics.
+
+        :param points: positions on the road where crossings are counted.
+        :type points: list of float
+        :param detectors: definitions of loop detectors from job definition:
+            id -> dictionary with position and interval.
+        :type detectors: dict"""
+        # Car id -> [add time, time of last record, last position, idle time]
+        self.activeCars = {}
+        self.travelTimes = []
+        self.idleTimes = {}
+        self.addedCount = 0
+        self.deletedCount = 0
+        self.points = list(points)
+        self.crossings = [0] * len(self.points)
+        self.detectors = []
+        if detectors is not None:
+            for id, detector in sorted(detectors.iteritems()):
+                self.detectors.append(LoopDetector(id, detector['position'],
+                    detector.get('interval', 60)))
+
+    def addState(self, time, cars):
+        """Adds records of all cars of model state.
+
+        :param time: time of state.
+        :type time: float
+        :param cars: cars as returned by ``Model._getCarsState``."""
+        for carId, state, description in cars:
+            self.addRecord(time, carId, state[0], state[3], state[1])
+
+    def addRecord(self, time, carId, position, state, line=0):
+        """Adds record of car state.
+
+        :param time: time of record.
+        :type time: float
+        :param carId: id of car.
+        :param position: position of car.
+        :type position: float
+        :param state: state of car, like ``Car.ADDED``.
+        :type state: str
+        :param line: line of car.
+        :type line: int
+        """
+        car = self.activeCars.get(carId)
+        if car is None:
+            car = [None, time, position, 0.0]
+            self.activeCars[carId] = car
+            previousPosition = None
+        else:
+            previousPosition = car[2]
+            if position == previousPosition:
+                car[3] += time - car[1]
+        for i, point in enumerate(self.points):
+            if (previousPosition is None or previousPosition < point) and point <= position:
+                self.crossings[i] += 1
+        for detector in self.detectors:
+            if (previousPosition is None or previousPosition < detector.position) and detector.position <= position:
+                detector.addCrossing(time, line)
+        car[1] = time
+        car[2] = position
+
+        if state == Car.ADDED:
+            car[0] = time
+            self.addedCount += 1
+        elif state == Car.DELETED:
+            self.deletedCount += 1
+            if car[0] is not None:
+                self.travelTimes.append(time - car[0])
+            self.idleTimes[carId] = car[3]
+            del self.activeCars[carId]
+
+    def getBasicStats(self, roadLength):
+        """Returns tuple of average travel time, its standard deviation and
+        average speed."""
+        arr = numpy.array(self.travelTimes)
+        average = numpy.average(arr)
+        return average, numpy.std(arr), roadLength / average
+
+    def getIdleTimes(self):
+        "Returns idle times in the format of ``SimulationJob.saveIdleTimes``."
+        values = dict((carId, round(idleTime, 4))
+                      for carId, idleTime in self.idleTimes.iteritems())
+        mean = numpy.average(numpy.array(self.idleTimes.values()))
+        return {'values': values, 'average': round(mean, 4)}
+
+    def getThroughput(self, job):
+        "Returns throughput in the format of ``SimulationJob.saveThroughput``."
+        duration = job.definition['simulationParameters']['duration']
+        result = []
+        points = [('start', self.addedCount), ('end', self.deletedCount)]
+        points.extend(zip(self.points, self.crossings))
+        for point, carsAmount in points:
+            throughput = float(carsAmount) / duration * 3600
+            result.append({'cars': carsAmount, 'rate': job.round(throughput),
+                           'pos': point})
+        return result
+
+    def getDetectors(self):
+        "Returns results of loop detectors in the format of ``SimulationJob.saveDetectors``."
+        return [detector.getResults() for detector in self.detectors]
+
+    def getStateData(self):
+        "Returns dictionary with state of statistics that can be saved to database."
+        return {'activeCars': self.activeCars, 'travelTimes': self.travelTimes,
+                'idleTimes': self.idleTimes, 'addedCount': self.addedCount,
+                'deletedCount': self.deletedCount, 'points': self.points,
+                'crossings': self.crossings,
+                'detectors': [detector.getStateData() for detector in self.detectors]}
+
+    def load(self, state):
+        "Loads state returned by ``getStateData``."
+        self.activeCars = dict((carId, list(car))
+                               for carId, car in state['activeCars'].iteritems())
+        self.travelTimes = list(state['travelTimes'])
+        self.idleTimes = dict(state['idleTimes'])
+        self.addedCount = state['addedCount']
+        self.deletedCount = state['deletedCount']
+        self.points = list(state['points'])
+        self.crossings = list(state['crossings'])
+        self.detectors = []
+        for detectorState in state['detectors']:
+            detector = LoopDetector(None, None)
+            detector.load(detectorState)
+            self.detectors.append(detector)
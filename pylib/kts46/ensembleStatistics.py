@@ -0,0 +1,141 @@
+# Copyright 2010-2011 Anthony Kolesov
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import math
+import numpy
+
+
+# Two-sided critical values of Student's t-distribution: confidence -> values
+# for 1-30 degrees of freedom, then for 40, 60 and 120.
+_T_TABLE = {
+    0.90: (6.314, 2.920, 2.353, 2.132, 2.015, 1.943, 1.895, 1.860, 1.833, 1.812,
+           1.796, 1.782, 1.771, 1.761, 1.753, 1.746, 1.740, 1.734, 1.729, 1.725,
+           1.721, 1.717, 1.714, 1.711, 1.708, 1.706, 1.703, 1.701, 1.699, 1.697,
+           1.684, 1.671, 1.658),
+    0.95: (12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262, 2.228,
+           2.201, 2.179, 2.160, 2.145, 2.131, 2.120, 2.110, 2.101, 2.093, 2.086,
+           2.080, 2.074, 2.069, 2.064, 2.060, 2.056, 2.052, 2.048, 2.045, 2.042,
+           2.021, 2.000, 1.980),
+    0.99: (63.657, 9.925, 5.841, 4.604, 4.032, 3.707, 3.499, 3.355, 3.250, 3.169,
+           3.106, 3.055, 3.012, 2.977, 2.947, 2.921, 2.898, 2.878, 2.861, 2.845,
+           2.831, 2.819, 2.807, 2.797, 2.787, 2.779, 2.771, 2.763, 2.756, 2.750,
+           2.704, 2.660, 2.617),
+}
+_T_TABLE_LARGE_DF = (40, 60, 120)
+
+
+def getStudentCoefficient(confidence, df):
+    """Returns two-sided critical value of Student's t-distribution. For
+    degrees of freedom that aren't in the table value for the nearest smaller
+    one is used, so intervals are a little wider then exact.
+
+    :param confidence: confidence level: 0.9, 0.95 or 0.99.
+    :type confidence: float
+    :param df: degrees of freedom.
+    :type df: int
+    :raises ValueError: if confidence level isn't supported."""
+    if confidence not in _T_TABLE:
+        raise ValueError("Unsupported confidence level: {0}.".format(confidence))
+    values = _T_TABLE[confidence]
+    if df <= 30:
+        return values[df - 1]
+    i = 29
+    for tableDf in _T_TABLE_LARGE_DF:
+        if df >= tableDf:
+            i += 1
+    return values[i]
+
+
+def getConfidenceInterval(values, confidence=0.95):
+    """Returns dictionary with mean of values, half width of its confidence
+    interval and amount of values. Half width is None if there is only one
+    value."""
+    n = len(values)
+    mean = float(numpy.average(numpy.array(values)))
+    if n < 2:
+        halfWidth = None
+    else:
+        deviation = float(numpy.std(numpy.array(values), ddof=1))
+        halfWidth = getStudentCoefficient(confidence, n - 1) * deviation / math.sqrt(n)
+    return {'mean': mean, 'halfWidth': halfWidth, 'n': n}
+
+
+class EnsembleStatistics(object):
+    """Aggregates statistics of replicas of the same job into means with
+    confidence intervals. Replicas are added as statistics documents of
+    :class:`kts46.mongodb.SimulationJob`."""
+
+    # Fields of statistics document that are aggregated.
+    FIELDS = ('average', 'stdeviation', 'averageSpeed')
+
+    def __init__(self, confidence=0.95):
+        """Creates new empty aggregation.
+
+        :param confidence: confidence level of intervals.
+        :type confidence: float"""
+        getStudentCoefficient(confidence, 1)
+        self.confidence = confidence
+        # Name of value -> list of values of replicas.
+        self.values = {}
+        # Position of throughput measurement point -> list of rates.
+        self.throughput = {}
+        self.throughputPoints = []
+        self.count = 0
+
+    def addReplica(self, statistics):
+        """Adds statistics of replica.
+
+        :param statistics: statistics document of job.
+        :type statistics: dict"""
+        for name in EnsembleStatistics.FIELDS:
+            self.values.setdefault(name, []).append(statistics[name])
+        self.values.setdefault('idleTime', []).append(statistics['idleTimes']['average'])
+        for point in statistics['throughput']:
+            if point['pos'] not in self.throughput:
+                self.throughputPoints.append(point['pos'])
+            self.throughput.setdefault(point['pos'], []).append(point['rate'])
+        self.count += 1
+
+    def getResults(self):
+        """Returns dictionary with confidence interval of each value like
+        ``getConfidenceInterval`` does. Throughput is a list of intervals of
+        rates with ``pos`` of measurement point."""
+        result = dict((name, getConfidenceInterval(values, self.confidence))
+                      for name, values in self.values.iteritems())
+        throughput = []
+        for pos in self.throughputPoints:
+            throughput.append(getConfidenceInterval(self.throughput[pos], self.confidence))
+            throughput[-1]['pos'] = pos
+        result['throughput'] = throughput
+        return result
+
+    def isConverged(self, names, relativeWidth, minReplicas=3):
+        """Checks whether confidence intervals of specified values are narrow
+        enough: half width of each interval must not exceed ``relativeWidth``
+        of its mean.
+
+        :param names: names of values to check.
+        :type names: list
+        :param relativeWidth: maximum ratio of half width to mean.
+        :type relativeWidth: float
+        :param minReplicas: amount of replicas required before check.
+        :type minReplicas: int
+        :rtype: bool"""
+        if self.count < max(minReplicas, 2):
+            return False
+        for name in names:
+            interval = getConfidenceInterval(self.values[name], self.confidence)
+            if interval['halfWidth'] > relativeWidth * abs(interval['mean']):
+                return False
+        return True
@@ -0,0 +1,158 @@
+# Copyright 2010-2011 Anthony Kolesov
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from bisect import bisect_right
+from datetime import timedelta
+import random
+
+import kts46.utils
+
+
+# Microseconds in an hour. Rates are measured in cars per hour.
+_HOUR = 3600 * 1000000
+
+
+class ArrivalGenerator(object):
+    """Generates times when cars come to the road. All times are integer
+    amounts of microseconds.
+
+    Cars may come with equal intervals (``uniform`` distribution) or as a
+    Poisson process (``poisson``). Rate may change in time: it is defined by
+    ``inputRate`` model parameter and piecewise constant ``profile`` of
+    ``arrivals`` model parameter::
+
+        arrivals:
+            distribution: poisson
+            profile: [[0, 1200], [600, 2400], [1800, 1200]]
+            peakHour: {start: 3600, duration: 3600, rate: 3000}
+
+    Each item of profile is a pair of time in seconds and rate that is used
+    from that time. Peak hour overrides profile in its interval."""
+
+    UNIFORM = 'uniform'
+    POISSON = 'poisson'
+
+    def __init__(self, params, randomGenerator=None):
+        """Creates new generator.
+
+        :param params: model parameters.
+        :type params: dict
+        :param randomGenerator: generator of random numbers for Poisson
+            arrivals. Global generator is used if it isn't set.
+        :raises ValueError: if distribution is unknown."""
+        description = params.get('arrivals', {})
+        self.distribution = description.get('distribution', ArrivalGenerator.UNIFORM)
+        if self.distribution not in (ArrivalGenerator.UNIFORM, ArrivalGenerator.POISSON):
+            msg = "Unknown distribution of arrivals: {0}.".format(self.distribution)
+            raise ValueError(msg)
+        self.random = randomGenerator if randomGenerator is not None else random
+
+        # Times when rate changes and rates since that times.
+        profile = [(0, params['inputRate'])]
+        profile.extend((ArrivalGenerator._toMicroseconds(time), rate)
+                       for time, rate in description.get('profile', []))
+        peakHour = description.get('peakHour')
+        if peakHour is not None:
+            start = ArrivalGenerator._toMicroseconds(peakHour['start'])
+            end = start + ArrivalGenerator._toMicroseconds(peakHour.get('duration', 3600))
+            # Rate after the peak hour is the rate of profile at its end.
+            afterRate = ArrivalGenerator._getProfileRate(profile, end)
+            profile = [item for item in profile if item[0] < start or item[0] > end]
+            profile.extend([(start, peakHour['rate']), (end, afterRate)])
+        profile.sort(key=lambda item: item[0])
+        self._times = [time for time, rate in profile]
+        self._rates = [rate for time, rate in profile]
+        # Uniform intervals between cars for each rate.
+        self._intervals = [kts46.utils.timedeltaToMicroseconds(timedelta(seconds=3600/rate))
+                           if rate > 0 else None for rate in self._rates]
+
+    @staticmethod
+    def _toMicroseconds(seconds):
+        return int(round(seconds * 1000000))
+
+    @staticmethod
+    def _getProfileRate(profile, time):
+        "Returns rate of unsorted profile at specified time."
+        return max((item for item in profile if item[0] <= time),
+                   key=lambda item: item[0])[1]
+
+    def getArrivals(self, nextArrival, end):
+        """Returns amount of cars that come to the road from the time of the
+        next car till the end of interval inclusive and time of the next car
+        after interval.
+
+        :param nextArrival: time of the next car.
+        :type nextArrival: int
+        :param end: end of interval.
+        :type end: int
+        :rtype: (int, int)"""
+        if self.distribution == ArrivalGenerator.UNIFORM:
+            return self._getUniformArrivals(nextArrival, end)
+        else:
+            return self._getPoissonArrivals(nextArrival, end)
+
+    def _getPiece(self, time):
+        """Returns index of profile piece of time and time when next piece
+        starts or None if piece is the last one."""
+        i = bisect_right(self._times, time) - 1
+        change = self._times[i + 1] if i + 1 < len(self._times) else None
+        return i, change
+
+    def _getUniformArrivals(self, nextArrival, end):
+        count = 0
+        while nextArrival <= end:
+            i, change = self._getPiece(nextArrival)
+            interval = self._intervals[i]
+            if interval is None:
+                # No cars till the next piece.
+                if change is None:
+                    return count, end + 1
+                nextArrival = change
+                continue
+            # Cars of this piece come with equal intervals.
+            limit = end if change is None else min(end, change - 1)
+            if nextArrival <= limit:
+                n = (limit - nextArrival) // interval + 1
+                count += n
+                nextArrival += n * interval
+        return count, nextArrival
+
+    def _getPoissonArrivals(self, nextArrival, end):
+        count = 0
+        # Cars don't come when rate is zero, so such time is only a time
+        # since which the next car is searched.
+        if self._rates[self._getPiece(nextArrival)[0]] == 0:
+            nextArrival = self._getNextPoissonArrival(nextArrival, end)
+        while nextArrival <= end:
+            count += 1
+            nextArrival = self._getNextPoissonArrival(nextArrival, end)
+        return count, nextArrival
+
+    def _getNextPoissonArrival(self, time, end):
+        """Returns time of the next car after the car at specified time. Gap
+        is drawn with the rate of current piece of profile, if it crosses the
+        start of the next piece then it is drawn again from that start with its
+        rate. Intervals between events of Poisson process are memoryless, so
+        this is exact. If rate is zero till the end of profile then time after
+        the end of interval is returned."""
+        while True:
+            i, change = self._getPiece(time)
+            rate = self._rates[i]
+            if rate > 0:
+                gap = int(round(self.random.expovariate(float(rate) / _HOUR)))
+                if change is None or time + gap < change:
+                    return time + gap
+            elif change is None:
+                return max(time, end) + 1
+            time = change
@@ -14,10 +14,21 @@
 
 import logging
 from uuid import uuid4
-import kts46.utils
+
+
+def _column(name, doc=None):
+    "Creates property for field of car that is stored in column of CarStore."
+    def get(self):
+        return self._store.columns[name][self.row]
+    def set(self, value):
+        self._store.columns[name][self.row] = value
+    return property(get, set, doc=doc)
+
 
 class Car(object):
-    "Represent a car in the model."
+    """Represent a car in the model. Fields of car are stored in the
+    :class:`CarStore` of the model and car object is only a view over a row of
+    that store. Number of that row is available as ``row`` field."""
 
     INACTIVE = 'inactive'
     ADDED = 'add'
@@ -29,20 +40,29 @@ class Car(object):
     BLINKER_RIGHT = 2
     BLINKER_ALARM = 3
 
+    # States are stored in CarStore as indexes in this tuple.
+    STATES = (INACTIVE, ADDED, ACTIVE, DELETED)
+    _ADDED = STATES.index(ADDED)
+    _ACTIVE = STATES.index(ACTIVE)
+    _DELETED = STATES.index(DELETED)
+
+    __slots__ = ('_store', 'row')
+
 
     def __init__(self, model, road, id=None, speed=15, length=4.5, width=1.5, position=0,
                 line=0):
         """Initializes a new car object.
 
         Creates new car using given parameters. Speed is measured in m/s, length,
-        width and position in metrs."""
+        width and position in metrs. Car is stored in the ``carStore`` of the
+        model, ``road`` must be the road of that store."""
 
+        self._store = model.carStore
+        self.row = self._store.allocate()
         if id is None:
             self.id = str(uuid4())
         else:
             self.id = str(id)
-        self.model = model
-        self.road = road
         self.desiredSpeed = speed
         self.currentSpeed = 0.0
         self.length = length
@@ -54,6 +74,46 @@ class Car(object):
         self.blinkerTime = 0.0
 
 
+    length = _column('length')
+    width = _column('width')
+    desiredSpeed = _column('desiredSpeed')
+    currentSpeed = _column('currentSpeed')
+    position = _column('position')
+    line = _column('line')
+    blinker = _column('blinker')
+    blinkerTime = _column('blinkerTime')
+
+    @property
+    def id(self):
+        return self._store.ids[self.row]
+
+    @id.setter
+    def id(self, value):
+        self._store.ids[self.row] = value
+
+    @property
+    def state(self):
+        return Car.STATES[self._store.state[self.row]]
+
+    @state.setter
+    def state(self, value):
+        self._store.state[self.row] = Car.STATES.index(value)
+
+    @property
+    def model(self):
+        return self._store.model
+
+    @property
+    def road(self):
+        return self._store.road
+
+
+    def release(self):
+        """Frees storage of car when it is removed from the model. Car object
+        must not be used after that."""
+        self._store.release(self.row)
+
+
     def getDescriptionData(self):
         """Get dictionary with data describing this car. Conains: id, length,
         width and desired speed.
@@ -96,9 +156,11 @@ class Car(object):
         self.width = description['width']
         self.desiredSpeed = description['desiredSpeed']
         if 'pos' in state: self.position = state['pos']
-        if 'line' in state: self.line = state['line']
+        if 'line' in state: self.line = int(state['line'])
         if 'curspd' in state: self.currentSpeed = state['curspd']
         if 'state' in state: self.state = state['state']
+        # Default state is omitted in state data.
+        elif len(state) > 0: self.state = Car.DEFAULT
         if 'blinker' in state: self.blinker = state['blinker']
         if 'blinkerTime' in state: self.blinkerTime = state['blinkerTime']
 
@@ -125,69 +187,80 @@ class Car(object):
         """Returns predicted moving distance for car for given time interval on
         the base of current car speed.
 
-        :param timedelta time: Time for which to calculate moving distance."
+        :param float time: Time in seconds for which to calculate moving distance."
         :rtype: float"""
-        distance = self.currentSpeed * kts46.utils.timedeltaToSeconds(time)
+        distance = self.currentSpeed * time
         return distance
 
 
-    def prepareMove(self, time):
+    def prepareMove(self, ts):
         """Calculates current car move but new parameters won't be saved to
         fields, other cars will make decisions on the basis of current car
-        state, not future."""
+        state, not future.
 
-        # Change state
-        if self.state == Car.ADDED:
-            self.state = Car.ACTIVE
+        :param float ts: length of step in seconds."""
+
+        # Fields are read from CarStore directly, that is faster then
+        # properties.
+        store = self._store
+        row = self.row
+        params = store.model.params
+        line = store.line[row]
+        position = store.position[row]
+        currentSpeed = store.currentSpeed[row]
+        blinker = store.blinker[row]
+        blinkerTime = store.blinkerTime[row]
 
-        ts = kts46.utils.timedeltaToSeconds(time)
+        # Change state
+        if store.state[row] == Car._ADDED:
+            store.state[row] = Car._ACTIVE
 
         brakingDistance = self.getBrakingDistance()
         desiredSpeed, desiredDistance = self.getDesiredDistance(ts)
         distanceToTL = self.getNearestTLDistance()
 
         # Get distance to leading car.
-        distanceToLeadingCar = self.getDistanceToLeadingCar(ts, self.line)
+        distanceToLeadingCar = self.getDistanceToLeadingCar(ts, line)
         # Skip it if it is after red light.
         if distanceToTL is not None and distanceToTL < distanceToLeadingCar:
             distanceToLeadingCar = None
 
         # Does leading car restatrains us?
-        if self.road.lines > 1 and distanceToLeadingCar is not None and distanceToLeadingCar <= brakingDistance:
+        if store.road.lines > 1 and distanceToLeadingCar is not None and distanceToLeadingCar <= brakingDistance:
             # Try other lines.
-            if self.line > 0:
-                rightDistance = self.tryOtherLine(ts, self.line - 1, distanceToTL)
+            if line > 0:
+                rightDistance = self.tryOtherLine(ts, line - 1, distanceToTL)
             else:
                 rightDistance = None
-            if self.line + 1 < self.road.lines:
-                leftDistance = self.tryOtherLine(ts, self.line + 1, distanceToTL)
+            if line + 1 < store.road.lines:
+                leftDistance = self.tryOtherLine(ts, line + 1, distanceToTL)
             else:
                 leftDistance = None
 
             # Choose line with maximum distance.
             # If speeds are equal, than lines are choosen according to priority:
             # current, left, right. Thus overtaking will be done on left line if possible.
-            finalLine = self.line
+            finalLine = line
             finalDistance = distanceToLeadingCar
             finalBlinker = Car.BLINKER_OFF
             # First try left.
             if leftDistance is not None and leftDistance > finalDistance:
                 # We want to go to this line, but we will be ably only if enough time passed.
-                if self.blinker == Car.BLINKER_LEFT and self.blinkerTime >= self.model.params['lineChangingDelay']:
-                    finalLine = self.line - 1
+                if blinker == Car.BLINKER_LEFT and blinkerTime >= params['lineChangingDelay']:
+                    finalLine = line - 1
                     finalDistance = leftDistance
                     finalBlinker = Car.BLINKER_OFF
                 else:
                     finalBlinker = Car.BLINKER_LEFT
             if rightDistance is not None and rightDistance > finalDistance:
-                if self.blinker == Car.BLINKER_RIGHT and self.blinkerTime >= self.model.params['lineChangingDelay']:
-                    finalLine = self.line + 1
+                if blinker == Car.BLINKER_RIGHT and blinkerTime >= params['lineChangingDelay']:
+                    finalLine = line + 1
                     finalDistance = rightDistance
                     finalBlinker = Car.BLINKER_OFF
                 else:
                     finalBlinker = Car.BLINKER_RIGHT
         else:
-            finalLine = self.line
+            finalLine = line
             finalBlinker = Car.BLINKER_OFF
             if distanceToLeadingCar is not None:
                 finalDistance = distanceToLeadingCar
@@ -198,85 +271,92 @@ class Car(object):
 
         if finalDistance <= brakingDistance:
             # Normal deacceleration.
-            allowedDistance = finalDistance - self.model.params['minimalDistance']
+            allowedDistance = finalDistance - params['minimalDistance']
             if allowedDistance > 0:
-                deacceleration = self.currentSpeed * self.currentSpeed / (2.0 * allowedDistance)
-                if deacceleration >= self.model.params["brakingLimit"]:
-                    deacceleration = self.model.params["brakingLimit"]
-                newSpeed = self.currentSpeed - deacceleration * ts
+                deacceleration = currentSpeed * currentSpeed / (2.0 * allowedDistance)
+                if deacceleration >= params["brakingLimit"]:
+                    deacceleration = params["brakingLimit"]
+                newSpeed = currentSpeed - deacceleration * ts
                 if newSpeed < 0: newSpeed = .0
             else:
                 deacceleration = .0
                 newSpeed = .0
-            newDistance = self.currentSpeed * ts - deacceleration * ts * ts / 2.0
+            newDistance = currentSpeed * ts - deacceleration * ts * ts / 2.0
             if newDistance < 0: newDistance = 0
         else:
             newSpeed = desiredSpeed
             newDistance = desiredDistance
 
-        newPosition = self.position + newDistance
+        newPosition = position + newDistance
         if finalBlinker == Car.BLINKER_OFF:
             blinkerTime = 0.0
-        elif self.blinker == finalBlinker:
-            blinkerTime = self.blinkerTime + ts
+        elif blinker == finalBlinker:
+            blinkerTime = blinkerTime + ts
         else:
             blinkerTime = ts
-        self.newState = {
-            'line': finalLine,
-            'position': newPosition,
-            'speed': newSpeed,
-            'blinker': finalBlinker,
-            'blinkerTime': blinkerTime
-        }
-        if self.road.length < newPosition:
-            self.newState['state'] = Car.DELETED
+        store.newLine[row] = finalLine
+        store.newPosition[row] = newPosition
+        store.newSpeed[row] = newSpeed
+        store.newBlinker[row] = finalBlinker
+        store.newBlinkerTime[row] = blinkerTime
+        store.newDeleted[row] = store.road.length < newPosition
 
 
     def finishMove(self):
         "Stores caclculated new moving parameters in the car fields."
-        self.line = self.newState['line']
-        self.position = self.newState['position']
-        self.currentSpeed = self.newState['speed']
-        self.blinker = self.newState['blinker']
-        self.blinkerTime = self.newState['blinkerTime']
-        if 'state' in self.newState: self.state = self.newState['state']
+        store = self._store
+        row = self.row
+        store.line[row] = store.newLine[row]
+        store.position[row] = store.newPosition[row]
+        store.currentSpeed[row] = store.newSpeed[row]
+        store.blinker[row] = store.newBlinker[row]
+        store.blinkerTime[row] = store.newBlinkerTime[row]
+        if store.newDeleted[row]: store.state[row] = Car._DELETED
 
 
     def getBrakingDistance(self):
-        a = self.model.params["comfortBrakingLimit"]
-        #treaction = self.model.params["driverReactionTime"]
+        params = self._store.model.params
+        a = params["comfortBrakingLimit"]
+        #treaction = params["driverReactionTime"]
         treaction = 0.0
-        smin = self.model.params["minimalDistance"]
-        return self.currentSpeed * (self.currentSpeed/(2*a) + treaction) + smin
+        smin = params["minimalDistance"]
+        currentSpeed = self._store.currentSpeed[self.row]
+        return currentSpeed * (currentSpeed/(2*a) + treaction) + smin
 
 
     def getDistanceToLeadingCar(self, interval, line):
         "Get distance to leading car including its predicted movement."
         # Get distance to leading car.
-        leadingCar = self.model.getNearestCar(self.position, line)
+        store = self._store
+        position = store.position[self.row]
+        leadingCar = store.model.getNearestCar(position, line)
         if leadingCar is None:
             return None
         else:
-            return (leadingCar.position - leadingCar.length - self.position +
-                    leadingCar.currentSpeed * interval)# - self.model.params['minimalDistance'])
+            row = leadingCar.row
+            return (store.position[row] - store.length[row] - position +
+                    store.currentSpeed[row] * interval)# - self.model.params['minimalDistance'])
 
 
     def getDesiredDistance(self, ts):
         """Get desired distance for car in following time cycle.
 
         :return: (desiredSpeed, desiredDistance)"""
-        desiredSpeed = min(self.desiredSpeed,
-            self.currentSpeed + self.model.params["accelerationLimit"] * ts)
-        acceleration = max(desiredSpeed - self.currentSpeed, 0)
-        desiredDistance = self.currentSpeed * ts + acceleration * ts * ts / 2.0
+        store = self._store
+        currentSpeed = store.currentSpeed[self.row]
+        desiredSpeed = min(store.desiredSpeed[self.row],
+            currentSpeed + store.model.params["accelerationLimit"] * ts)
+        acceleration = max(desiredSpeed - currentSpeed, 0)
+        desiredDistance = currentSpeed * ts + acceleration * ts * ts / 2.0
         return (desiredSpeed, desiredDistance)
 
 
     def getNearestTLDistance(self):
         "Returns distance to nearest traffic light or None if there is not any."
-        nearestTL = self.model.getNearestTrafficLight(self.position)
+        position = self._store.position[self.row]
+        nearestTL = self._store.model.getNearestTrafficLight(position)
         if nearestTL is not None and not nearestTL.isGreen:
-            return nearestTL.position - self.position
+            return nearestTL.position - position
         else:
             return None
 
@@ -0,0 +1,86 @@
+# Copyright 2010-2011 Anthony Kolesov
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from array import array
+
+
+class CarStore(object):
+    """Compact storage of cars fields. Each field is stored in a separate
+    column (``array.array``) and each car occupies one row in all columns.
+    :class:`Car` objects are only views over rows of this store, so cars don't
+    have instance dictionaries and references to model and road.
+
+    Rows of released cars are reused by new cars, so rows aren't moved and
+    row of car doesn't change while car exists."""
+
+    # Column name -> array type code.
+    COLUMNS = {
+        'length': 'd',
+        'width': 'd',
+        'desiredSpeed': 'd',
+        'currentSpeed': 'd',
+        'position': 'd',
+        'line': 'b',
+        'state': 'b',
+        'blinker': 'b',
+        'blinkerTime': 'd',
+        # New state calculated by Car.prepareMove.
+        'newLine': 'b',
+        'newPosition': 'd',
+        'newSpeed': 'd',
+        'newBlinker': 'b',
+        'newBlinkerTime': 'd',
+        'newDeleted': 'b',
+    }
+
+    def __init__(self, model, road):
+        """Creates new empty store for cars of model.
+
+        :param model: model to which cars belong.
+        :param road: road on which cars move."""
+        self.model = model
+        self.road = road
+        self.ids = []
+        # Columns are available both as attributes and in this dictionary.
+        self.columns = {}
+        for name, typecode in CarStore.COLUMNS.iteritems():
+            self.columns[name] = array(typecode)
+            setattr(self, name, self.columns[name])
+        self._freeRows = []
+
+    def __len__(self):
+        "Returns amount of cars in the store."
+        return len(self.ids) - len(self._freeRows)
+
+    def allocate(self):
+        """Allocates row for a new car. All fields of row are set to zero.
+
+        :returns: row number."""
+        if len(self._freeRows) > 0:
+            row = self._freeRows.pop()
+            for column in self.columns.itervalues():
+                column[row] = 0
+            self.ids[row] = None
+        else:
+            row = len(self.ids)
+            for column in self.columns.itervalues():
+                column.append(0)
+            self.ids.append(None)
+        return row
+
+    def release(self, row):
+        """Releases row of car that has been removed from the model. Row may be
+        reused by other cars, so view of released car must not be used."""
+        self.ids[row] = None
+        self._freeRows.append(row)
@@ -0,0 +1,140 @@
+# Copyright 2010-2011 Anthony Kolesov
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import struct
+import sys
+import zlib
+from array import array
+
+from Car import Car
+
+
+class CompactCheckpoint(object):
+    """Checkpoint of model packed into a compressed binary string. Fields of
+    cars on the road and in the enter queue are packed as columns of
+    little-endian numbers like columns of :class:`CarStore`, other data is
+    kept as JSON header. It is much smaller then checkpoint returned by
+    :meth:`Model.getCheckpointData` and is loaded without creating
+    dictionaries of cars.
+
+    ``header`` has the same fields as dictionary checkpoint except cars and
+    enter queue, but times are integer amounts of microseconds. Cars are
+    ``(ids, columns)`` tuples, where columns is a dictionary of arrays."""
+
+    # Binary strings of checkpoints start with this prefix.
+    MAGIC = 'kts46:checkpoint:1\n'
+
+    # Fields of cars in the order they are packed and their array type codes.
+    CAR_COLUMNS = (('position', 'd'), ('line', 'b'), ('currentSpeed', 'd'),
+                   ('state', 'b'), ('blinker', 'b'), ('blinkerTime', 'd'),
+                   ('length', 'd'), ('width', 'd'), ('desiredSpeed', 'd'))
+
+    def __init__(self, header, cars, enterQueue):
+        """Creates checkpoint.
+
+        :param header: data of checkpoint except cars.
+        :type header: dict
+        :param cars: packed cars on the road.
+        :param enterQueue: packed cars in the enter queue."""
+        self.header = header
+        self.cars = cars
+        self.enterQueue = enterQueue
+
+    @staticmethod
+    def isCompact(data):
+        "Checks whether checkpoint data is a packed checkpoint."
+        return isinstance(data, basestring) and data.startswith(CompactCheckpoint.MAGIC)
+
+    @staticmethod
+    def packCarsState(cars):
+        """Returns packed cars from (id, state, description) tuples returned by
+        :meth:`Model._getCarsState`."""
+        ids = []
+        columns = dict((name, array(typecode))
+                       for name, typecode in CompactCheckpoint.CAR_COLUMNS)
+        position, line, currentSpeed = columns['position'], columns['line'], columns['currentSpeed']
+        state, blinker, blinkerTime = columns['state'], columns['blinker'], columns['blinkerTime']
+        length, width, desiredSpeed = columns['length'], columns['width'], columns['desiredSpeed']
+        states = Car.STATES
+        for carId, carState, description in cars:
+            ids.append(carId)
+            position.append(carState[0])
+            line.append(carState[1])
+            currentSpeed.append(carState[2])
+            state.append(states.index(carState[3]))
+            blinker.append(carState[4])
+            blinkerTime.append(carState[5])
+            length.append(description[0])
+            width.append(description[1])
+            desiredSpeed.append(description[2])
+        return ids, columns
+
+    @staticmethod
+    def packCars(cars):
+        "Returns packed cars from list of :class:`Car`."
+        return CompactCheckpoint.packCarsState(
+            (car.id, (car.position, car.line, car.currentSpeed, car.state,
+                      car.blinker, car.blinkerTime),
+             (car.length, car.width, car.desiredSpeed)) for car in cars)
+
+    def pack(self):
+        """Returns checkpoint as compressed binary string.
+
+        :rtype: str"""
+        header = json.dumps(self.header, separators=(',', ':'))
+        parts = [struct.pack('<I', len(header)), header]
+        for ids, columns in (self.cars, self.enterQueue):
+            parts.append(CompactCheckpoint._packIds(ids))
+            for name, typecode in CompactCheckpoint.CAR_COLUMNS:
+                column = columns[name]
+                if sys.byteorder == 'big':
+                    column = array(typecode, column)
+                    column.byteswap()
+                parts.append(column.tostring())
+        return CompactCheckpoint.MAGIC + zlib.compress(''.join(parts))
+
+    @staticmethod
+    def _packIds(ids):
+        data = '\0'.join(unicode(carId).encode('utf-8') for carId in ids)
+        return struct.pack('<II', len(ids), len(data)) + data
+
+    @staticmethod
+    def unpack(data):
+        """Creates checkpoint from binary string returned by ``pack``.
+
+        :raises ValueError: if data isn't a packed checkpoint."""
+        if not CompactCheckpoint.isCompact(data):
+            raise ValueError("Data isn't a packed checkpoint.")
+        data = zlib.decompress(data[len(CompactCheckpoint.MAGIC):])
+        size = struct.unpack_from('<I', data)[0]
+        offset = 4 + size
+        header = json.loads(data[4:offset])
+        packedCars = []
+        for i in xrange(2):
+            count, size = struct.unpack_from('<II', data, offset)
+            offset += 8
+            ids = data[offset:offset + size].decode('utf-8').split(u'\0') if count > 0 else []
+            offset += size
+            columns = {}
+            for name, typecode in CompactCheckpoint.CAR_COLUMNS:
+                column = array(typecode)
+                end = offset + column.itemsize * count
+                column.fromstring(data[offset:end])
+                if sys.byteorder == 'big':
+                    column.byteswap()
+                columns[name] = column
+                offset = end
+            packedCars.append((ids, columns))
+        return CompactCheckpoint(header, packedCars[0], packedCars[1])
@@ -12,14 +12,21 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import heapq
 import json
 import logging
 import math
 import random
-from datetime import timedelta
+from bisect import bisect_left, bisect_right
+from collections import deque
+from itertools import islice
 
 import kts46.utils
+from kts46.carStatistics import CarStatistics
+from ArrivalGenerator import ArrivalGenerator
 from Car import Car
+from CarStore import CarStore
+from CompactCheckpoint import CompactCheckpoint
 from Road import Road
 from TrafficLight import SimpleSemaphore
 
@@ -38,21 +45,45 @@ class Model(object):
         "lineChangingDelay": 1.0 # m/s
     }
 
+    # Fields of car state in the order of values returned by _getCarsState.
+    CAR_STATE_FIELDS = ('pos', 'line', 'curspd', 'state', 'blinker', 'blinkerTime')
+
     def __init__(self, params):
         """Initializes new model with provided set of parameters.
 
         :param params: Model parameters.
         :type params: dictionary"""
-        self.time = timedelta()
+        # Times are integer amounts of microseconds, they are converted to
+        # strings only when state is saved.
+        self.time = 0
         self._cars = []
-        self._enterQueue = []
+        self._enterQueue = deque()
         self._lights = []
+        # Lights ordered by position and their positions.
+        self._lightsByPosition = []
+        self._lightPositions = []
+        # Heap of (next switch time, index of light in self._lights).
+        self._lightsQueue = []
         self._road = Road()
-        self._lastCarGenerationTime = timedelta()
+        self.carStore = CarStore(self, self._road)
+        self._lastCarGenerationTime = 0
         self.params = params
         self._loggerName = 'kts46.roadModel'
         self._logger = logging.getLogger(self._loggerName)
         self._lastCarId = -1
+        # Per line index of cars ordered by position: line -> (positions, cars).
+        self._lineIndex = {}
+        # State of the model on previous call of getStateDelta.
+        self._deltaCars = {}
+        self._deltaLights = {}
+        self._deltaQueueLength = 0
+        self._deltaLastCarId = -1
+        # Statistics calculated during simulation, if they are enabled.
+        self.statistics = None
+        # Generator of random numbers of this model. It is seeded from job
+        # definition and its state is saved with checkpoint.
+        self.random = random.Random()
+        self._arrivals = ArrivalGenerator(self.params, self.random)
 
 
     def run_step(self, milliseconds):
@@ -62,22 +93,11 @@ class Model(object):
         :type milliseconds: int"""
         stopDistance = self.params['safeDistance']
 
-        timeStep = timedelta(milliseconds=milliseconds)
+        timeStep = int(round(milliseconds * 1000))
         newTime = self.time + timeStep # Time after step is performed.
 
-        for light in self._lights:
-            if newTime > light.getNextSwitchTime():
-                light.switch(newTime)
-
-        toRemove = [ ]
-        for car in self._cars:
-            if car.state != Car.DELETED:
-                car.prepareMove(timeStep)
-            else:
-                toRemove.append(car)
-
-        for car in toRemove: self._cars.remove(car)
-        for car in self._cars: car.finishMove()
+        self.switchLights(newTime)
+        self.moveCars(timeStep)
 
         # Generate new car.
         # It is always added to the queue and if there is enough place then
@@ -91,6 +111,57 @@ class Model(object):
         # Update time.
         self.time = newTime
 
+        if self.statistics is not None:
+            self.statistics.addState(round(kts46.utils.microsecondsToSeconds(self.time), 3),
+                                     self._getCarsState())
+
+
+    def switchLights(self, newTime):
+        """Switches traffic lights which time has come. Synchronized lights
+        are switched at their switch time, other lights at the end of step.
+
+        :param newTime: time after step in microseconds.
+        :type newTime: int"""
+        queue = self._lightsQueue
+        while len(queue) > 0 and queue[0][0] < newTime:
+            switchTime, i = queue[0]
+            light = self._lights[i]
+            light.switch(switchTime if light.synchronized else newTime)
+            heapq.heapreplace(queue, (light.getNextSwitchTime(), i))
+
+
+    def _updateLightsIndex(self):
+        """Rebuilds list of lights ordered by position, which is used to find
+        nearest light, and queue of lights ordered by next switch time."""
+        # Stable sort, so the first of lights with equal positions is found
+        # like in getNearestObjectInArray.
+        self._lightsByPosition = sorted(self._lights, key=lambda light: light.position)
+        self._lightPositions = [light.position for light in self._lightsByPosition]
+        self._lightsQueue = [(light.getNextSwitchTime(), i)
+                             for i, light in enumerate(self._lights)]
+        heapq.heapify(self._lightsQueue)
+
+
+    def moveCars(self, timeStep):
+        """Moves cars on the road and removes cars that have left it on the
+        previous step.
+
+        :param timeStep: length of step in microseconds.
+        :type timeStep: int"""
+        ts = kts46.utils.microsecondsToSeconds(timeStep)
+        toRemove = [ ]
+        for car in self._cars:
+            if car.state != Car.DELETED:
+                car.prepareMove(ts)
+            else:
+                toRemove.append(car)
+
+        for car in toRemove:
+            self._cars.remove(car)
+            car.release()
+        for car in self._cars: car.finishMove()
+        self._updateLineIndex()
+
 
     def addCarsFromQueueToRoad(self):
         "Add cars from entering queue to road."
@@ -111,8 +182,7 @@ class Model(object):
                         addCar = True
                         break
             if addCar:
-                self._addCar(self._enterQueue[0])
-                del self._enterQueue[0]
+                self._addCar(self._enterQueue.popleft())
 
 
     def addCars(self, amount):
@@ -123,33 +193,41 @@ class Model(object):
         speedMultiplier = self.params['speed'][1] - self.params['speed'][0]
         speedAdder = self.params['speed'][0]
         for i in xrange(amount):
-            speed = math.floor(random.random() * speedMultiplier) + speedAdder
+            speed = math.floor(self.random.random() * speedMultiplier) + speedAdder
             self._lastCarId += 1
-            line = math.floor(random.random() * self._road.lines)
+            line = int(self.random.random() * self._road.lines)
             newCar = Car(model=self, road=self._road, id=self._lastCarId, speed=speed, line=line)
             self._logger.debug('Created car: [speed: %f].', speed)
             self._enterQueue.append(newCar)
 
 
     def howManyCarsToAdd(self, newTime):
-        "Define how many cars can be added to the model."
-        newCarGenRate = timedelta(seconds=3600/self.params['inputRate'])
-        lastCarTime = self._lastCarGenerationTime
-        carsToGenerate = 0
-        while lastCarTime <= newTime:
-            carsToGenerate += 1
-            lastCarTime += newCarGenRate
-        return (carsToGenerate, lastCarTime)
+        """Define how many cars can be added to the model. Last car generation
+        time is the time when the next car comes.
+
+        :returns: amount of cars and new last car generation time."""
+        return self._arrivals.getArrivals(self._lastCarGenerationTime, newTime)
 
 
     def getNearestTrafficLight(self, position):
         "Get nearest traffic light to specified position in forward destination."
-        return self.getNearestObjectInArray(self._lights, position)
+        # Same threshold as in getNearestObjectInArray.
+        i = bisect_left(self._lightPositions, position + 0.1)
+        if i == len(self._lightPositions):
+            return None
+        return self._lightsByPosition[i]
 
     def getNearestCar(self, position, line=0):
         """Get nearest car to specified position in forward destination.
         If there is no leading car, then ``None`` will be returned."""
-        return self.getNearestObjectInArray(self._cars, position, line)
+        if line not in self._lineIndex:
+            return None
+        positions, cars = self._lineIndex[line]
+        # Same threshold as in getNearestObjectInArray.
+        i = bisect_left(positions, position + 0.1)
+        if i == len(positions):
+            return None
+        return cars[i]
 
     def getNearestObjectInArray(self, array, position, line=0):
         "Get nearest object in array to specified position in forward destination."
@@ -181,7 +259,15 @@ class Model(object):
     def getFollowingCar(self, position, line=0):
         """Get nearest following car to specified position in backward destination.
         If there is no following car, then ``None`` will be returned."""
-        return self.getFollowingObjectInArray(self._cars, position, line)
+        if line not in self._lineIndex:
+            return None
+        positions, cars = self._lineIndex[line]
+        i = bisect_right(positions, position) - 1
+        if i < 0:
+            return None
+        # If several cars have the same position then linear scan returns
+        # first of them, so do the same.
+        return cars[bisect_left(positions, positions[i], 0, i)]
 
 
     def getFollowingObjectInArray(self, array, position, line=0):
@@ -215,6 +301,43 @@ class Model(object):
         "Add car to the model, but not to the road."
         self._cars.append(car)
         car.state = Car.ADDED
+        # Car is the last in the self._cars so it goes after cars with the same
+        # position.
+        positions, cars = self._lineIndex.setdefault(car.line, ([], []))
+        i = bisect_right(positions, car.position)
+        positions.insert(i, car.position)
+        cars.insert(i, car)
+
+    def _updateLineIndex(self):
+        """Rebuilds index of cars on each line ordered by position. It is used
+        by getNearestCar and getFollowingCar instead of scanning all cars, so it
+        must be rebuilt each time when cars are moved. Sort is stable, so cars
+        with equal positions are kept in order of self._cars like in
+        getNearestObjectInArray."""
+        # Read fields directly from the store, it is much faster then
+        # properties of Car.
+        deleted = Car.STATES.index(Car.DELETED)
+        state = self.carStore.state
+        line = self.carStore.line
+        position = self.carStore.position
+        lines = {}
+        for car in self._getIndexedCars():
+            if state[car.row] != deleted:
+                lines.setdefault(line[car.row], []).append(car)
+        self._lineIndex = {}
+        for line, cars in lines.iteritems():
+            cars.sort(key=lambda car: position[car.row])
+            self._lineIndex[line] = ([position[car.row] for car in cars], cars)
+
+    def _getIndexedCars(self):
+        "Returns cars that are included in index of lines."
+        return self._cars
+
+
+    def close(self):
+        "Releases resources used by model. Model can't be used after that."
+        pass
+
 
     def getStateData(self):
         """Returns object data that represents current state of a model."""
@@ -227,9 +350,8 @@ class Model(object):
 
         # Cars
         cars = {}
-        for car in self._cars:
-            cars[car.id] = car.getStateData()
-            cars[car.id].update(car.getDescriptionData())
+        for id, state, description in self._getCarsState():
+            cars[id] = Model._getCarData(id, state, description)
         data['cars'] = cars
 
         # Enter queue
@@ -240,14 +362,191 @@ class Model(object):
         data['enterQueue'] = enterQueue
 
         # Fields
-        data['time'] = kts46.utils.timedelta2str(self.time)
-        data['lastCarGenerationTime'] = kts46.utils.timedelta2str(self._lastCarGenerationTime)
+        data['time'] = kts46.utils.microseconds2str(self.time)
+        data['lastCarGenerationTime'] = kts46.utils.microseconds2str(self._lastCarGenerationTime)
         data['lastCarId'] = self._lastCarId
 
         # Result.
         return data
 
 
+    def getCheckpointData(self):
+        """Returns data required to continue simulation: state of model, state
+        of random numbers generator and state of statistics calculated during
+        simulation."""
+        data = self.getStateData()
+        # Positions of cars are rounded in states, but simulation must continue
+        # like it hasn't been interrupted, so checkpoint has exact values and
+        # order of cars.
+        cars = self._getCarsState(False)
+        data['cars'] = dict((id, Model._getCarData(id, state, description))
+                            for id, state, description in cars)
+        data['carsOrder'] = [id for id, state, description in cars]
+        data['random'] = self._getRandomStateData()
+        if self.statistics is not None:
+            data['statistics'] = self.statistics.getStateData()
+        return data
+
+
+    def getCompactCheckpointData(self):
+        """Returns the same data as ``getCheckpointData`` packed into a
+        compressed binary string by :class:`CompactCheckpoint`. Model can be
+        loaded from both formats.
+
+        :rtype: str"""
+        header = {
+            'trafficLights': dict((light.id, light.getStateData()) for light in self._lights),
+            'time': self.time,
+            'lastCarGenerationTime': self._lastCarGenerationTime,
+            'lastCarId': self._lastCarId,
+            'random': self._getRandomStateData()
+        }
+        if self.statistics is not None:
+            header['statistics'] = self.statistics.getStateData()
+        cars = CompactCheckpoint.packCarsState(self._getCarsState(False))
+        enterQueue = CompactCheckpoint.packCars(self._enterQueue)
+        return CompactCheckpoint(header, cars, enterQueue).pack()
+
+
+    def _getRandomStateData(self):
+        version, internalState, gaussNext = self.random.getstate()
+        return {'version': version, 'state': internalState, 'gaussNext': gaussNext}
+
+
+    def seed(self, seed, replica=0):
+        """Seeds random numbers generator of model. Generators of different
+        replicas with the same seed produce independent streams of numbers.
+
+        :param seed: seed of job.
+        :param replica: number of replica.
+        :type replica: int"""
+        self.random.seed(seed)
+        if replica > 0:
+            self.random.jumpahead(replica)
+
+
+    def getStateDelta(self):
+        """Returns changes of model state since previous call of this method.
+        First call returns all cars, lights and enter queue as new. Delta
+        contains:
+
+        * ``cars`` -- changed fields of cars that were on the road before;
+        * ``newCars`` -- data of cars that have been added to the road, the
+          same as in ``getStateData``;
+        * ``removedCars`` -- ids of cars that have been removed from the road;
+        * ``trafficLights`` -- data of lights which state has changed;
+        * ``enterQueue`` -- dictionary with amount of cars ``removed`` from the
+          beginning of queue and data of cars ``added`` to its end;
+        * ``time``, ``lastCarGenerationTime`` and ``lastCarId`` like in
+          ``getStateData``.
+
+        State at the time of this call can be reconstructed from the state at
+        the time of previous call with :func:`applyStateDelta`."""
+        delta = {}
+
+        # Cars
+        previousCars = self._deltaCars
+        currentCars = {}
+        changedCars = {}
+        newCars = {}
+        for id, state, description in self._getCarsState():
+            currentCars[id] = state
+            previous = previousCars.get(id)
+            if previous is None:
+                newCars[id] = Model._getCarData(id, state, description)
+            elif previous != state:
+                changes = {}
+                for name, value, oldValue in zip(Model.CAR_STATE_FIELDS, state, previous):
+                    if value != oldValue:
+                        changes[name] = value
+                # Blinker time is omitted from state data when blinker is off.
+                if 'blinker' in changes:
+                    changes['blinkerTime'] = state[5]
+                changedCars[id] = changes
+        delta['cars'] = changedCars
+        delta['newCars'] = newCars
+        delta['removedCars'] = [id for id in previousCars if id not in currentCars]
+        self._deltaCars = currentCars
+
+        # Traffic lights
+        lights = {}
+        for light in self._lights:
+            lightData = light.getStateData()
+            if self._deltaLights.get(light.id) != lightData:
+                lights[light.id] = lightData
+                self._deltaLights[light.id] = lightData
+        delta['trafficLights'] = lights
+
+        # Enter queue: cars are added to the end and removed from the beginning.
+        queueLength = len(self._enterQueue)
+        addedCount = min(self._lastCarId - self._deltaLastCarId, queueLength)
+        added = []
+        for car in islice(self._enterQueue, queueLength - addedCount, None):
+            added.append(car.getStateData())
+            added[-1].update(car.getDescriptionData())
+        delta['enterQueue'] = {
+            'removed': self._deltaQueueLength - (queueLength - addedCount),
+            'added': added
+        }
+        self._deltaQueueLength = queueLength
+        self._deltaLastCarId = self._lastCarId
+
+        # Fields
+        delta['time'] = kts46.utils.microseconds2str(self.time)
+        delta['lastCarGenerationTime'] = kts46.utils.microseconds2str(self._lastCarGenerationTime)
+        delta['lastCarId'] = self._lastCarId
+        return delta
+
+
+    def _getCarsState(self, roundPositions=True):
+        """Returns list of (id, state, description) tuples for cars on the road,
+        where state is a tuple of values of fields from CAR_STATE_FIELDS and
+        description is a tuple of length, width and desired speed. Positions
+        are rounded to centimeters unless ``roundPositions`` is false."""
+        store = self.carStore
+        ids = store.ids
+        position = store.position
+        line = store.line
+        currentSpeed = store.currentSpeed
+        state = store.state
+        blinker = store.blinker
+        blinkerTime = store.blinkerTime
+        length = store.length
+        width = store.width
+        desiredSpeed = store.desiredSpeed
+        result = []
+        for car in self._cars:
+            row = car.row
+            pos = round(position[row], 2) if roundPositions else position[row]
+            result.append((ids[row],
+                (pos, line[row], currentSpeed[row],
+                 Car.STATES[state[row]], blinker[row], blinkerTime[row]),
+                (length[row], width[row], desiredSpeed[row])))
+        return result
+
+
+    @staticmethod
+    def _getCarData(id, state, description):
+        """Returns car data in the format of Car.getStateData and
+        Car.getDescriptionData from tuples returned by _getCarsState."""
+        pos, line, curspd, carState, blinker, blinkerTime = state
+        length, width, desiredSpeed = description
+        d = {'pos': pos,
+             'line': line,
+             'curspd': curspd,
+             'id': id,
+             'length': length,
+             'width': width,
+             'desiredSpeed': desiredSpeed
+        }
+        if carState != Car.DEFAULT:
+            d['state'] = carState
+        if blinker != Car.BLINKER_OFF:
+            d['blinker'] = blinker
+            d['blinkerTime'] = blinkerTime
+        return d
+
+
     def getDescriptionData(self):
         "Gets dictionary describing model."
         data = {}
@@ -262,21 +561,43 @@ class Model(object):
 
 
     def load(self, description, state=None):
-        "Loads object from JSON data."
+        """Loads object from JSON data. State may be a state or checkpoint
+        dictionary or a checkpoint packed by ``getCompactCheckpointData``."""
+        checkpoint = None
+        if CompactCheckpoint.isCompact(state):
+            checkpoint = CompactCheckpoint.unpack(state)
+            state = checkpoint.header
 
         self.params = description['modelParameters']
         self._road.load(description['road'])
+        self._arrivals = ArrivalGenerator(self.params, self.random)
+
+        simParams = description.get('simulationParameters', {})
+        if simParams.get('seed') is not None:
+            self.seed(simParams['seed'], simParams.get('replica', 0))
 
+        offsets = Model._getGreenWaveOffsets(description)
         for lightId, lightData in description['trafficLights'].iteritems():
-            light = SimpleSemaphore(id=lightId)
+            light = SimpleSemaphore(id=lightId, randomGenerator=self.random)
             lState = {}
             if state is not None:
                 lState = state['trafficLights'][lightId]
+            if lightId in offsets:
+                lightData = dict(lightData, offset=offsets[lightId])
             light.load(lightData, lState)
             self._lights.append(light)
+        self._updateLightsIndex()
 
-        if state is not None:
-            for carData in state['cars'].itervalues():
+        if checkpoint is not None:
+            self._cars.extend(self._loadPackedCars(checkpoint.cars))
+            self._enterQueue.extend(self._loadPackedCars(checkpoint.enterQueue))
+            self.time = state['time']
+            self._lastCarGenerationTime = state['lastCarGenerationTime']
+            self._lastCarId = state['lastCarId']
+        elif state is not None:
+            # Checkpoint contains order of cars.
+            for carId in state.get('carsOrder', state['cars']):
+                carData = state['cars'][carId]
                 c = Car(model=self, road=self._road)
                 c.load(carData, carData)
                 self._cars.append(c)
@@ -287,6 +608,107 @@ class Model(object):
                 self._enterQueue.append(c)
 
             # Fields
-            self.time = kts46.utils.str2timedelta(state['time'])
-            self._lastCarGenerationTime = kts46.utils.str2timedelta(state['lastCarGenerationTime'])
+            self.time = kts46.utils.str2microseconds(state['time'])
+            self._lastCarGenerationTime = kts46.utils.str2microseconds(state['lastCarGenerationTime'])
             self._lastCarId = state['lastCarId']
+
+        # Checkpoint contains state of random numbers generator.
+        if state is not None and 'random' in state:
+            randomState = state['random']
+            self.random.setstate((randomState['version'],
+                                  tuple(randomState['state']),
+                                  randomState['gaussNext']))
+
+        if simParams.get('onlineStatistics', False):
+            self.statistics = CarStatistics(simParams.get('measurementPoints', []),
+                                            description.get('detectors'))
+            if state is not None and 'statistics' in state:
+                self.statistics.load(state['statistics'])
+
+        self._updateLineIndex()
+
+
+    def _loadPackedCars(self, packedCars):
+        """Creates cars from cars packed by :class:`CompactCheckpoint`. Columns
+        are copied to the store at once if rows of cars are contiguous.
+
+        :returns: list of cars."""
+        ids, columns = packedCars
+        cars = [Car(model=self, road=self._road, id=carId) for carId in ids]
+        if len(cars) == 0:
+            return cars
+        store = self.carStore
+        rows = [car.row for car in cars]
+        start, end = rows[0], rows[-1] + 1
+        if end - start == len(rows):
+            store.ids[start:end] = ids
+            for name, column in columns.iteritems():
+                store.columns[name][start:end] = column
+        else:
+            for name, column in columns.iteritems():
+                storeColumn = store.columns[name]
+                for row, value in zip(rows, column):
+                    storeColumn[row] = value
+            for row, carId in zip(rows, ids):
+                store.ids[row] = carId
+        return cars
+
+
+    @staticmethod
+    def _getGreenWaveOffsets(description):
+        """Returns offsets of lights of green wave declared in ``greenWave``
+        section of job definition. Green light of each light starts when car
+        that moves with the speed of wave comes to it from the first light.
+
+        :returns: light id -> offset in seconds.
+        :rtype: dict"""
+        greenWave = description.get('greenWave')
+        if greenWave is None:
+            return {}
+        lights = description['trafficLights']
+        ids = greenWave.get('lights', lights.keys())
+        if len(ids) == 0:
+            return {}
+        start = min(lights[lightId]['position'] for lightId in ids)
+        speed = float(greenWave['speed'])
+        offset = greenWave.get('offset', 0)
+        return dict((lightId, offset + (lights[lightId]['position'] - start) / speed)
+                    for lightId in ids)
+
+
+def applyStateDelta(state, delta):
+    """Applies changes returned by :meth:`Model.getStateDelta` to the state
+    returned by :meth:`Model.getStateData`. State is changed in place and
+    returned. Enter queue is updated only if it is present both in state and
+    in delta, because storages usually don't save it.
+
+    :param state: model state for the time of previous delta.
+    :type state: dict
+    :param delta: changes of model state.
+    :type delta: dict
+    :rtype: dict"""
+    cars = state['cars']
+    for carId in delta['removedCars']:
+        del cars[carId]
+    for carId, changes in delta['cars'].iteritems():
+        car = cars[carId]
+        car.update(changes)
+        # Default values are omitted in state data.
+        if car.get('state') == Car.DEFAULT:
+            del car['state']
+        if car.get('blinker') == Car.BLINKER_OFF:
+            del car['blinker']
+            del car['blinkerTime']
+    for carId, car in delta['newCars'].iteritems():
+        cars[carId] = dict(car)
+
+    state['trafficLights'].update(delta['trafficLights'])
+
+    if 'enterQueue' in state and 'enterQueue' in delta:
+        del state['enterQueue'][:delta['enterQueue']['removed']]
+        state['enterQueue'].extend(delta['enterQueue']['added'])
+
+    state['time'] = delta['time']
+    state['lastCarGenerationTime'] = delta['lastCarGenerationTime']
+    state['lastCarId'] = delta['lastCarId']
+    return state
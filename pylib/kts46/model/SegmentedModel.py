@@ -0,0 +1,387 @@
+# Copyright 2010-2011 Anthony Kolesov
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Model that splits road into contiguous segments simulated by separate
+processes.
+
+Each segment moves only its own cars. Cars of other segments that are nearest
+to the segment on each line are copied to it as ghosts before each step, so
+cars near the borders see the same leading and following cars as in a model of
+the whole road. After the step cars that have crossed the end of segment are
+moved to the following segments. Cars are generated and added to the road by
+the first segment, which also coordinates the others, so states are the same
+as states of :class:`Model` with the same seed.
+
+Daemonic processes, like processes of ``multiprocessing.Pool``, can't start
+processes, so in them segments are simulated in the same process one after
+another."""
+
+import copy
+import logging
+import multiprocessing
+from bisect import bisect_left, bisect_right
+
+import kts46.utils
+from Car import Car
+from Model import Model
+
+
+def _getCarRecord(car):
+    """Returns tuple with exact values of all fields of car: id, position,
+    line, current speed, state, blinker, blinker time, length, width and
+    desired speed."""
+    store = car._store
+    row = car.row
+    return (store.ids[row], store.position[row], store.line[row],
+            store.currentSpeed[row], store.state[row], store.blinker[row],
+            store.blinkerTime[row], store.length[row], store.width[row],
+            store.desiredSpeed[row])
+
+
+def _getCarOrder(carId):
+    "Returns key that orders cars in the order they have been added to road."
+    return int(carId)
+
+
+class RoadSegment(Model):
+    """Model of a part of the road from ``start`` to ``end``. If ``end`` is
+    ``None`` then segment lasts till the end of the road."""
+
+    # Threshold used by Model.getNearestCar.
+    GAP = 0.1
+
+    def __init__(self, params, start=0.0, end=None):
+        """Creates new segment.
+
+        :param params: Model parameters.
+        :type params: dictionary
+        :param start: position where segment starts.
+        :type start: float
+        :param end: position where segment ends.
+        :type end: float"""
+        Model.__init__(self, params)
+        self.start = start
+        self.end = end
+        self._ghosts = []
+
+
+    def _getIndexedCars(self):
+        return self._cars + self._ghosts
+
+
+    def loadSegment(self, description, lights, time, cars):
+        """Loads segment of other model.
+
+        :param description: job definition.
+        :param lights: traffic lights of model.
+        :param time: current time of model in microseconds.
+        :type time: int
+        :param cars: records of cars of segment."""
+        self.params = description['modelParameters']
+        self._road.load(description['road'])
+        self._lights = lights
+        self._updateLightsIndex()
+        self.time = time
+        self.takeCars(cars)
+
+
+    def moveSegment(self, milliseconds, ghosts):
+        """Performs move part of simulation step: switches lights and moves
+        cars, but doesn't generate new ones.
+
+        :param milliseconds: length of step in milliseconds.
+        :type milliseconds: int
+        :param ghosts: records of cars of other segments.
+        :returns: records of cars that have left segment."""
+        timeStep = int(round(milliseconds * 1000))
+        self.setGhosts(ghosts)
+        self.switchLights(self.time + timeStep)
+        self.moveCars(timeStep)
+        self.time += timeStep
+        leaving = self.removeLeavingCars()
+        self.setGhosts([])
+        return leaving
+
+
+    def removeLeavingCars(self):
+        """Removes cars that are beyond the end of segment. Index of lines
+        isn't updated.
+
+        :returns: records of removed cars."""
+        if self.end is None:
+            return []
+        position = self.carStore.position
+        leaving = [car for car in self._cars if position[car.row] >= self.end]
+        records = []
+        for car in leaving:
+            records.append(_getCarRecord(car))
+            self._cars.remove(car)
+            car.release()
+        return records
+
+
+    def takeCars(self, records):
+        """Adds cars that have entered segment. Cars are kept in the order
+        they have been added to the road.
+
+        :param records: records of cars."""
+        if len(records) > 0:
+            order = [_getCarOrder(car.id) for car in self._cars]
+            for record in records:
+                i = bisect_right(order, _getCarOrder(record[0]))
+                order.insert(i, _getCarOrder(record[0]))
+                self._cars.insert(i, self._createCar(record))
+        self._updateLineIndex()
+
+
+    def setGhosts(self, records):
+        """Replaces ghost cars with the new ones and updates index of lines.
+
+        :param records: records of cars of other segments."""
+        for car in self._ghosts:
+            car.release()
+        self._ghosts = [self._createCar(record) for record in records]
+        self._updateLineIndex()
+
+
+    def getBoundaryCars(self):
+        """Returns cars of segment that may be ghosts of other segments. For
+        each line there are cars at the start of segment: all that are closer
+        then ``GAP`` to the start and the first after them, and the last car of
+        segment. Must be called when segment has no ghosts.
+
+        :returns: line -> (list of records of first cars, record of last car).
+        :rtype: dict"""
+        result = {}
+        for line, (positions, cars) in self._lineIndex.iteritems():
+            headEnd = bisect_left(positions, self.start + RoadSegment.GAP) + 1
+            head = [_getCarRecord(car) for car in cars[:headEnd]]
+            # Like getFollowingCar return first of cars with the same position.
+            tail = _getCarRecord(cars[bisect_left(positions, positions[-1])])
+            result[line] = (head, tail)
+        return result
+
+
+    def _createCar(self, record):
+        "Creates car from record returned by _getCarRecord."
+        car = Car(model=self, road=self._road, id=record[0])
+        store = self.carStore
+        row = car.row
+        (store.position[row], store.line[row], store.currentSpeed[row],
+         store.state[row], store.blinker[row], store.blinkerTime[row],
+         store.length[row], store.width[row], store.desiredSpeed[row]) = record[1:]
+        return car
+
+
+def _executeSegmentCommand(segment, command, args):
+    "Executes command sent to segment and returns response to it."
+    if command == 'move':
+        return segment.moveSegment(*args)
+    elif command == 'take':
+        segment.takeCars(args)
+        return segment.getBoundaryCars()
+    elif command == 'state':
+        return Model._getCarsState(segment, args)
+
+
+def _segmentProcessImplementation(conn, params, description, lights, time, start, end, cars):
+    """Simulates segment of road in a separate process. Commands are received
+    from connection as (name, arguments) tuples."""
+    segment = RoadSegment(params, start, end)
+    segment.loadSegment(description, lights, time, cars)
+    conn.send(segment.getBoundaryCars())
+    while True:
+        command, args = conn.recv()
+        if command == 'close':
+            break
+        conn.send(_executeSegmentCommand(segment, command, args))
+    conn.close()
+
+
+class LocalSegmentConnection(object):
+    """Simulates segment of road in the current process, but acts like
+    connection to segment process: response to command is received with
+    ``recv`` after command is sent with ``send``."""
+
+    def __init__(self, params, description, lights, time, start, end, cars):
+        # Segment process gets copies of arguments, so does this segment.
+        params, description, lights, cars = copy.deepcopy((params, description, lights, cars))
+        self._segment = RoadSegment(params, start, end)
+        self._segment.loadSegment(description, lights, time, cars)
+        self._responses = [self._segment.getBoundaryCars()]
+
+    def send(self, message):
+        command, args = message
+        if command != 'close':
+            self._responses.append(_executeSegmentCommand(self._segment, command, args))
+
+    def recv(self):
+        return self._responses.pop(0)
+
+    def close(self):
+        pass
+
+
+class SegmentedModel(RoadSegment):
+    """Model that simulates road in several processes. Amount of segments is
+    defined by ``segments`` simulation parameter, by default it is equal to
+    amount of CPUs. Model itself is the first segment.
+
+    Cars are ordered by their ids, so cars ids must be numbers, like ids of
+    cars generated by model."""
+
+    def __init__(self, params):
+        """Initializes new model with provided set of parameters.
+
+        :param params: Model parameters.
+        :type params: dictionary"""
+        RoadSegment.__init__(self, params)
+        self._starts = [0.0]
+        self._connections = []
+        self._processes = []
+        # Boundary cars of other segments.
+        self._boundaries = []
+
+
+    def load(self, description, state=None):
+        """Loads model and starts processes of segments. If current process is
+        daemonic then segments are simulated in it. Model must be closed with
+        ``close`` after use."""
+        Model.load(self, description, state)
+        self._cars.sort(key=lambda car: _getCarOrder(car.id))
+
+        simParams = description.get('simulationParameters', {})
+        count = simParams.get('segments') or multiprocessing.cpu_count()
+        length = float(self._road.length)
+        self._starts = [length * i / count for i in xrange(count)]
+        if count > 1:
+            self.end = self._starts[1]
+        cars = [[] for i in xrange(count)]
+        for record in self.removeLeavingCars():
+            cars[bisect_right(self._starts, record[1]) - 1].append(record)
+        self._updateLineIndex()
+
+        # Daemonic process isn't allowed to have children.
+        local = multiprocessing.current_process().daemon
+        if local and count > 1:
+            logging.getLogger(self._loggerName).warning(
+                "Segments are simulated in one process because process %s is daemonic.",
+                multiprocessing.current_process().name)
+        ends = self._starts[2:] + [None]
+        for start, end, segmentCars in zip(self._starts[1:], ends, cars[1:]):
+            if local:
+                self._connections.append(LocalSegmentConnection(self.params,
+                    description, self._lights, self.time, start, end, segmentCars))
+                continue
+            conn, childConn = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=_segmentProcessImplementation,
+                args=(childConn, self.params, description, self._lights,
+                      self.time, start, end, segmentCars))
+            process.daemon = True
+            process.start()
+            self._connections.append(conn)
+            self._processes.append(process)
+        self._boundaries = [conn.recv() for conn in self._connections]
+
+
+    def run_step(self, milliseconds):
+        """Performs one step of simulation.
+
+        :param milliseconds: length of step in milliseconds.
+        :type milliseconds: int"""
+        timeStep = int(round(milliseconds * 1000))
+        newTime = self.time + timeStep # Time after step is performed.
+
+        # Move cars of all segments.
+        self.setGhosts([])
+        boundaries = [self.getBoundaryCars()] + self._boundaries
+        for i, conn in enumerate(self._connections, 1):
+            conn.send(('move', (milliseconds, self._getGhosts(boundaries, i))))
+        self.setGhosts(self._getGhosts(boundaries, 0))
+        self.switchLights(newTime)
+        self.moveCars(timeStep)
+
+        # Move cars that have crossed borders of segments.
+        leaving = self.removeLeavingCars()
+        for conn in self._connections:
+            leaving.extend(conn.recv())
+        cars = [[] for conn in self._connections]
+        for record in leaving:
+            cars[bisect_right(self._starts, record[1]) - 2].append(record)
+        for conn, segmentCars in zip(self._connections, cars):
+            conn.send(('take', segmentCars))
+        self._boundaries = [conn.recv() for conn in self._connections]
+        self.setGhosts(self._getGhosts([{}] + self._boundaries, 0))
+
+        # Generate new cars like Model does.
+        carsToAdd, newLastCarTime = self.howManyCarsToAdd(newTime)
+        self.addCars(carsToAdd)
+        self._lastCarGenerationTime = newLastCarTime
+        self.addCarsFromQueueToRoad()
+
+        self.time = newTime
+
+        if self.statistics is not None:
+            self.statistics.addState(round(kts46.utils.microsecondsToSeconds(self.time), 3),
+                                     self._getCarsState())
+
+
+    def _getGhosts(self, boundaries, index):
+        """Returns records of ghost cars for segment.
+
+        :param boundaries: boundary cars of all segments.
+        :param index: number of segment."""
+        ghosts = []
+        lines = set()
+        for boundary in boundaries:
+            lines.update(boundary)
+        end = self._starts[index + 1] if index + 1 < len(self._starts) else None
+        for line in lines:
+            # Leading cars.
+            if end is not None:
+                for boundary in boundaries[index + 1:]:
+                    if line in boundary:
+                        head = boundary[line][0]
+                        ghosts.extend(head)
+                        if head[-1][1] >= end + RoadSegment.GAP:
+                            break
+            # Following car.
+            for boundary in reversed(boundaries[:index]):
+                if line in boundary:
+                    ghosts.append(boundary[line][1])
+                    break
+        return ghosts
+
+
+    def _getCarsState(self, roundPositions=True):
+        for conn in self._connections:
+            conn.send(('state', roundPositions))
+        result = Model._getCarsState(self, roundPositions)
+        for conn in self._connections:
+            result.extend(conn.recv())
+        result.sort(key=lambda car: _getCarOrder(car[0]))
+        return result
+
+
+    def close(self):
+        "Stops processes of segments."
+        for conn in self._connections:
+            conn.send(('close', None))
+        for process in self._processes:
+            process.join()
+        for conn in self._connections:
+            conn.close()
+        self._connections = []
+        self._processes = []
+        self._boundaries = []
@@ -12,7 +12,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from random import random
+import random
 from datetime import timedelta
 from uuid import uuid4
 import kts46.utils
@@ -21,23 +21,33 @@ class SimpleSemaphore(object):
     """Simple semaphore that works in one direction.
 
     Duration of green and red lights states are setted separatly.
-    They are stored as datetime.timedelta type, but you can just a number, it
-    will be used as a number of seconds in conversion. Id is always converted to
-    unicode.
+    They are stored as integer amounts of microseconds like all times of
+    model, but you can set a number of seconds or datetime.timedelta, it will
+    be converted. Id is always converted to unicode.
+
+    If light has an offset, then it is synchronized: green light starts at
+    offset and after that each cycle of green and red, so lights with
+    different offsets make a green wave. Otherwise light switches at the end of
+    step when its time has come.
     """
 
     __green_state = "g"
     __red_state = "r"
 
-    def __init__(self, id=None, position=0, greenDuration=5, redDuration=5):
-        """Creates a new simple semaphore."""
+    def __init__(self, id=None, position=0, greenDuration=5, redDuration=5,
+                 randomGenerator=None):
+        """Creates a new simple semaphore. Original state is chosen with
+        ``randomGenerator`` or with global generator if it isn't set."""
+        if randomGenerator is None:
+            randomGenerator = random
         self.id = str(id if (id is not None) else uuid4())
         self.position = position
-        self.lastSwitchTime = timedelta()
+        self.lastSwitchTime = 0
         # Original state is random.
-        self.state = SimpleSemaphore.__red_state if random() > 0.5 else SimpleSemaphore.__green_state
+        self.state = SimpleSemaphore.__red_state if randomGenerator.random() > 0.5 else SimpleSemaphore.__green_state
         self.greenDuration = 5
         self.redDuration = 5
+        self.synchronized = False
 
     def switch(self, currentTime):
         "Switches semaphore to the other state and records current time."
@@ -53,33 +63,66 @@ class SimpleSemaphore(object):
 
     def getNextSwitchTime(self):
         if self.isGreen:
-            addTime = self.greenDuration
+            addTime = self._greenDuration
         else:
-            addTime = self.redDuration
+            addTime = self._redDuration
         return self.lastSwitchTime + addTime
 
     def getDescriptionData(self):
         return {#'id': self.id,
                 'position': self.position,
-                'green': self.greenDuration,
-                'red': self.redDuration
+                'green': kts46.utils.microsecondsToSeconds(self._greenDuration),
+                'red': kts46.utils.microsecondsToSeconds(self._redDuration)
         }
 
     def getStateData(self):
         return {
             'state': self.state,
-            'lastSwitchTime': kts46.utils.timedelta2str(self.lastSwitchTime)
+            'lastSwitchTime': kts46.utils.microseconds2str(self.lastSwitchTime)
         }
 
-    # Little metaprogramming magic, so it is possible to set duration as float
-    # (in seconds). Also store in unicode explicitly.
-    def __setattr__(self, name, value):
-        effValue = value
-        if ((name == "greenDuration" or name == "redDuration") and
-                not isinstance(value, timedelta)):
-            effValue = timedelta(seconds=value)
-        object.__setattr__(self, name, effValue)
+    @staticmethod
+    def _toMicroseconds(value):
+        "Converts duration in seconds or timedelta to microseconds."
+        if not isinstance(value, timedelta):
+            value = timedelta(seconds=value)
+        return kts46.utils.timedeltaToMicroseconds(value)
+
+    @property
+    def greenDuration(self):
+        "Duration of green light in microseconds."
+        return self._greenDuration
+
+    @greenDuration.setter
+    def greenDuration(self, value):
+        self._greenDuration = SimpleSemaphore._toMicroseconds(value)
+
+    @property
+    def redDuration(self):
+        "Duration of red light in microseconds."
+        return self._redDuration
 
+    @redDuration.setter
+    def redDuration(self, value):
+        self._redDuration = SimpleSemaphore._toMicroseconds(value)
+
+    def setOffset(self, offset):
+        """Sets state of light at time zero, so that green light starts at
+        ``offset`` and after each cycle of green and red. Light becomes
+        synchronized.
+
+        :param offset: offset in seconds.
+        :type offset: float"""
+        cycle = self._greenDuration + self._redDuration
+        # Time passed since the start of green light.
+        phase = -SimpleSemaphore._toMicroseconds(offset) % cycle
+        if phase < self._greenDuration:
+            self.state = SimpleSemaphore.__green_state
+            self.lastSwitchTime = -phase
+        else:
+            self.state = SimpleSemaphore.__red_state
+            self.lastSwitchTime = self._greenDuration - phase
+        self.synchronized = True
 
     def load(self, description, state={}):
         self.position = description['position']
@@ -88,8 +131,9 @@ class SimpleSemaphore(object):
         # Load color from description if available.
         if 'state' in description: self.state = description['state']
         if 'id' in description: self.id = description['id']
+        if 'offset' in description: self.setOffset(description['offset'])
 
         # Load current state of light.
         if 'state' in state: self.state = state['state']
         if 'lastSwitchTime' in state:
-            self.lastSwitchTime = kts46.utils.str2timedelta(state['lastSwitchTime'])
+            self.lastSwitchTime = kts46.utils.str2microseconds(state['lastSwitchTime'])
@@ -0,0 +1,372 @@
+# Copyright 2010-2011 Anthony Kolesov
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import numpy
+
+import kts46.utils
+from Car import Car
+from Model import Model
+
+
+class VectorModel(Model):
+    """Model that stores cars on the road in NumPy arrays and moves all of them
+    at once instead of calling ``Car.prepareMove`` and ``Car.finishMove`` for
+    each car. Cars in the enter queue are still :class:`Car` objects.
+
+    Every car makes its decision on the basis of state of other cars on the
+    previous step, so the result is the same as of :class:`Model`. Arrays are
+    kept in the order in which cars have been added to the road, that is used
+    to choose between cars with equal positions exactly like ``Model`` does."""
+
+    # Car states are stored as indexes in this tuple, like in CarStore.
+    STATES = Car.STATES
+    _ADDED = Car._ADDED
+    _ACTIVE = Car._ACTIVE
+    _DELETED = Car._DELETED
+
+    def __init__(self, params):
+        Model.__init__(self, params)
+        self._ids = numpy.zeros(0, dtype=object)
+        self._length = numpy.zeros(0)
+        self._width = numpy.zeros(0)
+        self._desiredSpeed = numpy.zeros(0)
+        self._position = numpy.zeros(0)
+        self._line = numpy.zeros(0, dtype=int)
+        self._speed = numpy.zeros(0)
+        self._state = numpy.zeros(0, dtype=int)
+        self._blinker = numpy.zeros(0, dtype=int)
+        self._blinkerTime = numpy.zeros(0)
+
+
+    def moveCars(self, timeStep):
+        """Moves cars on the road and removes cars that have left it on the
+        previous step.
+
+        :param timeStep: length of step in microseconds.
+        :type timeStep: int"""
+        self._removeCars(self._state != VectorModel._DELETED)
+        if len(self._position) == 0:
+            return
+
+        params = self.params
+        ts = kts46.utils.microsecondsToSeconds(timeStep)
+        pos = self._position
+        speed = self._speed
+        line = self._line
+        length = self._length
+        lanes = self._getLanes()
+
+        # Comparisons with NaN (it stands for None in Car) are always false.
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            # Braking and desired distances: Car.getBrakingDistance and
+            # Car.getDesiredDistance.
+            brakingDistance = speed * (speed / (2 * params["comfortBrakingLimit"]) +
+                0.0) + params["minimalDistance"]
+            desiredSpeed = numpy.minimum(self._desiredSpeed,
+                speed + params["accelerationLimit"] * ts)
+            acceleration = numpy.maximum(desiredSpeed - speed, 0)
+            desiredDistance = speed * ts + acceleration * ts * ts / 2.0
+
+            distanceToTL = self._getNearestTLDistances(pos)
+
+            # Get distance to leading car and skip it if it is after red light.
+            distanceToLeadingCar = self._getLeadingDistances(lanes, pos, line, ts)
+            distanceToLeadingCar[distanceToTL < distanceToLeadingCar] = numpy.nan
+
+            # Does leading car restrains us? Decide on line for those cars.
+            finalLine = line.copy()
+            finalDistance = distanceToLeadingCar.copy()
+            finalBlinker = numpy.zeros(len(pos), dtype=int)
+            if self._road.lines > 1:
+                changing = numpy.flatnonzero(distanceToLeadingCar <= brakingDistance)
+            else:
+                changing = numpy.zeros(0, dtype=int)
+            if len(changing) > 0:
+                self._chooseLines(lanes, ts, changing, distanceToTL,
+                                  finalLine, finalDistance, finalBlinker)
+
+            # Other cars are following leading car, red light or move freely.
+            free = numpy.ones(len(pos), dtype=bool)
+            free[changing] = False
+            noLeader = free & numpy.isnan(finalDistance)
+            finalDistance[noLeader] = distanceToTL[noLeader]
+            noObstacle = free & numpy.isnan(finalDistance)
+            finalDistance[noObstacle] = brakingDistance[noObstacle] + 1.0
+
+            # Normal deacceleration.
+            braking = finalDistance <= brakingDistance
+            allowedDistance = finalDistance - params['minimalDistance']
+            deacceleration = speed * speed / (2.0 * allowedDistance)
+            limit = deacceleration >= params["brakingLimit"]
+            deacceleration[limit] = params["brakingLimit"]
+            deacceleration[~(allowedDistance > 0)] = .0
+            brakingSpeed = speed - deacceleration * ts
+            brakingSpeed[brakingSpeed < 0] = .0
+            brakingSpeed[~(allowedDistance > 0)] = .0
+            brakingMove = speed * ts - deacceleration * ts * ts / 2.0
+            brakingMove[brakingMove < 0] = 0
+
+        newSpeed = numpy.where(braking, brakingSpeed, desiredSpeed)
+        newPosition = pos + numpy.where(braking, brakingMove, desiredDistance)
+
+        blinkerTime = numpy.where(finalBlinker == self._blinker,
+                                  self._blinkerTime + ts, ts)
+        blinkerTime[finalBlinker == Car.BLINKER_OFF] = 0.0
+
+        # Finish move.
+        self._line = finalLine
+        self._position = newPosition
+        self._speed = newSpeed
+        self._blinker = finalBlinker
+        self._blinkerTime = blinkerTime
+        self._state[self._state == VectorModel._ADDED] = VectorModel._ACTIVE
+        self._state[self._road.length < newPosition] = VectorModel._DELETED
+
+
+    def _chooseLines(self, lanes, ts, changing, distanceToTL,
+                     finalLine, finalDistance, finalBlinker):
+        """Does the same as second part of Car.prepareMove for cars that are
+        restrained by leading car: tries other lines and chooses line with
+        maximum distance. Values in finalLine, finalDistance and finalBlinker
+        are changed in place."""
+        line = self._line[changing]
+        tl = distanceToTL[changing]
+        nan = numpy.empty(len(changing))
+        nan.fill(numpy.nan)
+
+        right = numpy.where(line > 0, self._tryOtherLine(lanes, ts, changing,
+            line - 1, tl), nan)
+        left = numpy.where(line + 1 < self._road.lines,
+            self._tryOtherLine(lanes, ts, changing, line + 1, tl), nan)
+
+        delay = self.params['lineChangingDelay']
+        blinker = self._blinker[changing]
+        blinkerTime = self._blinkerTime[changing]
+        distance = finalDistance[changing]
+        newLine = line.copy()
+        newBlinker = numpy.zeros(len(changing), dtype=int)
+
+        # First try left.
+        wants = left > distance
+        moves = wants & (blinker == Car.BLINKER_LEFT) & (blinkerTime >= delay)
+        newLine[moves] = line[moves] - 1
+        distance[moves] = left[moves]
+        newBlinker[wants & ~moves] = Car.BLINKER_LEFT
+
+        wants = right > distance
+        moves = wants & (blinker == Car.BLINKER_RIGHT) & (blinkerTime >= delay)
+        newLine[moves] = line[moves] + 1
+        distance[moves] = right[moves]
+        newBlinker[moves] = Car.BLINKER_OFF
+        newBlinker[wants & ~moves] = Car.BLINKER_RIGHT
+
+        finalLine[changing] = newLine
+        finalDistance[changing] = distance
+        finalBlinker[changing] = newBlinker
+
+
+    def _tryOtherLine(self, lanes, ts, cars, lineNumbers, distanceToTL):
+        """Vectorized version of Car.tryOtherLine.
+
+        :returns:
+            predicted distance to leading car or NaN if it isn't possible to
+            move to that line or -1 if there is no leading car."""
+        params = self.params
+        pos = self._position[cars]
+        length = self._length[cars]
+        leaders = self._getLeaders(lanes, pos, lineNumbers)
+        hasLeader = leaders >= 0
+        leaders = leaders[hasLeader]
+        result = numpy.empty(len(cars))
+        result.fill(-1)
+        result[hasLeader] = (self._position[leaders] - self._length[leaders] -
+            pos[hasLeader] + self._speed[leaders] * ts)
+
+        # Ignore if after red light.
+        forbidden = distanceToTL < result
+        # Check for rear safe distance.
+        following = self._getFollowers(lanes, pos, lineNumbers)
+        safe = following >= 0
+        rearDistance = numpy.empty(len(cars))
+        rearDistance.fill(numpy.nan)
+        rearDistance[safe] = pos[safe] - self._position[following[safe]]
+        forbidden |= rearDistance - length < params['safeDistanceRear']
+
+        # Cars on the line after target that want to change line into our
+        # target, see Car.tryOtherLine.
+        nextLineLeaders = self._getLeaders(lanes, pos, lineNumbers - 1)
+        found = (lineNumbers > 0) & (nextLineLeaders >= 0)
+        i = nextLineLeaders[found]
+        forbidden[found] |= ((self._blinker[i] == Car.BLINKER_LEFT) &
+            (self._position[i] - pos[found] - self._length[i] < params['safeDistanceRear']))
+        found = (lineNumbers > 0) & (following >= 0)
+        i = following[found]
+        forbidden[found] |= ((self._blinker[i] == Car.BLINKER_LEFT) &
+            (pos[found] - self._position[i] - length[found] < params['safeDistanceRear']))
+
+        result[forbidden & hasLeader] = numpy.nan
+        return result
+
+
+    def _getNearestTLDistances(self, positions):
+        """Returns distances to nearest traffic light for each position if it
+        is red and NaN otherwise."""
+        result = numpy.empty(len(positions))
+        result.fill(numpy.nan)
+        if len(self._lights) == 0:
+            return result
+        lights = self._lightsByPosition
+        lightPositions = numpy.array(self._lightPositions, dtype=float)
+        red = numpy.array([not light.isGreen for light in lights])
+        i = numpy.searchsorted(lightPositions, positions + 0.1, 'left')
+        found = i < len(lights)
+        found[found] = red[i[found]]
+        result[found] = lightPositions[i[found]] - positions[found]
+        return result
+
+
+    def _getLeadingDistances(self, lanes, positions, lineNumbers, ts):
+        "Returns distance to leading car including its predicted movement."
+        leaders = self._getLeaders(lanes, positions, lineNumbers)
+        result = numpy.empty(len(positions))
+        result.fill(numpy.nan)
+        found = leaders >= 0
+        i = leaders[found]
+        result[found] = (self._position[i] - self._length[i] - positions[found] +
+                         self._speed[i] * ts)
+        return result
+
+
+    def _getLanes(self):
+        """Returns dictionary line -> (positions, indexes) where positions are
+        sorted positions of cars on line and indexes are indexes of those cars
+        in arrays."""
+        lanes = {}
+        for line in numpy.unique(self._line):
+            indexes = numpy.flatnonzero(self._line == line)
+            order = numpy.argsort(self._position[indexes], kind='mergesort')
+            lanes[line] = (self._position[indexes][order], indexes[order])
+        return lanes
+
+
+    def _getLeaders(self, lanes, positions, lineNumbers):
+        """Vectorized Model.getNearestCar. Returns array of indexes of leading
+        cars or -1 where there is no leading car."""
+        result = numpy.empty(len(positions), dtype=int)
+        result.fill(-1)
+        for line, (lanePositions, indexes) in lanes.iteritems():
+            query = numpy.flatnonzero(lineNumbers == line)
+            if len(query) == 0:
+                continue
+            i = numpy.searchsorted(lanePositions, positions[query] + 0.1, 'left')
+            found = i < len(indexes)
+            result[query[found]] = indexes[i[found]]
+        return result
+
+
+    def _getFollowers(self, lanes, positions, lineNumbers):
+        """Vectorized Model.getFollowingCar. Returns array of indexes of
+        following cars or -1 where there is no following car."""
+        result = numpy.empty(len(positions), dtype=int)
+        result.fill(-1)
+        for line, (lanePositions, indexes) in lanes.iteritems():
+            query = numpy.flatnonzero(lineNumbers == line)
+            if len(query) == 0:
+                continue
+            i = numpy.searchsorted(lanePositions, positions[query], 'right') - 1
+            found = i >= 0
+            # The first of cars with the same position.
+            i = numpy.searchsorted(lanePositions, lanePositions[i[found]], 'left')
+            result[query[found]] = indexes[i]
+        return result
+
+
+    def _removeCars(self, keep):
+        "Removes cars from arrays. Cars with True in ``keep`` array are kept."
+        self._ids = self._ids[keep]
+        self._length = self._length[keep]
+        self._width = self._width[keep]
+        self._desiredSpeed = self._desiredSpeed[keep]
+        self._position = self._position[keep]
+        self._line = self._line[keep]
+        self._speed = self._speed[keep]
+        self._state = self._state[keep]
+        self._blinker = self._blinker[keep]
+        self._blinkerTime = self._blinkerTime[keep]
+
+
+    def _appendCars(self, cars):
+        "Appends list of cars to arrays."
+        ids = numpy.empty(len(cars), dtype=object)
+        ids[:] = [car.id for car in cars]
+        self._ids = numpy.append(self._ids, ids)
+        self._length = numpy.append(self._length, [car.length for car in cars])
+        self._width = numpy.append(self._width, [car.width for car in cars])
+        self._desiredSpeed = numpy.append(self._desiredSpeed,
+                                          [car.desiredSpeed for car in cars])
+        self._position = numpy.append(self._position, [car.position for car in cars])
+        self._line = numpy.append(self._line,
+                                  [car.line for car in cars]).astype(int)
+        self._speed = numpy.append(self._speed, [car.currentSpeed for car in cars])
+        self._state = numpy.append(self._state,
+            [VectorModel.STATES.index(car.state) for car in cars]).astype(int)
+        self._blinker = numpy.append(self._blinker,
+                                     [car.blinker for car in cars]).astype(int)
+        self._blinkerTime = numpy.append(self._blinkerTime,
+                                         [car.blinkerTime for car in cars])
+
+
+    def canAddCar(self, line=0):
+        "Defines whether car can be added to specified line."
+        # Detect cars which are comming on the road, like Model does.
+        cars = numpy.flatnonzero((self._line == line) &
+                                 (self._state != VectorModel._DELETED) &
+                                 (self._position >= -100.0 + 0.1))
+        if len(cars) == 0:
+            return True
+        lastCar = cars[numpy.argmin(self._position[cars])]
+        return (self._position[lastCar] - self._length[lastCar] >
+                self.params['safeDistance'])
+
+
+    def _addCar(self, car):
+        "Add car to the model, but not to the road."
+        car.state = Car.ADDED
+        self._appendCars([car])
+        car.release()
+
+
+    def _getCarsState(self, roundPositions=True):
+        """Returns list of (id, state, description) tuples for cars on the road,
+        like Model._getCarsState."""
+        states = [VectorModel.STATES[state] for state in self._state.tolist()]
+        positions = self._position.tolist()
+        if roundPositions:
+            positions = [round(pos, 2) for pos in positions]
+        return zip(self._ids,
+                   zip(positions, self._line.tolist(), self._speed.tolist(),
+                       states, self._blinker.tolist(), self._blinkerTime.tolist()),
+                   zip(self._length.tolist(), self._width.tolist(),
+                       self._desiredSpeed.tolist()))
+
+
+    def load(self, description, state=None):
+        "Loads object from JSON data."
+        Model.load(self, description, state)
+        # Move loaded cars to arrays.
+        self._appendCars(self._cars)
+        for car in self._cars:
+            car.release()
+        self._cars = []
+        self._updateLineIndex()
@@ -23,9 +23,21 @@ On their hand projects act like type specific dictionaries for
 :py:class:`SimulationJob` s. And jobs act like dictionaries for their
 simulation states."""
 
+import copy
 import logging
 import math # Math.floor
+import Queue
+import random
+import sys
+import threading
+import uuid
+import bson
 import pymongo # connect with db
+from kts46.ensembleStatistics import EnsembleStatistics
+from kts46.model.Car import Car
+from kts46.model.Model import applyStateDelta
+from kts46.outputPolicy import OutputPolicy
+from kts46.trajectories import TrajectoryBatch
 
 
 class StorageException(Exception):
@@ -159,18 +171,24 @@ class SimulationProject(object):
             self.db.cars.create_index([('job',pymongo.ASCENDING),('carid',pymongo.ASCENDING)])
             self.db.cars.create_index([('job',pymongo.ASCENDING),('time',pymongo.ASCENDING)])
             self.db.states.create_index([('job',pymongo.ASCENDING),('time',pymongo.ASCENDING)])
+        # Collection of columnar trajectories may be absent in old projects.
+        self.db.trajectories.ensure_index([('job',pymongo.ASCENDING),('start',pymongo.ASCENDING)])
+        self.db.trajectories.ensure_index([('job',pymongo.ASCENDING),('cars',pymongo.ASCENDING)])
 
     def addJob(self, jobName, definition):
-        """Adds job with specified YAML definition to project.
+        """Adds job with specified YAML definition to project. If definition
+        has ``ensemble`` section then ensemble of replicas is added instead.
 
         :param jobName: job name
         :type jobName: str
         :param definition: definition of job written in YAML.
         :type definition: str
         :returns: created job.
-        :rtype: :py:class:`SimulationJob`
+        :rtype: :py:class:`SimulationJob` or :py:class:`SimulationEnsemble`
         :raises StorageException: if job with specified name already exists.
         """
+        if 'ensemble' in definition:
+            return self.addEnsemble(jobName, definition)
 
         # Check for job duplication.
         if jobName in self:
@@ -180,6 +198,53 @@ class SimulationProject(object):
         return job
 
 
+    def addEnsemble(self, name, definition):
+        """Adds ensemble of replicas of job with specified definition.
+
+        :param name: name of ensemble.
+        :type name: str
+        :param definition: definition of job with ``ensemble`` section.
+        :type definition: dict
+        :rtype: :py:class:`SimulationEnsemble`
+        :raises StorageException: if ensemble or job with the same name as
+            ensemble or one of its replicas already exists or if ensemble has
+            no replicas.
+        """
+        if definition['ensemble']['replicas'] < 1:
+            msg = "Couldn't add ensemble '{0}' to project '{1}' because it must have at least one replica."
+            raise StorageException(msg.format(name, self.name))
+        names = [name] + SimulationEnsemble.getReplicasNames(name, definition)
+        for jobName in names:
+            if jobName in self or self.db.ensembles.find_one(jobName) is not None:
+                msg = "Couldn't add ensemble '{0}' to project '{1}' because job '{2}' already exists."
+                raise StorageException(msg.format(name, self.name, jobName))
+        return SimulationEnsemble(self, name, definition)
+
+
+    def getEnsemble(self, name):
+        """Gets ensemble with specified name.
+
+        :rtype: :py:class:`SimulationEnsemble`
+        :raises KeyError: if ensemble with specified name doesn't exists.
+        """
+        if self.db.ensembles.find_one(name) is None:
+            msg = "Couldn't get ensemble '{0}' from project '{1}' because it doesn't exists."
+            raise KeyError(msg.format(name, self.name))
+        return SimulationEnsemble(self, name)
+
+
+    def deleteEnsemble(self, name):
+        """Deletes ensemble with specified name and all of its replicas.
+
+        :raises KeyError: if ensemble with specified name doesn't exists.
+        """
+        ensemble = self.getEnsemble(name)
+        for replicaName in ensemble.replicas:
+            if replicaName in self:
+                del self[replicaName]
+        self.db.ensembles.remove(name)
+
+
     def __getitem__(self, key):
         """Gets job with specified name.
 
@@ -224,6 +289,7 @@ class SimulationProject(object):
         self.db.jobs.remove(key)
         self.db.states.remove({'job': key})
         self.db.cars.remove({'job': key})
+        self.db.trajectories.remove({'job': key})
 
 
     def getJobsNames(self):
@@ -257,10 +323,12 @@ class SimulationJob(object):
     BASIC_STATISTICS_FIELD_NAME = 'basicStatistics'
     IDLE_TIMES_FIELD_NAME = 'idleTimes'
     THROUGHPUT_FIELD_NAME = 'throughput'
+    DETECTORS_FIELD_NAME = 'detectors'
     FULL_STATISTICS_FIELD_NAME= 'fullStatistics'
+    OUTPUT_FIELD_NAME = 'output'
     
 
-    def __init__(self, project, name, definition=None):
+    def __init__(self, project, name, definition=None, ensemble=None):
         """Create new :class:`SimulationJob` instance .
 
         :param project: project to which job belongs.
@@ -270,6 +338,8 @@ class SimulationJob(object):
         :param definition: YAML definition of job. If it is omitted than job
          will be loaded from database.
         :type definition: str
+        :param ensemble: name of ensemble if new job is its replica.
+        :type ensemble: str
         """
         self.project = project
         self.db = project.db
@@ -278,6 +348,7 @@ class SimulationJob(object):
         self.progress = None
         self.statistics = None
         self.definition = definition
+        self.ensemble = ensemble
         if definition is None:
             self._load()
         else:
@@ -290,9 +361,13 @@ class SimulationJob(object):
         simulationTime = simParams['duration']
         simulationStep = simParams['stepDuration']
         simulationBatchLength = simParams['batchLength']
+        policy = OutputPolicy(simParams)
+        if policy.isSparse:
+            # Statistics can't be calculated from saved states.
+            simParams['onlineStatistics'] = True
 
         self.db.jobs.insert({'name': self.name, 'definition': self.definition,
-                             '_id': self.id})
+                             '_id': self.id, 'ensemble': self.ensemble})
         self.db.progresses.insert({'_id': self.id,
             'totalSteps': math.ceil(simulationTime / simulationStep),
             'batches': math.ceil(simulationTime / simulationStep / simulationBatchLength),
@@ -301,6 +376,7 @@ class SimulationJob(object):
             SimulationJob.IDLE_TIMES_FIELD_NAME: False,
             SimulationJob.THROUGHPUT_FIELD_NAME: False,
             SimulationJob.FULL_STATISTICS_FIELD_NAME: False,
+            SimulationJob.OUTPUT_FIELD_NAME: policy.getDescriptionData(),
             'jobname': self.name
         })
 
@@ -309,7 +385,8 @@ class SimulationJob(object):
             SimulationJob.STDEVIATION_FIELD_NAME: None,
             SimulationJob.AVERAGE_SPEED_FIELD_NAME: None,
             SimulationJob.IDLE_TIMES_FIELD_NAME: {},
-            SimulationJob.THROUGHPUT_FIELD_NAME: []}
+            SimulationJob.THROUGHPUT_FIELD_NAME: [],
+            SimulationJob.DETECTORS_FIELD_NAME: []}
         self.db.statistics.insert(self.statistics)
 
 
@@ -318,6 +395,7 @@ class SimulationJob(object):
         doc = self.db.jobs.find_one(self.name)
 
         self.definition = doc['definition']
+        self.ensemble = doc.get('ensemble')
 
         self.progress = self.db.progresses.find_one(self.id)
         self.statistics = self.db.statistics.find_one(self.id)
@@ -360,12 +438,158 @@ class SimulationJob(object):
         if s is None:
             raise KeyError("There is no state with specified time: {0}.".format(key))
         
-        carSpec = {'job': self.id, 'time': key}
         carFields = ['pos', 'width', 'length', 'line']
+        if self.deltaOutput:
+            s['data'] = self._reconstructState(key)
+            s['data']['cars'] = [dict((field, car[field]) for field in carFields)
+                                 for car in s['data']['cars'].itervalues()]
+            return s
+
+        if self.stateOutput == 'columns':
+            batchSpec = {'job': self.id, 'start': {'$lte': s['time']},
+                         'end': {'$gte': s['time']}}
+            doc = self.db.trajectories.find_one(batchSpec)
+            cars = []
+            if doc is not None:
+                batch = TrajectoryBatch.fromDocument(doc)
+                cars = batch.getCarsAt(s['time'])
+            s['data']['cars'] = [dict((field, car[field]) for field in carFields)
+                                 for car in cars]
+            return s
+
+        carSpec = {'job': self.id, 'time': key}
         s['data']['cars'] = [x for x in self.db.cars.find(carSpec, carFields) ]
         return s
 
 
+    @property
+    def stateOutput(self):
+        """How states of this job are saved: ``full``, ``delta`` or
+        ``columns``. See description of ``stateOutput`` simulation parameter."""
+        return self.definition['simulationParameters'].get('stateOutput', 'full')
+
+
+    @property
+    def outputPolicy(self):
+        """Policy that defines which states of this job are saved.
+
+        :rtype: :class:`kts46.outputPolicy.OutputPolicy`"""
+        return OutputPolicy(self.definition['simulationParameters'])
+
+
+    def getAvailableTimes(self):
+        """Returns times of states that have been saved by simulation that is
+        done so far.
+
+        :rtype: list of float"""
+        policy = self.outputPolicy
+        return [policy.getTime(step)
+                for step in policy.getOutputSteps(0, int(self.progress['done']))]
+
+
+    @property
+    def deltaOutput(self):
+        """Whether states of this job are saved as keyframes and deltas between
+        them instead of full state for each step."""
+        return self.stateOutput == 'delta'
+
+
+    def iterCarRecords(self):
+        """Iterates over records of cars of all states of job in order of time
+        regardless of how states are saved.
+
+        :returns: iterator of tuples (time, car id, position, state, line)."""
+        if self.stateOutput == 'columns':
+            for batch in self.iterTrajectoryBatches():
+                for record in batch.iterRows():
+                    yield record
+        elif self.stateOutput == 'delta':
+            for time, state in self.iterStates():
+                for carId, car in state['cars'].iteritems():
+                    yield (time, carId, car['pos'], car.get('state', Car.DEFAULT),
+                           car['line'])
+        else:
+            fields = ['time', 'carid', 'pos', 'state', 'line']
+            for car in self.db.cars.find({'job': self.id}, fields).sort('time'):
+                yield (car['time'], car['carid'], car['pos'],
+                       car.get('state', Car.DEFAULT), car['line'])
+
+
+    def getCarTrajectory(self, carId):
+        """Returns records of one car in order of time regardless of how states
+        are saved. With columns output only batches that contain the car are
+        read.
+
+        :returns: list of tuples (time, position, state, line).
+        :rtype: list"""
+        if self.stateOutput == 'columns':
+            result = []
+            spec = {'job': self.id, 'cars': carId}
+            for doc in self.db.trajectories.find(spec).sort('start'):
+                result.extend(TrajectoryBatch.fromDocument(doc).getCarTrajectory(carId))
+            return result
+        elif self.stateOutput == 'delta':
+            # States have to be reconstructed, so all of them are read.
+            result = []
+            for time, state in self.iterStates():
+                car = state['cars'].get(carId)
+                if car is not None:
+                    result.append((time, car['pos'], car.get('state', Car.DEFAULT),
+                                   car['line']))
+            return result
+        fields = ['time', 'pos', 'state', 'line']
+        spec = {'job': self.id, 'carid': carId}
+        return [(car['time'], car['pos'], car.get('state', Car.DEFAULT), car['line'])
+                for car in self.db.cars.find(spec, fields).sort('time')]
+
+
+    def iterTrajectoryBatches(self, unpack=True):
+        """Iterates over columnar trajectories batches of job in order of time.
+        Used for jobs with columns output.
+
+        :param unpack: whether columns are required. If False then only index
+            of batches is read.
+        :type unpack: bool
+        :rtype: iterator of :class:`kts46.trajectories.TrajectoryBatch`"""
+        fields = None if unpack else {'columns': 0}
+        for doc in self.db.trajectories.find({'job': self.id}, fields).sort('start'):
+            yield TrajectoryBatch.fromDocument(doc)
+
+
+    def _reconstructState(self, time):
+        """Reconstructs full state for specified time from the nearest previous
+        keyframe and deltas after it. Used for jobs with delta output.
+
+        :param time: time of state.
+        :type time: float
+        :rtype: dict"""
+        keyframeSpec = {'job': self.id, 'time': {'$lte': time},
+                        'data': {'$exists': True}}
+        keyframe = self.db.states.find_one(keyframeSpec,
+                                           sort=[('time', pymongo.DESCENDING)])
+        if keyframe is None:
+            raise KeyError("There is no keyframe before time: {0}.".format(time))
+        state = keyframe['data']
+        deltasSpec = {'job': self.id, 'time': {'$gt': keyframe['time'], '$lte': time}}
+        for doc in self.db.states.find(deltasSpec, ['delta']).sort('time'):
+            applyStateDelta(state, doc['delta'])
+        return state
+
+
+    def iterStates(self):
+        """Iterates over all states of job with delta output in order of time.
+        Yields tuples (time, data). Note that the same dictionary is updated
+        and returned for each state, so it must be copied if it is required
+        after next iteration."""
+        state = None
+        for doc in self.db.states.find({'job': self.id}).sort('time'):
+            if 'data' in doc:
+                state = doc['data']
+            else:
+                applyStateDelta(state, doc['delta'])
+            yield doc['time'], state
+
+
     def save(self):
         "Saves progress and statistics to server."
         if self.progress is not None:
@@ -417,6 +641,14 @@ class SimulationJob(object):
         self._updateFullStats()
         
         
+    def saveDetectors(self, data):
+        """Saves counts of loop detectors. They are stored next to throughput,
+        but are optional, so they don't affect progress of job."""
+        spec = {'_id': self.id}
+        sdoc = {'$set': { SimulationJob.DETECTORS_FIELD_NAME: data } }
+        self.db.statistics.update(spec, sdoc)
+        
+        
     def _updateFullStats(self):
         # self.progress my be out of date, so get new.
         spec = {'_id': self.id}
@@ -427,6 +659,8 @@ class SimulationJob(object):
             
             pdoc = {'$set': {SimulationJob.FULL_STATISTICS_FIELD_NAME: True}}
             self.db.progresses.update(spec, pdoc)
+            if self.ensemble is not None:
+                self.project.getEnsemble(self.ensemble).update()
 
             
     def round(self, value):
@@ -441,6 +675,8 @@ class SimulationJob(object):
 
     @property
     def currentFullState(self):
+        """Checkpoint of job: dictionary or binary string of compact
+        checkpoint, see :meth:`kts46.model.Model.Model.load`."""
         doc = self.db.fullStates.find_one({'_id': self.id})
         if doc is not None:
             return doc['data']
@@ -449,8 +685,23 @@ class SimulationJob(object):
 
     @currentFullState.setter
     def currentFullState(self, value):
-        doc = {'data': value, '_id': self.id}
+        # Compact checkpoint isn't a valid UTF-8 string.
+        if isinstance(value, str):
+            value = bson.binary.Binary(value)
+        doc = {'data': value, '_id': self.id, 'checkpointId': str(uuid.uuid4())}
         self.db.fullStates.save(doc)
+
+    @property
+    def checkpointId(self):
+        """Unique id of the current checkpoint of job. It changes each time
+        checkpoint is saved, so worker can check whether it still has the state
+        of job in memory without loading checkpoint. None if job has no
+        checkpoint or it has been saved without id."""
+        doc = self.db.fullStates.find_one({'_id': self.id}, fields=['checkpointId'])
+        if doc is not None:
+            return doc.get('checkpointId')
+        else:
+            return None
         
     def saveSimulationProgress(self, stepsDone):
         spec = {'_id': self.id}
@@ -458,10 +709,113 @@ class SimulationJob(object):
         self.db.progresses.update(spec, doc, safe=True)
 
 
+class SimulationEnsemble(object):
+    """Ensemble of replicas of the same job. Replicas are ordinary jobs named
+    ``<ensemble>.<number>`` which use the same seed and different streams of
+    random numbers. Statistics of replicas are calculated during simulation
+    and are aggregated into means with confidence intervals each time when
+    replica is finished. When intervals are narrow enough ensemble is
+    converged and other replicas are not simulated any more.
+
+    Ensemble is defined by ``ensemble`` section of job definition."""
+
+    # Values that must converge if ``stopOn`` isn't set in definition.
+    DEFAULT_STOP_ON = ['average', 'averageSpeed']
+
+    def __init__(self, project, name, definition=None):
+        """Creates new :class:`SimulationEnsemble` instance.
+
+        :param project: project to which ensemble belongs.
+        :type project: :py:class:`SimulationProject`
+        :param name: name of ensemble.
+        :type name: str
+        :param definition: definition of job with ``ensemble`` section. If it
+         is omitted than ensemble will be loaded from database.
+        :type definition: dict
+        """
+        self.project = project
+        self.db = project.db
+        self.name = name
+        self.id = name
+        self.definition = definition
+        if definition is None:
+            self._load()
+        else:
+            self._create()
+
+    @staticmethod
+    def getReplicasNames(name, definition):
+        "Returns names of replicas of ensemble."
+        return ['{0}.{1}'.format(name, i)
+                for i in xrange(definition['ensemble']['replicas'])]
+
+    def _create(self):
+        "Creates ensemble and its replicas on the server from definition."
+        seed = self.definition['simulationParameters'].get('seed')
+        if seed is None:
+            # Seed is saved in replicas, so they can be reproduced.
+            seed = random.randint(0, 2 ** 31)
+        self.replicas = SimulationEnsemble.getReplicasNames(self.name, self.definition)
+        for i, replicaName in enumerate(self.replicas):
+            definition = copy.deepcopy(self.definition)
+            del definition['ensemble']
+            simParams = definition['simulationParameters']
+            simParams['seed'] = seed
+            simParams['replica'] = i
+            simParams['onlineStatistics'] = True
+            SimulationJob(self.project, replicaName, definition, self.name)
+        self.converged = False
+        self.statistics = None
+        self.finished = []
+        self.db.ensembles.insert({'_id': self.id, 'definition': self.definition,
+            'replicas': self.replicas, 'finished': self.finished,
+            'converged': self.converged, 'statistics': self.statistics})
+
+    def _load(self):
+        "Loads existing ensemble from the server."
+        doc = self.db.ensembles.find_one(self.id)
+        self.definition = doc['definition']
+        self.replicas = doc['replicas']
+        self.finished = doc['finished']
+        self.converged = doc['converged']
+        self.statistics = doc['statistics']
+
+    def update(self):
+        """Aggregates statistics of finished replicas and checks whether
+        ensemble is converged.
+
+        :returns: whether ensemble is converged.
+        :rtype: bool"""
+        params = self.definition['ensemble']
+        aggregation = EnsembleStatistics(params.get('confidence', 0.95))
+        self.finished = []
+        for replicaName in self.replicas:
+            progress = self.db.progresses.find_one(replicaName)
+            if progress is not None and progress[SimulationJob.FULL_STATISTICS_FIELD_NAME]:
+                aggregation.addReplica(self.db.statistics.find_one(replicaName))
+                self.finished.append(replicaName)
+        if len(self.finished) > 0:
+            self.statistics = aggregation.getResults()
+        self.converged = aggregation.isConverged(
+            params.get('stopOn', SimulationEnsemble.DEFAULT_STOP_ON),
+            params.get('relativeWidth', 0.05), params.get('minReplicas', 3))
+        self.db.ensembles.update({'_id': self.id}, {'$set': {
+            'finished': self.finished, 'converged': self.converged,
+            'statistics': self.statistics}})
+        return self.converged
+
+
 class StateStorage(object):
-    "Represents storage for simulation states."
+    """Represents storage for simulation states.
+
+    States and cars are accumulated in buffers and sent to the server with bulk
+    inserts when buffers become large enough and when storage is closed.
+
+    Storage must be used from one thread: acknowledge of the server covers only
+    writes sent through the connection of the calling thread. States may be
+    added only by the thread that added the first of them."""
 
-    def __init__(self, job, batchLength=None):
+    def __init__(self, job, batchLength=None, maxBufferBytes=None, safe=True):
         """Creates new instance of :class:`StateStorage` class.
 
         :param job: job for which this storage belongs.
@@ -469,15 +823,41 @@ class StateStorage(object):
         :param batchLength: length of batches that to send to the server.
          If None then length from job parameters will be used.
         :type batchLength: int
+        :param maxBufferBytes: approximate size of buffered documents in bytes
+         at which buffer is sent to the server even if it contains less than
+         ``batchLength`` states. If None then only amount of states is used.
+        :type maxBufferBytes: int
+        :param safe: whether to wait for the server to acknowledge each bulk
+         insert. Buffer sent by ``close`` is always acknowledged.
+        :type safe: bool
         """
         self.db = job.db
         self.job = job
-        #self.buffer = []
-        #if batchLength is None:
-        #    self.bufferSize = job.simulationParameters['batchLength']
-        #else:
-        #    self.bufferSize = batchLength
-        
+        self.deltaOutput = job.deltaOutput
+        self.columnsOutput = (job.stateOutput == 'columns')
+        if batchLength is None:
+            self.bufferSize = job.definition['simulationParameters']['batchLength']
+        else:
+            self.bufferSize = batchLength
+        self.maxBufferBytes = maxBufferBytes
+        self.safe = safe
+        self.stateBuffer = []
+        self.carBuffer = []
+        self.trajectoryBuffer = TrajectoryBatch()
+        self.bufferBytes = 0
+        # Whether some inserts haven't been acknowledged by the server yet.
+        self.unsafeWrites = False
+        self.thread = None
+
+    def _checkThread(self):
+        """Raises :class:`StorageException` if storage is used from other thread
+        than the one that added states before."""
+        current = threading.current_thread()
+        if self.thread is None:
+            self.thread = current
+        elif self.thread is not current:
+            raise StorageException("State storage must be used from one thread.")
+
     def repair(self, currentTime):
         """If simulation was aborted in the process some states and cars will be
         left in database. This method will remove them. It is recommended to
@@ -493,6 +873,7 @@ class StateStorage(object):
             logging.getLogger('kts46.stateStorage').info('Reparing from time: %g', currentTime)
             self.db.states.remove({'job': self.job.id, 'time': {cmp: currentTime}}, safe=True)
             self.db.cars.remove({'job': self.job.id, 'time': {cmp: currentTime}}, safe=True)
+            self.db.trajectories.remove({'job': self.job.id, 'start': {cmp: currentTime}}, safe=True)
         else:
             logging.getLogger('kts46.stateStorage').debug('Nothing to repair.')
 
@@ -510,6 +891,22 @@ class StateStorage(object):
         d['_id'] = self.job.getStateDocumentId(str(time))
         d['data'] = data
 
+        if self.deltaOutput:
+            # This is a keyframe. Cars are stored in the state document
+            # so states of job can be reconstructed from one collection.
+            del data['enterQueue']
+            self._addToBuffer(d, [])
+            return
+
+        if self.columnsOutput:
+            self.trajectoryBuffer.addState(time, data['cars'])
+            if self.maxBufferBytes is not None:
+                self.bufferBytes += TrajectoryBatch.ROW_SIZE * len(data['cars'])
+            del data['cars']
+            del data['enterQueue']
+            self._addToBuffer(d, [])
+            return
+
         cars = []
         for carId, car in data['cars'].items():
             car['_id'] = "{0};{1}".format(d['_id'], carId)
@@ -519,20 +916,182 @@ class StateStorage(object):
             cars.append(car)
         del data['cars']
         del data['enterQueue'] # Isn't used now but generates a lot of traffic. Must be stored in separate collection, as `cars`.
-        
-        self.db.states.insert(d, safe=True)
-        # Mongodb raises error on attempt to insert empty list of docs.
-        if len(cars) > 0:
-            self.db.cars.insert(cars, safe=True)
+        self._addToBuffer(d, cars)
 
 
-    def dump(self):
+    def addDelta(self, time, delta):
+        """Adds changes of state since previous state to the storage. Used for
+        jobs with delta output.
+
+        :param time: time of state.
+        :type time: float
+        :param delta: changes of model state returned by ``Model.getStateDelta``.
+        :type delta: dict
+        """
+        del delta['enterQueue'] # Enter queue isn't stored, like in ``add``.
+        d = {'time': time, 'job': self.job.id,
+             '_id': self.job.getStateDocumentId(str(time)), 'delta': delta}
+        self._addToBuffer(d, [])
+
+
+    def _addToBuffer(self, state, cars):
+        """Adds state document and documents of its cars to buffers and dumps
+        buffers if they are full."""
+        self._checkThread()
+        self.stateBuffer.append(state)
+        self.carBuffer.extend(cars)
+        if self.maxBufferBytes is not None:
+            # Cars documents have the same fields, so size of one of them is
+            # enough to estimate size of all.
+            self.bufferBytes += len(bson.BSON.encode(state))
+            if len(cars) > 0:
+                self.bufferBytes += len(bson.BSON.encode(cars[0])) * len(cars)
+        if (len(self.stateBuffer) >= self.bufferSize or
+                (self.maxBufferBytes is not None and
+                 self.bufferBytes >= self.maxBufferBytes)):
+            self.dump()
+
+
+    def dump(self, safe=None):
         """Dump states saved in a buffers to server. This method is called by
-        ``add`` when length of buffer is more than batchLength and by
-        ``close`` method. Currently unused and unimplemented."""
-        pass
+        ``add`` when buffer is full and by ``close`` method.
+
+        :param safe: whether to wait for acknowledge from the server. If None
+         then value specified in constructor is used.
+        :type safe: bool"""
+        if safe is None:
+            safe = self.safe
+        self._checkThread()
+        # Mongodb raises error on attempt to insert empty list of docs.
+        if len(self.stateBuffer) > 0:
+            self.db.states.insert(self.stateBuffer, safe=safe)
+        if len(self.carBuffer) > 0:
+            self.db.cars.insert(self.carBuffer, safe=safe)
+        if len(self.trajectoryBuffer.times) > 0:
+            doc = self.trajectoryBuffer.toDocument()
+            doc['_id'] = self.job.getStateDocumentId(str(doc['start']))
+            doc['job'] = self.job.id
+            doc['columns'] = dict((name, bson.Binary(column))
+                                  for name, column in doc['columns'].iteritems())
+            doc['carRows'] = dict((carId, bson.Binary(rows))
+                                  for carId, rows in doc['carRows'].iteritems())
+            self.db.trajectories.insert(doc, safe=safe)
+        self.stateBuffer = []
+        self.carBuffer = []
+        self.trajectoryBuffer = TrajectoryBatch()
+        self.bufferBytes = 0
+        # Writes of the one connection are applied in order, so acknowledged
+        # insert confirms all previous ones.
+        self.unsafeWrites = not safe
+
+
+    def abort(self):
+        "Drops unsaved data. Used when simulation has failed."
+        self.stateBuffer = []
+        self.carBuffer = []
+        self.trajectoryBuffer = TrajectoryBatch()
+        self.bufferBytes = 0
+
+
+    def close(self):
+        """Save all unsaved data to server. Last insert is always acknowledged,
+        so after this method returns all states are stored even if storage
+        doesn't wait for acknowledges. Must be called before checkpoint of job
+        is saved and from the same thread that added states."""
+        if len(self.stateBuffer) > 0:
+            self.dump(safe=True)
+        elif self.unsafeWrites:
+            self._checkThread()
+            result = self.db.command('getlasterror')
+            self.unsafeWrites = False
+            if result.get('err') is not None:
+                raise StorageException("Failed to save states: {0}.".format(result['err']))
+
+
+class BackgroundStateStorage(object):
+    """Wraps state storage so states are saved by a separate writer thread and
+    simulation continues while previous states are sent to the server. States
+    are passed to the thread through a bounded queue: when it is full ``add``
+    waits until writer catches up. If writer fails then exception is raised
+    by the next call of ``add``, ``addDelta`` or ``close``. Wrapped storage
+    is closed by the writer thread too, so acknowledge of the server covers
+    the connection through which states were sent."""
+
+    def __init__(self, storage, queueLength=100):
+        """Creates new instance and starts writer thread.
+
+        :param storage: storage that will save states, like :class:`StateStorage`.
+        :param queueLength: maximum amount of states waiting to be saved.
+        :type queueLength: int
+        """
+        self.storage = storage
+        self.queue = Queue.Queue(queueLength)
+        self.error = None
+        self.aborted = False
+        self.thread = threading.Thread(target=self._write)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _write(self):
+        "Implementation of writer thread."
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            method, time, data = item
+            # After failure or abort states are dropped so producer doesn't block.
+            if self.error is None and not self.aborted:
+                try:
+                    if method == 'close':
+                        self.storage.close()
+                    else:
+                        getattr(self.storage, method)(time, data)
+                except Exception:
+                    logging.getLogger('kts46.stateStorage').exception('Failed to save state.')
+                    self.error = sys.exc_info()
+            if method == 'close':
+                break
+
+    def _raiseError(self):
+        "Raises exception of writer thread in the calling thread."
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+
+    def repair(self, currentTime):
+        "Same as :meth:`StateStorage.repair`. Must be called before states are added."
+        self.storage.repair(currentTime)
+
+    def add(self, time, data):
+        "Same as :meth:`StateStorage.add`, but returns before state is saved."
+        self._raiseError()
+        self.queue.put(('add', time, data))
 
+    def addDelta(self, time, delta):
+        "Same as :meth:`StateStorage.addDelta`, but returns before delta is saved."
+        self._raiseError()
+        self.queue.put(('addDelta', time, delta))
 
     def close(self):
-        "Save all unsaved data to server. Currently unused."
-        pass
+        """Waits until all states are saved, closes wrapped storage and stops
+        writer thread. After this method returns all added states are stored,
+        so checkpoint of job can be saved."""
+        self.queue.put(('close', None, None))
+        self.thread.join()
+        self._raiseError()
+
+    def abort(self):
+        """Stops writer thread without saving states that are still in the
+        queue and doesn't wait for them. Only state that is being saved at the
+        moment is finished. Used when simulation has failed."""
+        self.aborted = True
+        if self.thread.is_alive():
+            # Queue is emptied so sentinel is put without waiting. Writer
+            # finishes state that it is saving now and skips the rest.
+            try:
+                while True:
+                    self.queue.get_nowait()
+            except Queue.Empty:
+                pass
+            self.queue.put_nowait(None)
+            self.thread.join()
+        self.storage.abort()
@@ -0,0 +1,124 @@
+# Copyright 2010-2011 Anthony Kolesov
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from bisect import bisect_left, bisect_right
+import math
+
+
+class OutputPolicy(object):
+    """Defines states of job that are saved. States are identified by numbers
+    of steps: state after step ``n`` has time ``n * stepDuration`` and state
+    number 0 is the initial state. Policy is defined by ``outputPolicy``
+    simulation parameter:
+
+    * ``all`` -- state of each step (default);
+    * ``every`` -- state of each ``outputEvery`` step;
+    * ``times`` -- states nearest to times listed in ``outputTimes``;
+    * ``none`` -- states aren't saved, only checkpoint of job.
+
+    ``saveTrajectories: false`` is the same as ``none`` policy."""
+
+    ALL = 'all'
+    EVERY = 'every'
+    TIMES = 'times'
+    NONE = 'none'
+
+    def __init__(self, simParams):
+        """Creates policy of job.
+
+        :param simParams: simulation parameters of job.
+        :type simParams: dict
+        :raises ValueError: if policy is unknown or its parameters are invalid."""
+        self.stepDuration = simParams['stepDuration']
+        self.policy = simParams.get('outputPolicy', OutputPolicy.ALL)
+        if not simParams.get('saveTrajectories', True):
+            self.policy = OutputPolicy.NONE
+        if self.policy not in (OutputPolicy.ALL, OutputPolicy.EVERY,
+                               OutputPolicy.TIMES, OutputPolicy.NONE):
+            raise ValueError("Unknown output policy: {0}.".format(self.policy))
+        self.every = 1
+        self._steps = []
+        if self.policy == OutputPolicy.EVERY:
+            self.every = int(simParams.get('outputEvery', 1))
+            if self.every < 1:
+                raise ValueError("outputEvery must be positive: {0}.".format(self.every))
+        elif self.policy == OutputPolicy.TIMES:
+            self._steps = sorted(set(self.getStep(time)
+                                     for time in simParams.get('outputTimes', [])))
+
+    def getStep(self, time):
+        "Returns number of step of state with specified time in seconds."
+        return int(round(time / self.stepDuration))
+
+    def getTime(self, step):
+        "Returns time of state after specified step, like times of saved states."
+        return round(step * self.stepDuration, 3)
+
+    @property
+    def isSparse(self):
+        """Whether some states aren't saved. Statistics can't be calculated
+        from states of such jobs, they are calculated during simulation."""
+        return self.policy != OutputPolicy.ALL and not (
+            self.policy == OutputPolicy.EVERY and self.every == 1)
+
+    def isOutputStep(self, step):
+        """Checks whether state after specified step is saved.
+
+        :param step: number of step.
+        :type step: int
+        :rtype: bool"""
+        if self.policy == OutputPolicy.ALL:
+            return True
+        elif self.policy == OutputPolicy.EVERY:
+            return step % self.every == 0
+        elif self.policy == OutputPolicy.TIMES:
+            i = bisect_left(self._steps, step)
+            return i < len(self._steps) and self._steps[i] == step
+        return False
+
+    def getOutputIndex(self, step):
+        """Returns number of saved state among all saved states of job. Step
+        must be an output step. Used to choose keyframes of delta output."""
+        if self.policy == OutputPolicy.EVERY:
+            return step // self.every
+        elif self.policy == OutputPolicy.TIMES:
+            return bisect_left(self._steps, step)
+        return step
+
+    def getOutputSteps(self, first, last):
+        """Returns numbers of steps from ``first`` to ``last`` inclusive which
+        states are saved.
+
+        :rtype: list of int"""
+        if self.policy == OutputPolicy.ALL:
+            return range(first, last + 1)
+        elif self.policy == OutputPolicy.EVERY:
+            start = int(math.ceil(float(first) / self.every)) * self.every
+            return range(start, last + 1, self.every)
+        elif self.policy == OutputPolicy.TIMES:
+            return self._steps[bisect_left(self._steps, first):bisect_right(self._steps, last)]
+        return []
+
+    def getDescriptionData(self):
+        """Returns description of saved states that is stored with progress of
+        job: policy and interval between states in seconds or list of times
+        of states.
+
+        :rtype: dict"""
+        d = {'policy': self.policy}
+        if self.policy in (OutputPolicy.ALL, OutputPolicy.EVERY):
+            d['interval'] = self.getTime(self.every)
+        elif self.policy == OutputPolicy.TIMES:
+            d['times'] = [self.getTime(step) for step in self._steps]
+        return d
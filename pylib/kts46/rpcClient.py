@@ -44,4 +44,7 @@ def getJsonRpcClient(cfg):
     port = cfg.getint('JSON-RPC Server', 'port')
     path = cfg.get('JSON-RPC Server', 'path')
     connString = 'http://{host}:{port}{path}'.format(host=host, port=port, path=path)
-    return jsonRpcClient.Client(connString)
+    timeout = None
+    if cfg.has_option('JSON-RPC Server', 'timeout'):
+        timeout = cfg.getfloat('JSON-RPC Server', 'timeout')
+    return jsonRpcClient.Client(connString, timeout=timeout)
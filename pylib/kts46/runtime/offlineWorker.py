@@ -14,11 +14,15 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import atexit
+import copy
 import csv
 import glob
+import itertools
+import math
+import multiprocessing
 import os
 import os.path
+import shutil
 import sys
 import tarfile
 import tempfile
@@ -30,7 +34,9 @@ from optparse import OptionParser
 #PROJECT_LIB_PATH = '../../'
 #if PROJECT_LIB_PATH not in sys.path:
 #    sys.path.append(PROJECT_LIB_PATH)
+from kts46.outputPolicy import OutputPolicy
 from kts46.simulationServer import SimulationServer
+from kts46.model.Model import applyStateDelta
 
 
 def configureCmdOptions():
@@ -46,6 +52,15 @@ def configureCmdOptions():
     cmdOpts.add_option('-o', '--out', action='store', dest='output',
         default='./',
         help="Directory to place output files. By default this is current working directory." )
+    cmdOpts.add_option('--sweep', action='store_true', dest='sweep',
+        default=False,
+        help="Sweep mode: inputs may be directories with YAML files and definitions with sweep section. Runs are simulated in parallel until the end." )
+    cmdOpts.add_option('-j', '--processes', action='store', type='int',
+        dest='processes', default=0,
+        help="Amount of processes in sweep mode. By default this is amount of CPUs." )
+    cmdOpts.add_option('--summary-file', action='store', dest='summaryFile',
+        default='summary.csv',
+        help="Output file for summary of sweep." )
 
     return cmdOpts.parse_args(sys.argv[1:])
 
@@ -53,21 +68,55 @@ def configureCmdOptions():
 class OfflineJob(object):
 
     def __init__(self, definition):
-        self.currentFullState = None
+        self._currentFullState = None
+        # Changes each time checkpoint is saved.
+        self.checkpointId = None
         self.definition = definition
         self.progress = {}
+        # Statistics calculated during simulation.
+        self.statistics = {}
+
+    @property
+    def currentFullState(self):
+        return self._currentFullState
+
+    @currentFullState.setter
+    def currentFullState(self, value):
+        self._currentFullState = value
+        self.checkpointId = 0 if self.checkpointId is None else self.checkpointId + 1
 
     def saveSimulationProgress(self, stepsDone):
-        pass
+        self.progress['done'] += stepsDone
+
+    def saveBasicStats(self, average, stdeviation, averageSpeed):
+        self.statistics['average'] = self.round(average)
+        self.statistics['stdeviation'] = self.round(stdeviation)
+        self.statistics['averageSpeed'] = self.round(averageSpeed)
+
+    def saveIdleTimes(self, data):
+        self.statistics['idleTimes'] = data
+
+    def saveThroughput(self, data):
+        self.statistics['throughput'] = data
+
+    def saveDetectors(self, data):
+        self.statistics['detectors'] = data
+
+    def round(self, value):
+        return round(value, 6)
 
 class CSVStateStorage(object):
 
-    def __init__(self, statesFile, carsFile, totalSteps):
+    def __init__(self, statesFile, carsFile, totalSteps, progressFilePath="done.txt"):
         self.totalSteps = totalSteps
+        self.progressFilePath = progressFilePath
         self.stepsDone = 0
         self.statesWriter = csv.writer(statesFile, quoting=csv.QUOTE_MINIMAL)
         self.carsWriter = csv.writer(carsFile, quoting=csv.QUOTE_MINIMAL)
 
+        # Last full state, used to apply deltas in delta output mode.
+        self.lastState = None
+
         self.statesWriter.writerow( ["Time", "TimeAsTD",
             "Last car generation time", "Last car id"] )
         self.carsWriter.writerow(["Time", "Car id", "Desired speed",
@@ -75,6 +124,7 @@ class CSVStateStorage(object):
 
 
     def add(self, time, data):
+        self.lastState = data
 
         # time as seconds, time as dt, lastCarGenerationTime
         state = [
@@ -100,63 +150,183 @@ class CSVStateStorage(object):
 
         self.stepsDone += 1
         if (self.stepsDone % 100 == 0) or (self.stepsDone == self.totalSteps):
-            with open("done.txt", "w") as f:
+            with open(self.progressFilePath, "w") as f:
                 f.write( str(float(self.stepsDone) / self.totalSteps) )
 
+    def addDelta(self, time, delta):
+        # CSV files are always written with full states.
+        applyStateDelta(self.lastState, delta)
+        self.add(time, self.lastState)
+
     def close(self):
         pass
 
+    def abort(self):
+        pass
+
     def repair(self, currentTime):
         pass
 
 
-cfg = SafeConfigParser()
-options, inputFilePaths = configureCmdOptions()
-
-# Configure output directory.
-if os.path.exists(options.output):
-    if not os.path.isdir(options.output):
-        raise Exception("Specified output directory isn't a directory at all.")
-else:
-    # Recursive creation: make all intermediate directories.
-    os.makedirs(options.output)
-
-# Temp data
-tempDir = tempfile.mkdtemp(prefix='kts46-')
-statesFilePath = os.path.join(tempDir, options.statesFile)
-carsFilePath = os.path.join(tempDir, options.carsFile)
-
-# Remove temp directory
-atexit.register(lambda dir: os.rmdir(dir), tempDir)
-
-for inputFilePath in inputFilePaths:
-    # Get model definition
-    with open(inputFilePath) as f:
-        definition = yaml.load(f.read())
-
-    # Simulate
-    ss = SimulationServer(cfg)
-    statesFile = open(statesFilePath, "wb")
-    carsFile = open(carsFilePath, "wb")
-    storage = CSVStateStorage(statesFile, carsFile, definition['simulationParameters']['batchLength'])
-    job = OfflineJob(definition)
-    ss.runSimulationJob(job, storage)
-
-    # Close files for writing and reopen for reading.
-    statesFile.close(), carsFile.close()
-    #statesFile = open(statesFilePath, "rb")
-    #carsFile = open(carsFilePath, "rb")
-
-    # Compress
-    tarName = os.path.splitext(os.path.split(inputFilePath)[1])[0]
-    outpath = os.path.join(options.output, tarName + ".tar.bz2")
-    tar = tarfile.open(outpath, "w:bz2")
-    #tar.addfile(tar.gettarinfo(fileobj=statesFile), statesFile)
-    #tar.addfile(tar.gettarinfo(fileobj=carsFile), carsFile)
-    tar.add(statesFilePath, arcname=tarName+'/'+os.path.basename(statesFilePath))
-    tar.add(carsFilePath, arcname=tarName+'/'+os.path.basename(carsFilePath))
-
-    # Cleanup
-    tar.close()
-    #statesFile.close(), carsFile.close()
-    os.remove(statesFilePath), os.remove(carsFilePath)
+def getSweepValues(values):
+    """Returns list of values of swept parameter. Values may be specified as a
+    list or as a range: dictionary with ``from``, ``to`` and ``step``. End of
+    range is included."""
+    if not isinstance(values, dict):
+        return list(values)
+    result = []
+    i = 0
+    value = values['from']
+    while value <= values['to'] + values['step'] * 1e-9:
+        result.append(value)
+        i += 1
+        value = values['from'] + values['step'] * i
+    return result
+
+
+def expandSweep(name, definition):
+    """Expands definition with ``sweep`` section into definitions of runs for
+    all combinations of parameters values. Keys of sweep section are paths of
+    parameters in definition separated by dots, like
+    ``modelParameters.inputRate``.
+
+    :returns: list of tuples (run name, definition, parameters values).
+    :rtype: list"""
+    sweep = definition.pop('sweep', None)
+    if not sweep:
+        return [(name, definition, {})]
+    paths = sorted(sweep.keys())
+    runs = []
+    for number, values in enumerate(itertools.product(*[getSweepValues(sweep[path]) for path in paths])):
+        runDefinition = copy.deepcopy(definition)
+        for path, value in zip(paths, values):
+            keys = path.split('.')
+            section = runDefinition
+            for key in keys[:-1]:
+                section = section.setdefault(key, {})
+            section[keys[-1]] = value
+        runs.append(('{0}_{1}'.format(name, number + 1), runDefinition,
+                     dict(zip(paths, values))))
+    return runs
+
+
+def getRuns(inputPaths):
+    """Returns runs for input files. Directories are replaced with YAML files
+    they contain, definitions with sweep section are expanded."""
+    files = []
+    for inputPath in inputPaths:
+        if os.path.isdir(inputPath):
+            files.extend(sorted(glob.glob(os.path.join(inputPath, '*.yaml'))))
+        else:
+            files.append(inputPath)
+    runs = []
+    for inputFilePath in files:
+        with open(inputFilePath) as f:
+            definition = yaml.load(f.read())
+        name = os.path.splitext(os.path.split(inputFilePath)[1])[0]
+        runs.extend(expandSweep(name, definition))
+    return runs
+
+
+def runJob(run):
+    """Simulates one run and saves its results to archive in output directory.
+    Each run uses its own temporary directory, so runs may be done in parallel.
+
+    :param run: tuple (run name, definition, parameters values, options).
+    :returns: tuple (run name, parameters values, statistics)."""
+    tarName, definition, parameters, options = run
+    tempDir = tempfile.mkdtemp(prefix='kts46-')
+    try:
+        statesFilePath = os.path.join(tempDir, options.statesFile)
+        carsFilePath = os.path.join(tempDir, options.carsFile)
+        simParams = definition['simulationParameters']
+        if options.sweep:
+            # Summary requires statistics, so they are calculated during simulation.
+            simParams['onlineStatistics'] = True
+            totalSteps = int(math.ceil(simParams['duration'] / simParams['stepDuration']))
+        else:
+            totalSteps = simParams['batchLength']
+        policy = OutputPolicy(simParams)
+        if policy.isSparse:
+            # Statistics can't be calculated from saved states.
+            simParams['onlineStatistics'] = True
+        # Progress is counted by saved states.
+        totalOutputs = len(policy.getOutputSteps(0, totalSteps))
+
+        # Simulate
+        # Batches of sweep are simulated with the same model.
+        ss = SimulationServer(SafeConfigParser(), keepModel=True)
+        statesFile = open(statesFilePath, "wb")
+        carsFile = open(carsFilePath, "wb")
+        progressFilePath = os.path.join(tempDir, "done.txt") if options.sweep else "done.txt"
+        storage = CSVStateStorage(statesFile, carsFile, totalOutputs, progressFilePath)
+        job = OfflineJob(definition)
+        # In sweep mode the whole duration is simulated, otherwise one batch.
+        try:
+            ss.runSimulationJob(job, storage)
+            while options.sweep and job.progress['done'] < totalSteps:
+                ss.runSimulationJob(job, storage)
+        finally:
+            ss.close()
+
+        # Close files for writing.
+        statesFile.close(), carsFile.close()
+
+        # Compress
+        outpath = os.path.join(options.output, tarName + ".tar.bz2")
+        tar = tarfile.open(outpath, "w:bz2")
+        tar.add(statesFilePath, arcname=tarName+'/'+os.path.basename(statesFilePath))
+        tar.add(carsFilePath, arcname=tarName+'/'+os.path.basename(carsFilePath))
+        if len(job.statistics) > 0:
+            statisticsFilePath = os.path.join(tempDir, 'statistics.yaml')
+            with open(statisticsFilePath, 'w') as f:
+                yaml.safe_dump(job.statistics, f)
+            tar.add(statisticsFilePath, arcname=tarName+'/statistics.yaml')
+        tar.close()
+    finally:
+        shutil.rmtree(tempDir)
+    return tarName, parameters, job.statistics
+
+
+def writeSummary(path, results):
+    "Writes CSV file with basic statistics of runs."
+    parameters = sorted(set(key for name, values, statistics in results for key in values))
+    with open(path, "wb") as f:
+        writer = csv.writer(f, quoting=csv.QUOTE_MINIMAL)
+        writer.writerow(["Run"] + parameters + ["Average travel time",
+            "Standard deviation", "Average speed", "Average idle time"])
+        for name, values, statistics in results:
+            row = [name] + [values.get(key, '') for key in parameters]
+            row.append(statistics.get('average', ''))
+            row.append(statistics.get('stdeviation', ''))
+            row.append(statistics.get('averageSpeed', ''))
+            row.append(statistics.get('idleTimes', {}).get('average', ''))
+            writer.writerow(row)
+
+
+if __name__ == '__main__':
+    options, inputFilePaths = configureCmdOptions()
+
+    # Configure output directory.
+    if os.path.exists(options.output):
+        if not os.path.isdir(options.output):
+            raise Exception("Specified output directory isn't a directory at all.")
+    else:
+        # Recursive creation: make all intermediate directories.
+        os.makedirs(options.output)
+
+    if options.sweep:
+        runs = [run + (options,) for run in getRuns(inputFilePaths)]
+        processes = options.processes if options.processes > 0 else multiprocessing.cpu_count()
+        pool = multiprocessing.Pool(processes)
+        results = pool.map(runJob, runs, 1)
+        pool.close()
+        pool.join()
+        writeSummary(os.path.join(options.output, options.summaryFile), results)
+    else:
+        for inputFilePath in inputFilePaths:
+            # Get model definition
+            with open(inputFilePath) as f:
+                definition = yaml.load(f.read())
+            tarName = os.path.splitext(os.path.split(inputFilePath)[1])[0]
+            runJob((tarName, definition, {}, options))
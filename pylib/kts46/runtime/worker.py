@@ -22,7 +22,7 @@ from ConfigParser import SafeConfigParser
 from optparse import OptionParser
 # Project imports
 import kts46.utils
-from kts46.server.worker import Worker
+from kts46.server.worker import Worker, WorkerPool
 
 
 def configureCmdOptions():
@@ -35,6 +35,9 @@ def configureCmdOptions():
                        help="Configuration file that will override default.ini and local.ini." )
     cmdOpts.add_option('-q', '--quite', action='store_true', dest='quite',
                        help='Suppress all output to console.')
+    cmdOpts.add_option('-p', '--processes', action='store', type='int',
+                       dest='processes', default=None,
+                       help='Amount of worker processes. 0 means amount of CPUs.')
 
     return cmdOpts.parse_args(sys.argv[1:])
 
@@ -58,5 +61,11 @@ if __name__ == '__main__':
         import psyco
         psyco.full()
 
-    worker = Worker(cfg, options.wid)
+    processes = options.processes
+    if processes is None:
+        processes = cfg.getint('worker', 'processes')
+    if processes == 1:
+        worker = Worker(cfg, options.wid)
+    else:
+        worker = WorkerPool(cfg, options.wid, processes)
     worker.run()
@@ -19,6 +19,7 @@ import logging
 import os.path
 import re
 import urllib
+import xmlrpclib
 from socket import error as SocketException
 import gviz_api
 import kts46.rpcClient
@@ -205,85 +206,126 @@ class JSONApiRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
 
 
     def sendRPCResponse(self, result, id, error, httpcode=200):
+        self._sendResponse({'result':result, 'id':id, 'error': error}, httpcode)
+
+
+    def exceptBadRequest(self, msg, id=None):
+        self.sendRPCResponse(None, id, msg, 400)
+
+
+    def _sendResponse(self, body, httpcode=200):
+        "Sends response object or list of them."
         self.send_response(httpcode)
         self.send_header('Content-Type', JSON_CONTENT_TYPE)
         self.end_headers()
-        self.wfile.write(json.dumps({'result':result, 'id':id, 'error': error}))
+        self.wfile.write(json.dumps(body))
 
 
-    def exceptBadRequest(self, msg, id=None):
-        self.sendRPCResponse(None, id, msg, 400)
+    def _getResponse(self, result, id, error, httpcode=200):
+        "Returns response object of call and HTTP code."
+        return {'result':result, 'id':id, 'error': error}, httpcode
+
 
-    def checkJSONArgsNumber(self, params, amount):
+    def checkJSONArgsNumber(self, params, amount, id=None):
         if len(params) != amount:
-            self.exceptBadRequest("""Provided number of parameters is invalid.
-Required number of params: {0}, but has: {1}.""".format(amount, len(params)), id)
-            return False
-        return True
+            return self._getResponse(None, id, """Provided number of parameters is invalid.
+Required number of params: {0}, but has: {1}.""".format(amount, len(params)), 400)
+        return None
 
     def handleCall(self):
         # JSON RPC request must be in one line o
-        request = json.loads(self.rfile.readline())
+        try:
+            request = json.loads(self.rfile.readline())
+        except ValueError as err:
+            self.exceptBadRequest(err.message)
+            return
+
+        # Batch request is an array of calls. Response is an array of
+        # responses to them in the same order.
+        if isinstance(request, list):
+            if len(request) == 0:
+                self.exceptBadRequest("Batch request must not be empty.")
+                return
+            self._sendResponse([self.getCallResponse(call)[0] for call in request])
+        else:
+            self._sendResponse(*self.getCallResponse(request))
+
+    def getCallResponse(self, request):
+        """Performs one call of request.
+
+        :param request: JSON-RPC request object.
+        :returns: response object and HTTP code.
+        :rtype: (dict, int)"""
+        if not isinstance(request, dict):
+            return self._getResponse(None, None, "Request must be an object.", 400)
 
         if "id" not in request:
-            self.exceptBadRequest("""`id` field is missing from JSON RPC request body.
-It must be `null` if you want to send notification.""")
-            return
+            return self._getResponse(None, None, """`id` field is missing from JSON RPC request body.
+It must be `null` if you want to send notification.""", 400)
 
         id = request['id']
 
         if "method" not in request:
-            self.exceptBadRequest("`method` field is missing from JSON RPC request body.", id)
-            return
+            return self._getResponse(None, id, "`method` field is missing from JSON RPC request body.", 400)
         if "params" not in request:
-            self.exceptBadRequest("""`params` field is missing from JSON RPC request body.
-It must be an empty array if method has no params.""", id)
-            return
+            return self._getResponse(None, id, """`params` field is missing from JSON RPC request body.
+It must be an empty array if method has no params.""", 400)
 
         methodName = request['method']
         params = request['params']
 
         if not isinstance(params, type( [] )):
-            self.exceptBadRequest("`params` fields must be an array.", id)
-            return
+            return self._getResponse(None, id, "`params` fields must be an array.", 400)
 
         xmlrpc = self.server.rpc_server
         result = "success" # Methods can overwrite this variable.
         try:
             if methodName == "addProject":
-                if not self.checkJSONArgsNumber(params, 1): return
+                test = self.checkJSONArgsNumber(params, 1, id)
+                if test is not None: return test
                 xmlrpc.createProject(params[0])
             elif methodName == "deleteProject":
-                if not self.checkJSONArgsNumber(params, 1): return
+                test = self.checkJSONArgsNumber(params, 1, id)
+                if test is not None: return test
                 xmlrpc.deleteProject(params[0])
             elif methodName == 'addJob':
-                if not self.checkJSONArgsNumber(params, 3): return
+                test = self.checkJSONArgsNumber(params, 3, id)
+                if test is not None: return test
                 xmlrpc.addJob(params[0], params[1], params[2])
             elif methodName == 'deleteJob':
-                if not self.checkJSONArgsNumber(params, 2): return
+                test = self.checkJSONArgsNumber(params, 2, id)
+                if test is not None: return test
                 xmlrpc.deleteJob(params[0], params[1])
+            elif methodName == 'getJobStatistics':
+                test = self.checkJSONArgsNumber(params, 2, id)
+                if test is not None: return test
+                result = xmlrpc.getJobStatistics(params[0], params[1], False)
             elif methodName == 'listJobStatistics':
-                if not self.checkJSONArgsNumber(params, 1): return
+                test = self.checkJSONArgsNumber(params, 1, id)
+                if test is not None: return test
                 result = []
                 for a in params[0]:
                     result.append(xmlrpc.getJobStatistics(a['p'],a['j'], False))
                     result[-1]['project'] = a['p']
                     result[-1]['job'] = a['j']
             elif methodName == 'runJob':
-                if not self.checkJSONArgsNumber(params, 2): return
+                test = self.checkJSONArgsNumber(params, 2, id)
+                if test is not None: return test
                 try:
                     self.server.jsonrpc.addTask(params[0], params[1])
                 except jsonRpcClient.RPCException as ex:
                     self.server.logger.warning("Scheduler returned error: %s.", ex.error['type']);
-                    self.sendRPCResponse(None, id, ex.error)
-                    return
+                    return self._getResponse(None, id, ex.error)
             else:
-                self.sendRPCResponse(None, id, "Unknown method: " + methodName)
-                return
+                return self._getResponse(None, id, "Unknown method: " + methodName)
         except SocketException, msg:
             self.log_error('Error connecting with RPC-server: %s', msg)
             publicMessage = "Couldn't connect to RPC server."
-            self.sendRPCResponse(None, id, publicMessage, 500)
+            return self._getResponse(None, id, publicMessage, 500)
+        except xmlrpclib.Fault as ex:
+            # In batch request other calls are still performed.
+            self.log_error('RPC-server returned error: %s', ex.faultString)
+            return self._getResponse(None, id, ex.faultString, 500)
 
         # If we are here than all was a success.
-        self.sendRPCResponse(result, id, None)
+        return self._getResponse(result, id, None)
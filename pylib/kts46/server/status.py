@@ -17,6 +17,12 @@ import logging
 from kts46.mongodb import Storage
 from kts46.model.Model import Model
 
+
+class JobNotFoundException(KeyError):
+    "Thrown if requested project or job doesn't exist."
+    pass
+
+
 class StatusServer:
     "A server that enables view of simulation status."
 
@@ -69,9 +75,13 @@ class StatusServer:
 
     def getJobStatistics(self, projectName, jobName, includeIdleTimes=False):
         """Returns job statistics dictionary. It is always dictionary and if
-        statistics hasn't been already calculated it fields will be set to None."""
-        project = self.storage[projectName]
-        job = project[jobName]
+        statistics hasn't been already calculated it fields will be set to None.
+
+        :raises JobNotFoundException: if project or job doesn't exist."""
+        try:
+            job = self.storage[projectName][jobName]
+        except KeyError as ex:
+            raise JobNotFoundException(ex.message)
         d = dict(job.statistics)
         # Remove utility fields of databases.
         if '_id' in d: del d['_id']
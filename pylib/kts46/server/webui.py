@@ -23,6 +23,8 @@ import urlparse
 from cStringIO import StringIO
 from socket import error as SocketException
 import kts46.rpcClient
+import jsonRpcClient
+from kts46.server.status import JobNotFoundException
 
 # Add MIME types
 mimetypes.add_type("text/csv", ".csv", True) # True to add to official types.
@@ -241,19 +243,30 @@ class ManagementAPIHandler(object):
 
 
     def sendRPCResponse(self, response, result, id, error, httpcode=200):
-        response(str(httpcode) + ' ' + httplib.responses[httpcode], [
-            ('Content-Type', mimetypes.types_map[".json"]) ])
-        return json.dumps({'result':result, 'id':id, 'error': error})
+        return self._sendResponse(response, self._getResponse(result, id, error, httpcode))
 
 
     def exceptBadRequest(self, response,  msg, id=None):
         return self.sendRPCResponse(response, None, id, msg, httplib.BAD_REQUEST)
 
 
-    def checkJSONArgsNumber(self, response, params, amount):
+    def _sendResponse(self, response, data):
+        "Sends response object or list of them with HTTP code."
+        body, httpcode = data
+        response(str(httpcode) + ' ' + httplib.responses[httpcode], [
+            ('Content-Type', mimetypes.types_map[".json"]) ])
+        return json.dumps(body)
+
+
+    def _getResponse(self, result, id, error, httpcode=200):
+        "Returns response object of call and HTTP code."
+        return {'result':result, 'id':id, 'error': error}, httpcode
+
+
+    def checkJSONArgsNumber(self, params, amount, id=None):
         if len(params) != amount:
             msg = "Provided number of parameters is invalid. Required number of params: {0}, but has: {1}."
-            return self.exceptBadRequest(response, msg.format(amount, len(params)), id)
+            return self._getResponse(None, id, msg.format(amount, len(params)), httplib.BAD_REQUEST)
         return None
 
 
@@ -264,52 +277,77 @@ class ManagementAPIHandler(object):
         except ValueError as err:
             return self.exceptBadRequest(response, err.message)
 
+        # Batch request is an array of calls. Response is an array of
+        # responses to them in the same order.
+        if isinstance(request, list):
+            if len(request) == 0:
+                return self.exceptBadRequest(response, "Batch request must not be empty.")
+            results = [self.handleCall(call)[0] for call in request]
+            return self._sendResponse(response, (results, httplib.OK))
+        return self._sendResponse(response, self.handleCall(request))
+
+
+    def handleCall(self, request):
+        """Performs one call of request.
+
+        :param request: JSON-RPC request object.
+        :returns: response object and HTTP code.
+        :rtype: (dict, int)"""
+        if not isinstance(request, dict):
+            return self._getResponse(None, None, "Request must be an object.",
+                                     httplib.BAD_REQUEST)
+
         if "id" not in request:
-            return self.exceptBadRequest(response,
+            return self._getResponse(None, None,
                 """`id` field is missing from JSON RPC request body.
-It must be `null` if you want to send notification.""")
+It must be `null` if you want to send notification.""", httplib.BAD_REQUEST)
 
         id = request["id"]
 
         if "method" not in request:
-            return self.exceptBadRequest(response,
-                "`method` field is missing from JSON RPC request body.", id)
+            return self._getResponse(None, id,
+                "`method` field is missing from JSON RPC request body.", httplib.BAD_REQUEST)
         if "params" not in request:
-            return self.exceptBadRequest(response,
+            return self._getResponse(None, id,
                 """`params` field is missing from JSON RPC request body.
-It must be an empty array if method has no params.""", id)
+It must be an empty array if method has no params.""", httplib.BAD_REQUEST)
 
         methodName = request['method']
         params = request['params']
 
         if not isinstance(params, type( [] )):
-            return self.exceptBadRequest(response,
-                                        "`params` fields must be an array.", id)
+            return self._getResponse(None, id,
+                                     "`params` fields must be an array.", httplib.BAD_REQUEST)
 
         result = "success" # Methods can overwrite this variable.
         try:
             if methodName == "addProject":
-                test = self.checkJSONArgsNumber(response, params, 1)
+                test = self.checkJSONArgsNumber(params, 1, id)
                 if test is not None:
                     return test
                 self.dbServer.createProject(params[0])
             elif methodName == "deleteProject":
-                test = self.checkJSONArgsNumber(response, params, 1)
+                test = self.checkJSONArgsNumber(params, 1, id)
                 if test is not None:
                     return test
                 self.dbServer.deleteProject(params[0])
             elif methodName == 'addJob':
-                test = self.checkJSONArgsNumber(response, params, 3)
+                test = self.checkJSONArgsNumber(params, 3, id)
                 if test is not None:
                     return test
                 self.dbServer.addJob(params[0], params[1], params[2])
             elif methodName == 'deleteJob':
-                test = self.checkJSONArgsNumber(response, params, 2)
+                test = self.checkJSONArgsNumber(params, 2, id)
                 if test is not None:
                     return test
                 self.dbServer.deleteJob(params[0], params[1])
+            elif methodName == 'getJobStatistics':
+                test = self.checkJSONArgsNumber(params, 2, id)
+                if test is not None:
+                    return test
+                result = self.statusServer.getJobStatistics(params[0], params[1], False)
             elif methodName == 'listJobStatistics':
-                test = self.checkJSONArgsNumber(response, params, 1)
+                test = self.checkJSONArgsNumber(params, 1, id)
                 if test is not None:
                     return test
                 result = []
@@ -318,20 +356,23 @@ It must be an empty array if method has no params.""", id)
                     result[-1]['project'] = a['p']
                     result[-1]['job'] = a['j']
             elif methodName == 'runJob':
-                test = self.checkJSONArgsNumber(response, params, 2)
+                test = self.checkJSONArgsNumber(params, 2, id)
                 if test is not None:
                     return test
                 try:
                     self.jsonrpc.addTask(params[0], params[1])
                 except jsonRpcClient.RPCException as ex:
                     self.logger.warning("Scheduler returned error: %s.", ex.error['type']);
-                    return self.sendRPCResponse(response, None, id, ex.error)
+                    return self._getResponse(None, id, ex.error)
             else:
-                return self.sendRPCResponse(response, None, id, "Unknown method: " + methodName)
+                return self._getResponse(None, id, "Unknown method: " + methodName)
         except SocketException, msg:
-            self.log_error('Error connecting with RPC-server: %s', msg)
+            self.logger.error('Error connecting with RPC-server: %s', msg)
             publicMessage = "Couldn't connect to RPC server."
-            return self.sendRPCResponse(response, None, id, publicMessage, httplib.INTERNAL_SERVER_ERROR)
+            return self._getResponse(None, id, publicMessage, httplib.INTERNAL_SERVER_ERROR)
+        except JobNotFoundException as ex:
+            # In batch request other calls are still performed.
+            return self._getResponse(None, id, str(ex.message), httplib.NOT_FOUND)
 
         # If we are here than all was a success.
-        return self.sendRPCResponse(response, result, id, None)
+        return self._getResponse(result, id, None)
@@ -13,8 +13,13 @@
 # limitations under the License.
 
 import logging
+import multiprocessing
+import Queue
+import signal
+import sys
 import threading
 import time
+import traceback
 import uuid
 import socket
 from socket import error as SocketException
@@ -25,7 +30,7 @@ import kts46.rpcClient
 import jsonRpcClient
 from kts46.simulationServer import SimulationServer
 from kts46.statisticsServer import StatisticsServer
-from kts46.mongodb import Storage, StateStorage
+from kts46.mongodb import Storage, StateStorage, BackgroundStateStorage
 
 def _notificationThreadImplementation(worker):
     while True:
@@ -48,6 +53,33 @@ def _notificationThreadImplementation(worker):
         worker.lastUpdateLock.release()
 
 
+def _taskProcessImplementation(cfg, tasks, results, number):
+    """Entry point of task process started by :class:`WorkerPool`. Executes
+    tasks from ``tasks`` queue and puts tuples (number, statistics, error) into
+    ``results`` queue."""
+    # Pool terminates its processes itself, so they ignore keyboard interrupt
+    # sent to the whole process group. On termination process exits normally,
+    # so its own daemonic processes are terminated too.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, _raiseSystemExit)
+    executor = TaskExecutor(cfg)
+    try:
+        while True:
+            task = tasks.get()
+            try:
+                results.put((number, executor.execute(task), None))
+            except Exception:
+                executor.log.exception('Task %s.%s has failed.', task['project'], task['job'])
+                results.put((number, None, traceback.format_exc()))
+    finally:
+        executor.close()
+
+
+def _raiseSystemExit(signum, frame):
+    "Signal handler that lets ``finally`` blocks run on termination."
+    sys.exit(0)
+
+
 class WorkerException(Exception): pass
 
 class Worker:
@@ -73,12 +105,14 @@ class Worker:
         self.server = kts46.rpcClient.getJsonRpcClient(cfg)
         self.startNotificationThread()
 
-        # Create db storage.
-        self.storage = None
-        #self.storage = Storage(self.cfg.get('mongodb', 'host'))
-
         # Get possible task types.
         self.possibleTypes = map(str.strip, cfg.get("worker", "possibleTasks").split(","))
+        self.checkInterval = cfg.getfloat('worker', 'checkInterval')
+        self.taskWaitTimeout = 0
+        if cfg.has_option('worker', 'taskWaitTimeout'):
+            self.taskWaitTimeout = cfg.getfloat('worker', 'taskWaitTimeout')
+
+        self.executor = TaskExecutor(cfg)
 
     def run(self):
         "Runs a worker loop."
@@ -87,67 +121,36 @@ class Worker:
         while True:
             # Try to get a task.
             try:
-                taskTypes = self.possibleTypes
-                task = self.server.getTask(self.workerId, taskTypes)
+                task = self.getTask()
             except SocketException, msg:
                 self.log.error("Couldn't connect to RPC server. Message: %s", msg)
-                task = {'empty': True}
+                task = None
 
-            # Sleep if there is nothing to do.
+            # Sleep if there is nothing to do. Scheduler has already waited
+            # for a task if it has been asked to.
+            if task is None or (task['empty'] and self.taskWaitTimeout == 0):
+                self.log.debug('Worker has nothing to do. Sleeping for %f s.', self.checkInterval)
+                time.sleep(self.checkInterval) # Wait some time for new job.
+                continue
             if task['empty']:
-                sleepTime = self.cfg.getfloat('worker', 'checkInterval')
-                self.log.debug('Worker has nothing to do. Sleeping for %f s.', sleepTime)
-                time.sleep(sleepTime) # Wait some time for new job.
                 continue
 
             # There is a task.
-            projectName = task['project']
-            jobName = task['job']
             # Report status isn't enabled at this time, so no need to lock.
             self.sig = task['sig']
 
-            # Create storage
-            dbHost = task['databases'][0]['host']
-            dbPort = task['databases'][0]['port']
-            if (self.storage is None or self.storage.host != dbHost or
-                    self.storage.port != dbPort):
-                self.storage = Storage(dbHost, dbPort)
-
             try:
                 self.log.debug("Accepting task")
                 self.sig = self.server.acceptTask(self.workerId, self.sig)['sig']
             except jsonRpcClient.RPCException as ex:
                 self.log.error("Couldn't accept task from server: %s", str(ex))
-                time.sleep(sleepTime) # Wait some time for new job.
+                time.sleep(self.checkInterval) # Wait some time for new job.
                 continue
 
             # interval is provided in milliseconds
             self.notificationSleepTimeout = task['notificationInterval'] / 1000
             self.enableNotificationEvent.set() # Start notifying scheduler about our state.
-            job = self.getJob(projectName, jobName)
-
-            if task['type'] == 'simulation':
-                self.log.info('Starting simulation task: {0}.{1} [{2}/{3}].'.format(
-                    projectName, jobName, job.progress['done'], job.progress['totalSteps']))
-                simServer = SimulationServer(self.cfg)
-                stateStorage = StateStorage(job, self.cfg.getint('worker', 'dbBatchLength'));
-                simServer.runSimulationJob(job, stateStorage)
-            elif task['type'] == 'basicStatistics':
-                self.log.info('Starting basicStatistics task: {0}.{1}.'.format(projectName, jobName))
-                stServer = StatisticsServer(self.cfg)
-                stServer.calculateBasicStats(job)
-            elif task['type'] == 'idleTimes':
-                self.log.info('Starting idleTimes statistics task: {0}.{1}.'.format(projectName, jobName))
-                stServer = StatisticsServer(self.cfg)
-                stServer.calculateIdleTimes(job)
-            elif task['type'] == 'throughput':
-                self.log.info('Starting throughput statistics task: {0}.{1}.'.format(projectName, jobName))
-                stServer = StatisticsServer(self.cfg)
-                stServer.calculateThroughput(job)
-
-            statistics = kts46.utils.getMemoryUsage()
-            statistics['hostName'] = socket.gethostname()
-            statistics['version'] = kts46.__version__
+            statistics = self.executor.execute(task)
 
             # Notify server.
             # Lock here so if condition in sync thread will be correct.
@@ -161,13 +164,26 @@ class Worker:
                     finishedSent = True
                 except SocketException, msg:
                     self.log.error("Connection to RPC server failed. Waiting for it.")
-                    time.sleep(self.cfg.getfloat('worker', 'checkInterval'))
+                    time.sleep(self.checkInterval)
                 except jsonRpcClient.RPCException as ex:
                     self.log.error("Error negotiating with RPC server: %s.", str(ex))
                     finishedSent = True # Couldn't recover from this error.
             self.lastUpdateLock.release()
 
 
+    def getTask(self):
+        """Requests a task from scheduler. If ``taskWaitTimeout`` option is
+        set then scheduler holds request until a task is queued or timeout
+        expires, otherwise it responds at once.
+
+        :returns: task or ``{'empty': True}`` if there is no task.
+        :rtype: dict"""
+        if self.taskWaitTimeout > 0:
+            return self.server.waitTask(self.workerId, self.possibleTypes,
+                                        self.taskWaitTimeout)
+        return self.server.getTask(self.workerId, self.possibleTypes)
+
+
     def startNotificationThread(self):
         "Starts thread to notify scheduler about worker availability and returns Thread object."
         t = threading.Thread(target=_notificationThreadImplementation, kwargs={'worker':self})
@@ -176,6 +192,74 @@ class Worker:
         return t
 
 
+class TaskExecutor(object):
+    """Executes tasks given by scheduler. Connection to database and model of
+    the last simulation task are kept between tasks."""
+
+    def __init__(self, cfg):
+        self.cfg = cfg
+        self.log = logging.getLogger(cfg.get('loggers', 'Worker'))
+        self.storage = None
+
+        # Model of the last simulation task is kept until the next one, so
+        # consecutive batches of the same job don't load it from database.
+        keepModel = (cfg.has_option('worker', 'keepLiveModel') and
+                     cfg.getboolean('worker', 'keepLiveModel'))
+        self.simServer = SimulationServer(cfg, keepModel)
+
+
+    def execute(self, task):
+        """Executes task that has been accepted.
+
+        :param task: task returned by scheduler.
+        :type task: dict
+        :returns: statistics of execution that are sent to scheduler.
+        :rtype: dict"""
+        projectName = task['project']
+        jobName = task['job']
+
+        # Create storage
+        dbHost = task['databases'][0]['host']
+        dbPort = task['databases'][0]['port']
+        if (self.storage is None or self.storage.host != dbHost or
+                self.storage.port != dbPort):
+            self.storage = Storage(dbHost, dbPort)
+        job = self.getJob(projectName, jobName)
+
+        if task['type'] == 'simulation':
+            self.log.info('Starting simulation task: {0}.{1} [{2}/{3}].'.format(
+                projectName, jobName, job.progress['done'], job.progress['totalSteps']))
+            stateStorage = StateStorage(job,
+                self.cfg.getint('worker', 'dbBatchLength'),
+                self.cfg.getint('worker', 'dbBatchBytes'),
+                self.cfg.getboolean('worker', 'dbSafeWrites'))
+            if self.cfg.getboolean('worker', 'backgroundDbWriter'):
+                stateStorage = BackgroundStateStorage(stateStorage,
+                    self.cfg.getint('worker', 'dbWriterQueueLength'))
+            self.simServer.runSimulationJob(job, stateStorage)
+        elif task['type'] == 'basicStatistics':
+            self.log.info('Starting basicStatistics task: {0}.{1}.'.format(projectName, jobName))
+            stServer = StatisticsServer(self.cfg)
+            stServer.calculateBasicStats(job)
+        elif task['type'] == 'idleTimes':
+            self.log.info('Starting idleTimes statistics task: {0}.{1}.'.format(projectName, jobName))
+            stServer = StatisticsServer(self.cfg)
+            stServer.calculateIdleTimes(job)
+        elif task['type'] == 'fullStatistics':
+            self.log.info('Starting fullStatistics task: {0}.{1}.'.format(projectName, jobName))
+            stServer = StatisticsServer(self.cfg)
+            stServer.calculateAllStats(job)
+        elif task['type'] == 'throughput':
+            self.log.info('Starting throughput statistics task: {0}.{1}.'.format(projectName, jobName))
+            stServer = StatisticsServer(self.cfg)
+            stServer.calculateThroughput(job)
+
+        statistics = kts46.utils.getMemoryUsage()
+        statistics['hostName'] = socket.gethostname()
+        statistics['version'] = kts46.__version__
+        return statistics
+
+
     def getJob(self, projectName, jobName):
         if projectName not in self.storage:
             raise WorkerException("Project '{0}' doesn't exist.".format(projectName))
@@ -185,3 +269,200 @@ class Worker:
             msg = "Job with name '{0}' doesn't exist in project '{1}'."
             raise WorkerException(msg.format(jobName, projectName))
         return project[jobName]
+
+
+    def close(self):
+        "Releases model kept after the last simulation task."
+        self.simServer.close()
+
+
+class WorkerPool(object):
+    """Runs several tasks at once in separate processes. Pool has one
+    dispatcher that takes tasks from scheduler, accepts them, notifies
+    scheduler about their progress and reports their end, while processes only
+    execute tasks. Each process has its own connection to database and keeps
+    model of its last simulation task.
+
+    Scheduler gives only one task at a time to a worker id, so task of each
+    process is taken for id made of pool id and number of process. Thus
+    scheduler affinity gives the next batch of a job to the process that
+    keeps its model. Dead processes are restarted."""
+
+    def __init__(self, cfg, workerId=None, processes=0):
+        """Creates new pool.
+
+        :param workerId: id of pool. Ids of processes are made by adding their
+            numbers to it. If None then id is taken from configuration or
+            random UUID is generated, like in :class:`Worker`.
+        :param processes: amount of task processes. If 0 then amount of CPUs
+            is used.
+        :type processes: int"""
+        self.cfg = cfg
+        self.log = logging.getLogger(cfg.get('loggers', 'Worker'))
+
+        if workerId is not None:
+            self.workerId = workerId
+        elif cfg.has_option('worker', 'id'):
+            self.workerId = cfg.get('worker', 'id')
+        else:
+            self.workerId = str(uuid.uuid4())
+
+        self.server = kts46.rpcClient.getJsonRpcClient(cfg)
+        self.possibleTypes = map(str.strip, cfg.get("worker", "possibleTasks").split(","))
+        self.checkInterval = cfg.getfloat('worker', 'checkInterval')
+        self.notificationSleepTimeout = cfg.getint('scheduler', 'notifyInterval')
+
+        if processes == 0:
+            processes = multiprocessing.cpu_count()
+        # Processes, their task queues, and tasks that they execute.
+        self.processes = [None] * processes
+        self.taskQueues = [None] * processes
+        self.tasks = [None] * processes
+        self.results = multiprocessing.Queue()
+        # Guards tasks and their signatures from notification thread.
+        self.lock = threading.Lock()
+
+
+    def getProcessId(self, number):
+        "Returns worker id with which process with specified number takes tasks."
+        return '{0}-{1}'.format(self.workerId, number)
+
+
+    def startProcess(self, number):
+        """Starts task process with specified number. Processes aren't daemonic,
+        so they can start processes themselves, for example, segments of
+        segmented model."""
+        self.taskQueues[number] = multiprocessing.Queue()
+        p = multiprocessing.Process(target=_taskProcessImplementation,
+            args=(self.cfg, self.taskQueues[number], self.results, number),
+            name=self.getProcessId(number))
+        p.start()
+        self.processes[number] = p
+        self.log.info('Started task process %s [pid: %i].', p.name, p.pid)
+
+
+    def run(self):
+        """Runs dispatcher loop. Task processes are terminated when it exits,
+        including termination of pool by signal."""
+        signal.signal(signal.SIGTERM, _raiseSystemExit)
+        try:
+            for number in xrange(len(self.processes)):
+                self.startProcess(number)
+            t = threading.Thread(target=self._notify)
+            t.daemon = True
+            t.start()
+            while True:
+                dispatched = self.dispatchTasks()
+                self.checkProcesses()
+                # Continue to take tasks while scheduler has them.
+                if dispatched and None in self.tasks:
+                    timeout = 0
+                else:
+                    timeout = self.checkInterval
+                self.collectResults(timeout)
+        finally:
+            self.close()
+
+
+    def dispatchTasks(self):
+        """Takes tasks from scheduler for idle processes and passes them to
+        processes. Returns whether any task has been dispatched."""
+        dispatched = False
+        for number, task in enumerate(self.tasks):
+            if task is not None:
+                continue
+            workerId = self.getProcessId(number)
+            try:
+                task = self.server.getTask(workerId, self.possibleTypes)
+                if task['empty']:
+                    break
+                self.log.debug("Accepting task for %s", workerId)
+                task['sig'] = self.server.acceptTask(workerId, task['sig'])['sig']
+            except SocketException, msg:
+                self.log.error("Couldn't connect to RPC server. Message: %s", msg)
+                break
+            except jsonRpcClient.RPCException as ex:
+                self.log.error("Couldn't accept task from server: %s", str(ex))
+                continue
+            # interval is provided in milliseconds
+            self.notificationSleepTimeout = task['notificationInterval'] / 1000
+            with self.lock:
+                self.tasks[number] = task
+            self.taskQueues[number].put(task)
+            dispatched = True
+        return dispatched
+
+
+    def collectResults(self, timeout):
+        """Waits for results of processes no longer than ``timeout`` seconds
+        and reports to scheduler about tasks that are finished."""
+        try:
+            result = self.results.get(timeout=timeout) if timeout > 0 else \
+                     self.results.get_nowait()
+            while True:
+                self.finishTask(*result)
+                result = self.results.get_nowait()
+        except Queue.Empty:
+            pass
+
+
+    def finishTask(self, number, statistics, error):
+        "Notifies scheduler that process has finished its task."
+        with self.lock:
+            task = self.tasks[number]
+            self.tasks[number] = None
+            if error is not None:
+                # Task isn't reported, so supervisor will restart it.
+                self.log.error('Task %s.%s of %s has failed:\n%s', task['project'],
+                               task['job'], self.getProcessId(number), error)
+                return
+            finishedSent = False
+            while not finishedSent:
+                try:
+                    self.server.taskFinished(self.getProcessId(number), task['sig'], statistics)
+                    finishedSent = True
+                except SocketException, msg:
+                    self.log.error("Connection to RPC server failed. Waiting for it.")
+                    time.sleep(self.checkInterval)
+                except jsonRpcClient.RPCException as ex:
+                    self.log.error("Error negotiating with RPC server: %s.", str(ex))
+                    finishedSent = True # Couldn't recover from this error.
+
+
+    def checkProcesses(self):
+        "Restarts processes that have died. Their tasks are left to supervisor."
+        for number, p in enumerate(self.processes):
+            if not p.is_alive():
+                self.log.warning('Task process %s has died with exit code %s.',
+                                 p.name, p.exitcode)
+                with self.lock:
+                    self.tasks[number] = None
+                self.startProcess(number)
+
+
+    def _notify(self):
+        "Implementation of thread that notifies scheduler about running tasks."
+        while True:
+            time.sleep(self.notificationSleepTimeout)
+            with self.lock:
+                for number, task in enumerate(self.tasks):
+                    if task is None:
+                        continue
+                    try:
+                        task['sig'] = self.server.taskInProgress(
+                            self.getProcessId(number), task['sig'])['sig']
+                    except SocketException, msg:
+                        # Continue to work even if connection failed.
+                        self.log.warning("Connection to RPC server failed. Couldn't notify server about task status.")
+                    except jsonRpcClient.RPCException as ex:
+                        self.log.warning("Couldn't notify server about task status: %s", str(ex))
+
+
+    def close(self):
+        "Terminates task processes."
+        for p in self.processes:
+            if p is not None and p.is_alive():
+                p.terminate()
+        for p in self.processes:
+            if p is not None:
+                p.join()
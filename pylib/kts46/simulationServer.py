@@ -14,7 +14,17 @@
 
 
 import logging
+import math
+import kts46.utils
+from kts46.outputPolicy import OutputPolicy
 from kts46.model.Model import Model
+from kts46.model.VectorModel import VectorModel
+from kts46.model.SegmentedModel import SegmentedModel
+
+
+# Model implementations that can be chosen with `engine` simulation parameter.
+MODEL_ENGINES = {'object': Model, 'numpy': VectorModel,
+                 'segmented': SegmentedModel}
 
 
 def timedeltaToSeconds(td):
@@ -24,8 +34,18 @@ def timedeltaToSeconds(td):
 class SimulationServer(object):
     "A server object that does simulation of model."
 
-    def __init__(self, cfg=None):
+    def __init__(self, cfg=None, keepModel=False):
+        """Creates new server.
+
+        :param keepModel: whether to keep model in memory after batch of job.
+            If the next batch of the same job is run by this server and job
+            checkpoint hasn't changed since then, model isn't loaded from
+            checkpoint again. Kept model must be released with ``close``.
+        :type keepModel: bool"""
         self.logger = logging.getLogger('kts46.SimulationServer')
+        self.keepModel = keepModel
+        self._liveModel = None
+        self._liveCheckpointId = None
 
     def runSimulationJob(self, job, saver):
         """Runs simulation job.
@@ -33,20 +53,78 @@ class SimulationServer(object):
         This function does all required stuff: gets initial state and definition,
         simulates and stores simulation results to database."""
 
-        model = Model(Model.defaultParams)
-
+        model = self._takeLiveModel(job)
+        loaded = model is not None
+        if model is None:
+            engine = job.definition['simulationParameters'].get('engine', 'object')
+            if engine not in MODEL_ENGINES:
+                raise ValueError("Unknown simulation engine: {0}.".format(engine))
+            model = MODEL_ENGINES[engine](Model.defaultParams)
+        try:
+            finished = self._runSimulationJob(job, saver, model, loaded)
+        except:
+            # Background writer of saver must be stopped even if simulation
+            # has failed, otherwise it would wait for states forever.
+            saver.abort()
+            model.close()
+            raise
+        if self.keepModel and not finished:
+            self._liveModel = model
+            self._liveCheckpointId = job.checkpointId
+        else:
+            model.close()
+
+    def _takeLiveModel(self, job):
+        """Returns kept model if it has the state of job checkpoint, otherwise
+        releases it and returns None."""
+        model = self._liveModel
+        self._liveModel = None
+        if model is not None and self._liveCheckpointId is not None and \
+                job.checkpointId == self._liveCheckpointId:
+            self.logger.debug('Continuing simulation with model kept in memory.')
+            return model
+        if model is not None:
+            model.close()
+        return None
+
+    def close(self):
+        "Releases model kept after the last batch."
+        if self._liveModel is not None:
+            self._liveModel.close()
+            self._liveModel = None
+
+    def _runSimulationJob(self, job, saver, model, loaded=False):
+        """Runs simulation job with specified model. If ``loaded`` is True then
+        model already has the current state of job. Returns whether the last
+        step of job has been done."""
         # Load current state: load state and set time
-        curState = job.currentFullState
-        if curState is not None:
-            model.load(job.definition, curState)
-            t = timedeltaToSeconds(model.time)
+        if loaded:
+            t = kts46.utils.microsecondsToSeconds(model.time)
         else:
-            model.load(job.definition)
-            t = 0.0
+            curState = job.currentFullState
+            if curState is not None:
+                model.load(job.definition, curState)
+                t = kts46.utils.microsecondsToSeconds(model.time)
+            else:
+                model.load(job.definition)
+                t = 0.0
 
         step = job.definition['simulationParameters']['stepDuration']
         duration = job.definition['simulationParameters']['duration']
         batchLength = job.definition['simulationParameters']['batchLength']
+        # In delta mode only changes of state are saved for each step and full
+        # state is saved only for keyframes.
+        stateOutput = job.definition['simulationParameters'].get('stateOutput', 'full')
+        keyframeInterval = job.definition['simulationParameters'].get('keyframeInterval', 100)
+        deltaOutput = (stateOutput == 'delta')
+        # Jobs that need only statistics calculated during simulation may
+        # save only some states or not save them at all.
+        policy = OutputPolicy(job.definition['simulationParameters'])
+        if deltaOutput:
+            # Deltas are counted from the current state of model. If it hasn't
+            # been saved then the next saved state must be a keyframe.
+            model.getStateDelta()
+            keyframeRequired = not policy.isOutputStep(policy.getStep(t))
 
         # Prepare infrastructure.
         saver.repair(t)
@@ -62,19 +140,48 @@ class SimulationServer(object):
         stepsCount = 0
 
         # if is start then save it as initial state.
-        if t == 0.0:
+        if t == 0.0 and policy.isOutputStep(0):
             saver.add(round(t, 3), data = model.getStateData())
 
         # Run.
         while t <= duration and stepsCount < batchLength:
             model.run_step(stepAsMs)
             stepsCount += 1
-            data = model.getStateData()
             t += step
-            saver.add(round(t, 3), data)
-
-        # Finalize.
-        job.currentFullState = model.getStateData()
-        job.saveSimulationProgress(stepsCount)
+            stepNumber = int(round(t / step))
+            if not policy.isOutputStep(stepNumber):
+                continue
+            if not deltaOutput:
+                saver.add(round(t, 3), model.getStateData())
+            else:
+                delta = model.getStateDelta()
+                if keyframeRequired or policy.getOutputIndex(stepNumber) % keyframeInterval == 0:
+                    saver.add(round(t, 3), model.getStateData())
+                    keyframeRequired = False
+                else:
+                    saver.addDelta(round(t, 3), delta)
+
+        # Finalize. States must be saved before checkpoint, otherwise they
+        # would be lost if worker fails after saving it.
         saver.close()
+        job.currentFullState = model.getCompactCheckpointData()
+        job.saveSimulationProgress(stepsCount)
+
+        # Statistics are final when the last step of job is done.
+        finished = int(round(t / step)) >= math.ceil(duration / step)
+        if model.statistics is not None and finished:
+            self.saveStatistics(job, model.statistics)
         self.logger.debug('End time: {0}.'.format(t))
+        return finished
+
+    def saveStatistics(self, job, statistics):
+        """Saves statistics calculated during simulation to job.
+
+        :param statistics: statistics of model.
+        :type statistics: :class:`kts46.carStatistics.CarStatistics`"""
+        self.logger.info('Saving statistics calculated during simulation.')
+        job.saveBasicStats(*statistics.getBasicStats(job.definition['road']['length']))
+        job.saveIdleTimes(statistics.getIdleTimes())
+        job.saveThroughput(statistics.getThroughput(job))
+        if len(statistics.detectors) > 0:
+            job.saveDetectors(statistics.getDetectors())
@@ -16,6 +16,14 @@ import json
 import logging
 import math
 import numpy
+from kts46.carStatistics import CarStatistics
+
+
+class StatisticsException(Exception):
+    """Exception for statistics that can't be calculated from saved states of
+    job, for example if only some of them are saved."""
+    pass
+
 
 class StatisticsServer:
     "Class to calculate model simulation statistics."
@@ -25,12 +33,60 @@ class StatisticsServer:
         self.log = logging.getLogger(cfg.get('loggers', 'StatisticsServer'))
 
 
+    def getCarsHistory(self, job, withPositions=True):
+        """Reads states of job with delta or columns output and returns times
+        when cars has been added and deleted and positions of cars.
+
+        :param withPositions: whether positions are required. Columns of
+            trajectories aren't read if they aren't.
+        :type withPositions: bool
+        :returns: tuple (addCarTimes, delCarTimes, positions) where positions
+            is a dictionary car id -> list of (time, position) sorted by time.
+        :rtype: tuple"""
+        addCarTimes = {}
+        delCarTimes = {}
+        positions = {}
+        if job.stateOutput == 'columns':
+            for batch in job.iterTrajectoryBatches(withPositions):
+                addCarTimes.update(batch.added)
+                delCarTimes.update(batch.deleted)
+                if withPositions:
+                    for time, carId, pos, state, line in batch.iterRows():
+                        positions.setdefault(carId, []).append((time, pos))
+            return addCarTimes, delCarTimes, positions
+
+        for time, state in job.iterStates():
+            for carId, car in state['cars'].iteritems():
+                carState = car.get('state')
+                if carState == 'add':
+                    addCarTimes[carId] = time
+                elif carState == 'del':
+                    delCarTimes[carId] = time
+                positions.setdefault(carId, []).append((time, car['pos']))
+        return addCarTimes, delCarTimes, positions
+
+
+    def _checkOutput(self, job):
+        """Checks that all states of job are saved, otherwise cars that are
+        added or deleted between saved states aren't visible.
+
+        :raises StatisticsException: if output of job is sparse."""
+        if job.outputPolicy.isSparse:
+            msg = ("States of job '{0}' are saved with '{1}' output policy, its "
+                   "statistics are calculated during simulation.")
+            raise StatisticsException(msg.format(job.name, job.outputPolicy.policy))
+
+
     def calculateBasicStats(self, job):
-        addCarData = job.db.cars.find({'job':job.name, 'state': 'add'},['carid','time'])
-        delCarData = job.db.cars.find({'job':job.name, 'state': 'del'},['carid','time'])
+        self._checkOutput(job)
+        if job.stateOutput != 'full':
+            addCarTimes, delCarTimes, positions = self.getCarsHistory(job, False)
+        else:
+            addCarData = job.db.cars.find({'job':job.name, 'state': 'add'},['carid','time'])
+            delCarData = job.db.cars.find({'job':job.name, 'state': 'del'},['carid','time'])
 
-        addCarTimes = dict((x['carid'], x['time']) for x in addCarData)
-        delCarTimes = dict((x['carid'], x['time']) for x in delCarData)
+            addCarTimes = dict((x['carid'], x['time']) for x in addCarData)
+            delCarTimes = dict((x['carid'], x['time']) for x in delCarData)
 
         times = {}
         moveTimes = []
@@ -52,6 +108,11 @@ class StatisticsServer:
 
         
     def calculateIdleTimes(self, job):
+        self._checkOutput(job)
+        if job.stateOutput != 'full':
+            self.calculateHistoryIdleTimes(job)
+            return
+
         # Get cars ids. We need no repeatings.
         carsSpec = {'job': job.name, 'state': 'del'}
         cars = job.db.cars.find(carsSpec, ['carid']).distinct("carid")
@@ -66,19 +127,7 @@ class StatisticsServer:
 
         # Retrieve data for each car separately.
         for carId in cars:
-            # Get positions already sorted by time.
-            spec = {'job': job.name, 'carid': carId}
-            fields = ['time', 'pos', 'state']
-            positions = job.db.cars.find(spec, fields).sort("time")
-
-            # Calculate idle time.
-            idleTime = 0.0
-            prevPos = None
-            for pos in positions:
-                if prevPos is not None and pos['pos'] == prevPos['pos']:
-                    idleTime += pos['time'] - prevPos['time']
-                prevPos = pos
-
+            idleTime = StatisticsServer.getIdleTime(job.getCarTrajectory(carId))[0]
             results[carId] = round(idleTime, 4)
             resultValues.append(idleTime)
 
@@ -92,36 +141,107 @@ class StatisticsServer:
         job.saveIdleTimes(d)
         
 
+    @staticmethod
+    def getIdleTime(trajectory, idleTime=0.0, last=None):
+        """Calculates time that car has been standing.
+
+        :param trajectory: records of car sorted by time, tuples (time,
+            position, ...) as returned by ``SimulationJob.getCarTrajectory``.
+        :param idleTime: idle time of previous records of car.
+        :type idleTime: float
+        :param last: last of previous records of car.
+        :returns: tuple (idle time, last record) that may be passed with the
+            next records of car.
+        :rtype: tuple"""
+        for record in trajectory:
+            if last is not None and record[1] == last[1]:
+                idleTime += record[0] - last[0]
+            last = record
+        return idleTime, last
+
+
+    def calculateHistoryIdleTimes(self, job):
+        "Calculates idle times for job with delta or columns output."
+        if job.stateOutput == 'columns':
+            # Batches are read once and trajectories of cars are continued
+            # from batch to batch, so positions of all cars aren't kept.
+            idleTimes = {}
+            delCarTimes = {}
+            for batch in job.iterTrajectoryBatches():
+                delCarTimes.update(batch.deleted)
+                for carId in batch.cars:
+                    idleTime, last = idleTimes.get(carId, (0.0, None))
+                    idleTimes[carId] = StatisticsServer.getIdleTime(
+                        batch.getCarTrajectory(carId), idleTime, last)
+        else:
+            addCarTimes, delCarTimes, positions = self.getCarsHistory(job)
+            idleTimes = dict((carId, StatisticsServer.getIdleTime(positions[carId]))
+                             for carId in delCarTimes)
+        results = {}
+        resultValues = []
+        for carId in delCarTimes:
+            idleTime = idleTimes[carId][0]
+            results[carId] = round(idleTime, 4)
+            resultValues.append(idleTime)
+
+        mean = numpy.average(numpy.array(resultValues))
+        d = {'values': results, 'average': round(mean, 4)}
+        job.saveIdleTimes(d)
+
+
     def calculateThroughput(self, job):
+        self._checkOutput(job)
         self.log.info("Calculating throughput.")
+        # Cars at intermediate points are counted by loop detectors.
         points = ['start', 'end']
         result = []
+        if job.stateOutput != 'full':
+            addCarTimes, delCarTimes, positions = self.getCarsHistory(job, False)
         for point in points:
-            if point == 'start' or point == 'end':
-                carsAmount = self.calculateEndpointsThroughput(job, point)
+            if job.stateOutput != 'full':
+                carsAmount = len(addCarTimes if point == 'start' else delCarTimes)
             else:
-                posSpec = {'job': job.name, 'pos': {'$gte': point}}
-                cursor = job.db.cars.find(posSpec, ['carid'])
-                carsAmount = len(cursor.distinct("carid"))
-                ##-
-                #self.log.info("Calculating point %g by local method", point)
-                #for carid in cars:
-                #    posspec = {'job':job.name,'carid':carid,'pos':{'$gte':point}}
-                #    # first: position ASC, then time DESC
-                #    sort = [('pos', 1), ('time', -1)]
-                #    carPosition = job.db.cars.find_one(posspec, sort=sort)
-                #    # We can do something with time, but not now.
-                #    if carPosition is not None:
-                #        carsAmount += 1
-                #self.log.info("Point %g finished by local method", point)
+                carsAmount = self.calculateEndpointsThroughput(job, point)
             throughput = float(carsAmount) / job.definition['simulationParameters']['duration'] * 3600
             result.append({'cars': carsAmount, 'rate': job.round(throughput),
                            'pos': point})
         job.saveThroughput(result)
         self.log.info("Throughput calculated for %i points.", len(points))
+        if job.definition.get('detectors'):
+            self.calculateDetectors(job)
         
 
 
+    def calculateAllStats(self, job):
+        """Calculates basic statistics, idle times and throughput of job in one
+        pass over records of cars and saves them."""
+        self._checkOutput(job)
+        self.log.info("Calculating all statistics.")
+        stats = CarStatistics(detectors=job.definition.get('detectors'))
+        for time, carId, pos, state, line in job.iterCarRecords():
+            stats.addRecord(time, carId, pos, state, line)
+
+        av, stdd, avgSpeed = stats.getBasicStats(job.definition['road']['length'])
+        self.log.info("Average: {0}".format(av))
+        self.log.info("Standard deviation: {0}".format(stdd))
+        job.saveBasicStats(av, stdd, avgSpeed)
+        job.saveIdleTimes(stats.getIdleTimes())
+        job.saveThroughput(stats.getThroughput(job))
+        if len(stats.detectors) > 0:
+            job.saveDetectors(stats.getDetectors())
+
+
+    def calculateDetectors(self, job):
+        """Counts cars by loop detectors declared in job definition in one pass
+        over records of cars and saves results."""
+        self._checkOutput(job)
+        self.log.info("Calculating loop detectors.")
+        stats = CarStatistics(detectors=job.definition['detectors'])
+        for time, carId, pos, state, line in job.iterCarRecords():
+            stats.addRecord(time, carId, pos, state, line)
+        job.saveDetectors(stats.getDetectors())
+
+
     def calculateEndpointsThroughput(self, job, point):
         """Calculates throughput for start and end points. That is much
         faster than for usual points because of 'state' field and indexes."""
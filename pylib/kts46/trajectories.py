@@ -0,0 +1,204 @@
+# Copyright 2010-2011 Anthony Kolesov
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Columnar format of cars trajectories.
+
+Cars of a sequence of states are stored as rows of packed columns: car, pos,
+curspd, line and state. Rows are sorted by time and index of batch contains
+time of each state and number of its first row, so time of row isn't stored.
+Car column contains index of car in the list of batch cars, which also holds
+their descriptions. Index also contains numbers of rows of each car, so
+trajectory of car is read without scanning car column. Each column is
+compressed with zlib separately."""
+
+import zlib
+from array import array
+from bisect import bisect_left, bisect_right
+from kts46.model.Car import Car
+
+
+class TrajectoryBatch(object):
+    "Trajectories of cars for a sequence of states."
+
+    # Column name -> array type code.
+    COLUMNS = (('car', 'i'), ('pos', 'd'), ('curspd', 'd'), ('line', 'b'),
+               ('state', 'b'))
+
+    # Approximate size of row in bytes before compression.
+    ROW_SIZE = 22
+
+    def __init__(self):
+        "Creates new empty batch."
+        # Time and first row of each state.
+        self.times = []
+        self.offsets = []
+        # Car ids and (length, width, desiredSpeed) descriptions.
+        self.cars = []
+        self.descriptions = []
+        self._carIndexes = {}
+        # Car id -> array of numbers of its rows.
+        self.carRows = {}
+        # Car id -> time when car has been added to or deleted from road.
+        self.added = {}
+        self.deleted = {}
+        self._columns = dict((name, array(typecode))
+                             for name, typecode in TrajectoryBatch.COLUMNS)
+        self._packedColumns = None
+
+    def __len__(self):
+        "Returns amount of rows in batch."
+        return len(self.columns['car'])
+
+    @property
+    def columns(self):
+        "Dictionary of columns. Columns are unpacked on first access."
+        for name, typecode in TrajectoryBatch.COLUMNS:
+            self.getColumn(name)
+        return self._columns
+
+    def getColumn(self, name):
+        """Returns column with specified name. Only this column is unpacked, so
+        queries that don't need all columns don't decompress them.
+
+        :rtype: array"""
+        if self._packedColumns is not None and name in self._packedColumns:
+            self._columns[name].fromstring(zlib.decompress(self._packedColumns.pop(name)))
+        return self._columns[name]
+
+    def addState(self, time, cars):
+        """Adds cars of state to batch.
+
+        :param time: time of state.
+        :type time: float
+        :param cars: cars data in the format of ``Model.getStateData``.
+        :type cars: dict
+        """
+        columns = self.columns
+        self.times.append(time)
+        self.offsets.append(len(columns['car']))
+        for carId, car in cars.iteritems():
+            if carId not in self._carIndexes:
+                self._carIndexes[carId] = len(self.cars)
+                self.cars.append(carId)
+                self.descriptions.append((car['length'], car['width'], car['desiredSpeed']))
+            state = car.get('state', Car.DEFAULT)
+            if state == Car.ADDED:
+                self.added[carId] = time
+            elif state == Car.DELETED:
+                self.deleted[carId] = time
+            self.carRows.setdefault(carId, array('i')).append(len(columns['car']))
+            columns['car'].append(self._carIndexes[carId])
+            columns['pos'].append(car['pos'])
+            columns['curspd'].append(car['curspd'])
+            columns['line'].append(int(car['line']))
+            columns['state'].append(Car.STATES.index(state))
+
+    def getRows(self, time):
+        """Returns range of rows of state with specified time.
+
+        :raises KeyError: if there is no state with specified time in batch."""
+        i = bisect_left(self.times, time)
+        if i == len(self.times) or self.times[i] != time:
+            raise KeyError("There is no state with specified time: {0}.".format(time))
+        end = self.offsets[i + 1] if i + 1 < len(self.offsets) else len(self)
+        return xrange(self.offsets[i], end)
+
+    def getCarsAt(self, time):
+        """Returns cars of state with specified time.
+
+        :returns: list of dictionaries with fields carid, pos, curspd, line,
+            length, width.
+        :rtype: list
+        :raises KeyError: if there is no state with specified time in batch."""
+        columns = self.columns
+        result = []
+        for row in self.getRows(time):
+            car = columns['car'][row]
+            length, width, desiredSpeed = self.descriptions[car]
+            result.append({'carid': self.cars[car], 'pos': columns['pos'][row],
+                           'curspd': columns['curspd'][row],
+                           'line': columns['line'][row],
+                           'length': length, 'width': width})
+        return result
+
+    def getCarTrajectory(self, carId):
+        """Returns records of car with specified id in order of time. Only
+        rows of this car are read and car column isn't unpacked.
+
+        :returns: list of tuples (time, position, state, line). List is empty
+            if car has no rows in batch.
+        :rtype: list"""
+        pos = self.getColumn('pos')
+        state = self.getColumn('state')
+        line = self.getColumn('line')
+        if self.carRows is None:
+            self.carRows = {}
+            for row, car in enumerate(self.getColumn('car')):
+                self.carRows.setdefault(self.cars[car], array('i')).append(row)
+        result = []
+        for row in self.carRows.get(carId, ()):
+            # Time of row is the time of the last state started before it.
+            time = self.times[bisect_right(self.offsets, row) - 1]
+            result.append((time, pos[row], Car.STATES[state[row]], line[row]))
+        return result
+
+    def iterRows(self):
+        """Yields tuples (time, car id, position, state, line) for all rows in
+        order of time."""
+        car = self.columns['car']
+        pos = self.columns['pos']
+        state = self.columns['state']
+        line = self.columns['line']
+        ends = self.offsets[1:] + [len(self)]
+        for time, start, end in zip(self.times, self.offsets, ends):
+            for row in xrange(start, end):
+                yield (time, self.cars[car[row]], pos[row],
+                       Car.STATES[state[row]], line[row])
+
+    def toDocument(self):
+        """Returns batch as a dictionary. Columns are compressed strings that
+        must be stored as binary data."""
+        columns = self.columns
+        packed = dict((name, zlib.compress(columns[name].tostring()))
+                      for name, typecode in TrajectoryBatch.COLUMNS)
+        return {'start': self.times[0], 'end': self.times[-1],
+                'times': self.times, 'offsets': self.offsets,
+                'cars': self.cars, 'descriptions': self.descriptions,
+                'added': self.added, 'deleted': self.deleted,
+                'carRows': dict((carId, rows.tostring())
+                                for carId, rows in self.carRows.iteritems()),
+                'columns': packed}
+
+    @staticmethod
+    def fromDocument(doc):
+        """Creates batch from dictionary returned by ``toDocument``. Columns
+        are decompressed only when they are required, so index of batch can
+        be used without unpacking them."""
+        batch = TrajectoryBatch()
+        batch.times = doc['times']
+        batch.offsets = doc['offsets']
+        batch.cars = doc['cars']
+        batch.descriptions = doc['descriptions']
+        batch.added = doc['added']
+        batch.deleted = doc['deleted']
+        batch._packedColumns = doc.get('columns')
+        if batch._packedColumns is not None:
+            batch._packedColumns = dict(batch._packedColumns)
+        if 'carRows' in doc:
+            batch.carRows = dict((carId, array('i', str(rows)))
+                                 for carId, rows in doc['carRows'].iteritems())
+        else:
+            # Batch has been saved before rows of cars were indexed.
+            batch.carRows = None
+        return batch
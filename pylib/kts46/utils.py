@@ -87,6 +87,28 @@ def timedeltaToSeconds(td):
     "Converts timedelta to seconds."
     return td.days * 24 * 60 * 60 + td.seconds + td.microseconds / 1e6
 
+def timedeltaToMicroseconds(td):
+    "Converts timedelta to integer amount of microseconds."
+    return (td.days * 24 * 60 * 60 + td.seconds) * 1000000 + td.microseconds
+
+def microsecondsToSeconds(value):
+    """Converts integer amount of microseconds to seconds. Result is the same
+    as of timedeltaToSeconds for timedelta of that length."""
+    seconds, microseconds = divmod(value, 1000000)
+    return seconds + microseconds / 1e6
+
+def microseconds2str(value):
+    "Converts integer amount of microseconds to string like timedelta2str."
+    days, rest = divmod(value, 24 * 60 * 60 * 1000000)
+    seconds, microseconds = divmod(rest, 1000000)
+    return u'{0}d{1}s{2}'.format(days, seconds, microseconds)
+
+def str2microseconds(value):
+    "Converts string returned by timedelta2str to integer amount of microseconds."
+    days, rest = value.split('d')
+    seconds, mcs = rest.split('s')
+    return (int(days) * 24 * 60 * 60 + int(seconds)) * 1000000 + int(mcs)
+
 
 def getMemoryUsage():
     # Convert to MiB!
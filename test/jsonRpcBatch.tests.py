@@ -0,0 +1,104 @@
+# Copyright 2010-2011 Anthony Kolesov
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests of JSON-RPC batch requests to management API of web UI. Serves
+handler on localhost: python jsonRpcBatch.tests.py"""
+
+import json
+import logging
+import os.path
+import sys
+import threading
+import unittest
+from wsgiref.simple_server import make_server, WSGIRequestHandler
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(TEST_DIR, '..', 'pylib'))
+
+import jsonRpcClient
+import kts46.utils
+from kts46.server.status import JobNotFoundException
+from kts46.server.webui import ManagementAPIHandler
+
+
+class FakeStatusServer(object):
+    "Status server that knows statistics only of specified jobs."
+
+    def __init__(self, statistics):
+        self.statistics = statistics
+
+    def getJobStatistics(self, projectName, jobName, fullStatistics):
+        if (projectName, jobName) not in self.statistics:
+            raise JobNotFoundException(jobName)
+        return dict(self.statistics[(projectName, jobName)])
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+
+class BatchTests(unittest.TestCase):
+
+    def setUp(self):
+        cfg = kts46.utils.getConfiguration([os.path.join(TEST_DIR, '..', 'etc', 'default.ini')])
+        statusServer = FakeStatusServer({('p', 'a'): {'average': 1.0},
+                                         ('p', 'c'): {'average': 3.0}})
+        handler = ManagementAPIHandler(cfg, None, statusServer)
+        self.server = make_server('127.0.0.1', 0, handler.handle,
+                                  handler_class=QuietRequestHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        address = 'http://127.0.0.1:{0}/api/jsonrpc'.format(self.server.server_port)
+        self.client = jsonRpcClient.Client(address)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def testMixedSuccess(self):
+        "Failed call doesn't affect other calls of batch."
+        with self.client.batch() as batch:
+            calls = [batch.getJobStatistics('p', j) for j in ('a', 'b', 'c')]
+        self.assertEqual({'average': 1.0}, calls[0].result)
+        self.assertRaises(jsonRpcClient.RPCException, lambda: calls[1].result)
+        self.assertEqual({'average': 3.0}, calls[2].result)
+
+    def testResponsesOrder(self):
+        "Responses are in the order of calls and keep their ids."
+        ids = [5, 'x', 2, None]
+        request = [{'method': 'getJobStatistics', 'id': id, 'params': ['p', j]}
+                   for id, j in zip(ids, ('c', 'b', 'a', 'a'))]
+        responses = json.loads(self.client.pool.post(json.dumps(request) + '\n'))
+        self.assertEqual(ids, [response['id'] for response in responses])
+        self.assertEqual([{'average': 3.0}, None, {'average': 1.0}, {'average': 1.0}],
+                         [response['result'] for response in responses])
+        self.assertEqual([False, True, False, False],
+                         [response['error'] is not None for response in responses])
+
+    def testListJobStatistics(self):
+        "listJobStatistics returns statistics of all jobs with their names."
+        statistics = self.client.listJobStatistics([{'p': 'p', 'j': 'c'},
+                                                    {'p': 'p', 'j': 'a'}])
+        self.assertEqual([{'average': 3.0, 'project': 'p', 'job': 'c'},
+                          {'average': 1.0, 'project': 'p', 'job': 'a'}], statistics)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.CRITICAL)
+    unittest.main()
@@ -0,0 +1,93 @@
+# Copyright 2010-2011 Anthony Kolesov
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests of sweep mode of offline worker. Runs offlineWorker.py the same way
+as it is run from command line: python offlineWorker.tests.py"""
+
+import csv
+import os
+import os.path
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import unittest
+import yaml
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+LIB_DIR = os.path.join(TEST_DIR, '..', 'pylib')
+OFFLINE_WORKER = os.path.join(LIB_DIR, 'kts46', 'runtime', 'offlineWorker.py')
+
+
+class SweepTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='kts46-test-')
+        self.definition = {
+            'simulationParameters': {'duration': 120, 'stepDuration': 0.2,
+                                     'batchLength': 200, 'seed': 46},
+            'modelParameters': {'inputRate': 1600, 'safeDistance': 20,
+                'safeDistanceRear': 10, 'trafficLightStopDistance': 5,
+                'accelerationLimit': 2.0, 'brakingLimit': 6.5,
+                'comfortBrakingLimit': 4.5, 'minimalDistance': 3,
+                'speed': [14, 22], 'lineChangingDelay': 1.0},
+            'road': {'length': 1000, 'width': 25, 'lines': 2},
+            'trafficLights': {
+                '1': {'position': 300, 'green': 30, 'red': 20, 'state': 'r'},
+                '2': {'position': 700, 'green': 30, 'red': 20, 'state': 'g'}},
+        }
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def sweep(self, name, definition, processes=2):
+        "Runs sweep for definition and returns path of output directory."
+        inputPath = os.path.join(self.dir, name + '.yaml')
+        with open(inputPath, 'w') as f:
+            yaml.safe_dump(definition, f)
+        output = os.path.join(self.dir, name)
+        env = dict(os.environ, PYTHONPATH=LIB_DIR)
+        subprocess.check_call([sys.executable, OFFLINE_WORKER, '--sweep',
+                               '-j', str(processes), '-o', output, inputPath],
+                              cwd=self.dir, env=env)
+        return output
+
+    def readStates(self, output, runName):
+        "Returns content of states and cars files of run."
+        tar = tarfile.open(os.path.join(output, runName + '.tar.bz2'))
+        try:
+            return [tar.extractfile('{0}/{1}'.format(runName, name)).read()
+                    for name in ('states.csv', 'cars.csv')]
+        finally:
+            tar.close()
+
+    def testSegmentedSweep(self):
+        "Segmented model in a process of pool gives the same states as Model."
+        self.definition['sweep'] = {'modelParameters.inputRate': [1200, 1800]}
+        objectOutput = self.sweep('object', self.definition)
+        self.definition['simulationParameters'].update(engine='segmented', segments=3)
+        segmentedOutput = self.sweep('segmented', self.definition)
+
+        for number in (1, 2):
+            expected = self.readStates(objectOutput, 'object_{0}'.format(number))
+            actual = self.readStates(segmentedOutput, 'segmented_{0}'.format(number))
+            self.assertEqual(expected, actual)
+        with open(os.path.join(segmentedOutput, 'summary.csv')) as f:
+            rows = list(csv.reader(f))
+        self.assertEqual(3, len(rows))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,370 @@
+/*
+Copyright 2010-2011 Anthony Kolesov
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+*/
+
+// Unit tests of scheduler. Unlike scheduler.tests.js they don't require
+// running control node or MongoDB: project storage is replaced with jobs in
+// memory. Run: node schedulerUnit.tests.js
+
+var Module = require('module'),
+    assert = require('assert');
+
+// Scheduler options used in tests, in milliseconds.
+var maxTaskWaitTime = 100,
+    affinityTime = 50;
+
+// MongoDB driver and config modules are replaced, so they needn't be
+// installed.
+var stubs = {
+    mongodb: {Server: function() {}, Db: function() {}},
+    config: function(name, defaults) {
+        defaults.maxTaskWaitTime = maxTaskWaitTime;
+        defaults.affinityTime = affinityTime;
+        return defaults;
+    }
+};
+var load = Module._load;
+Module._load = function(request) {
+    if (stubs.hasOwnProperty(request)) {
+        return stubs[request];
+    }
+    return load.apply(this, arguments);
+};
+
+var schedulerLib = require('../ControlNode/scheduler'),
+    taskTypes = schedulerLib.taskTypes;
+
+var projectName = 'test';
+
+
+/* Project storage that keeps jobs and ensembles in memory. */
+var FakeStorage = function() {
+    this.jobs = {};
+    this.ensembles = {};
+};
+
+FakeStorage.prototype.addJob = function(name, fields) {
+    var job = {id: name, name: name, done: 0, totalSteps: 1000,
+        duration: 200, batchLength: 500, stepDuration: 0.2,
+        ensemble: null, ensembleConverged: false, fullStatistics: false,
+        basicStatistics: false, idleTimes: false, throughput: false};
+    for (var key in fields) {
+        job[key] = fields[key];
+    }
+    this.jobs[name] = job;
+    return job;
+};
+
+FakeStorage.prototype.getJob = function(projectName, jobName, onHasJob, onError) {
+    var job = this.jobs.hasOwnProperty(jobName) ? this.jobs[jobName] : null;
+    if (job !== null && job.ensemble !== null) {
+        job.ensembleConverged = this.ensembles[job.ensemble].converged;
+    }
+    process.nextTick(onHasJob.bind({}, job));
+};
+
+FakeStorage.prototype.getEnsemble = function(projectName, ensembleName, onHasEnsemble, onError) {
+    var ensemble = this.ensembles.hasOwnProperty(ensembleName) ?
+        this.ensembles[ensembleName] : null;
+    process.nextTick(onHasEnsemble.bind({}, ensemble));
+};
+
+
+/* Response that records results and errors of a call. */
+var Response = function() {
+    this.results = [];
+    this.errors = [];
+    this.onResponse = null;
+};
+
+Response.prototype.response = function(result) {
+    this.results.push(result);
+    if (this.onResponse) {
+        this.onResponse(result);
+    }
+};
+
+Response.prototype.error = function(error) {
+    this.errors.push(error);
+};
+
+
+var createScheduler = function() {
+    var scheduler = new schedulerLib.Scheduler();
+    scheduler.projectStorage = new FakeStorage();
+    return scheduler;
+};
+
+/* Gives task to worker and makes it running. Returns task. */
+var startTask = function(scheduler, workerId, types) {
+    var response = new Response();
+    scheduler.getTask(response, workerId, types);
+    var task = response.results[0];
+    assert.strictEqual(task.empty, false);
+    response = new Response();
+    scheduler.acceptTask(response, workerId, task.sig);
+    task.sig = response.results[0].sig;
+    return task;
+};
+
+
+var tests = {
+
+    waitTaskTimeout: function(done) {
+        var scheduler = createScheduler(),
+            response = new Response(),
+            started = Date.now();
+        response.onResponse = function(task) {
+            assert.deepEqual(task, {empty: true});
+            assert.ok(Date.now() - started >= 25);
+            assert.deepEqual(Object.keys(scheduler.waitingWorkers), []);
+            done();
+        };
+        scheduler.waitTask(response, 'w1', [taskTypes.simulation], 30);
+        assert.strictEqual(response.results.length, 0);
+    },
+
+    waitTaskTimeoutIsLimited: function(done) {
+        var scheduler = createScheduler(),
+            response = new Response(),
+            started = Date.now();
+        response.onResponse = function(task) {
+            assert.deepEqual(task, {empty: true});
+            assert.ok(Date.now() - started < 10 * maxTaskWaitTime);
+            done();
+        };
+        scheduler.waitTask(response, 'w1', [taskTypes.simulation], 60000);
+    },
+
+    waitTaskWakeUp: function(done) {
+        var scheduler = createScheduler(),
+            statisticsWorker = new Response(),
+            simulationWorker = new Response();
+        scheduler.projectStorage.addJob('j1');
+        scheduler.waitTask(statisticsWorker, 'w1', [taskTypes.fullStatistics], 60000);
+        scheduler.waitTask(simulationWorker, 'w2', [taskTypes.simulation], 60000);
+        simulationWorker.onResponse = function(task) {
+            assert.strictEqual(task.empty, false);
+            assert.strictEqual(task.job, 'j1');
+            assert.strictEqual(task.type, taskTypes.simulation);
+            assert.strictEqual(scheduler.waitingActivation.w2, task);
+            // Worker that waits for other task types is still waiting.
+            assert.strictEqual(statisticsWorker.results.length, 0);
+            assert.deepEqual(Object.keys(scheduler.waitingWorkers), ['w1']);
+            scheduler._stopWaiting('w1');
+            assert.deepEqual(statisticsWorker.results, [{empty: true}]);
+            done();
+        };
+        scheduler.addTask(new Response(), projectName, 'j1');
+    },
+
+    waitTaskReturnsNotAcceptedTask: function(done) {
+        var scheduler = createScheduler(),
+            response = new Response();
+        scheduler.projectStorage.addJob('j1');
+        scheduler.waitTask(response, 'w1', [taskTypes.simulation], 60000);
+        response.onResponse = function(task) {
+            var again = new Response();
+            scheduler.waitTask(again, 'w1', [taskTypes.simulation], 60000);
+            assert.deepEqual(again.results, [task]);
+            done();
+        };
+        scheduler.addTask(new Response(), projectName, 'j1');
+    },
+
+    affinityExpires: function(done) {
+        var scheduler = createScheduler(),
+            response = new Response(),
+            otherWorker = new Response(),
+            queued = Date.now();
+        scheduler.projectStorage.addJob('j1', {done: 500});
+        response.onResponse = function() {
+            // Task is reserved for worker that has done previous batch.
+            var other = new Response();
+            scheduler.getTask(other, 'w2', [taskTypes.simulation]);
+            assert.deepEqual(other.results, [{empty: true}]);
+            scheduler.waitTask(otherWorker, 'w2', [taskTypes.simulation], 60000);
+        };
+        otherWorker.onResponse = function(task) {
+            assert.strictEqual(task.empty, false);
+            assert.strictEqual(task.preferredWorker, 'w1');
+            assert.ok(Date.now() - queued >= affinityTime - 5);
+            done();
+        };
+        scheduler.addTask(response, projectName, 'j1', 'w1');
+    },
+
+    affinityPreferredWorker: function(done) {
+        var scheduler = createScheduler(),
+            response = new Response();
+        scheduler.projectStorage.addJob('j1', {done: 500});
+        response.onResponse = function() {
+            var preferred = new Response();
+            scheduler.getTask(preferred, 'w1', [taskTypes.simulation]);
+            assert.strictEqual(preferred.results[0].empty, false);
+            assert.strictEqual(preferred.results[0].startState, 500);
+            done();
+        };
+        scheduler.addTask(response, projectName, 'j1', 'w1');
+    },
+
+    ensembleQueuesReplicas: function(done) {
+        var scheduler = createScheduler(),
+            response = new Response(),
+            storage = scheduler.projectStorage;
+        storage.ensembles.e1 = {id: 'e1', replicas: ['r1', 'r2', 'r3'], converged: false};
+        storage.addJob('r1', {ensemble: 'e1'});
+        storage.addJob('r2', {ensemble: 'e1'});
+        storage.addJob('r3', {ensemble: 'e1', done: 1000,
+            fullStatistics: true, basicStatistics: true, idleTimes: true,
+            throughput: true});
+        response.onResponse = function(result) {
+            assert.strictEqual(result, 'success');
+            assert.deepEqual(scheduler.waitingQueue.map(function(task) {
+                return task.job;
+            }), ['r1', 'r2']);
+            done();
+        };
+        scheduler.addTask(response, projectName, 'e1');
+    },
+
+    ensembleWithoutReplicas: function(done) {
+        var scheduler = createScheduler(),
+            response = new Response();
+        scheduler.projectStorage.ensembles.e1 = {id: 'e1', replicas: [], converged: false};
+        response.onResponse = function(result) {
+            assert.strictEqual(result, 'success');
+            assert.deepEqual(scheduler.waitingQueue, []);
+            done();
+        };
+        scheduler.addTask(response, projectName, 'e1');
+    },
+
+    ensembleConvergenceStopsReplicas: function(done) {
+        var scheduler = createScheduler(),
+            response = new Response(),
+            storage = scheduler.projectStorage;
+        storage.ensembles.e1 = {id: 'e1', replicas: ['r1', 'r2'], converged: false};
+        storage.addJob('r1', {ensemble: 'e1'});
+        storage.addJob('r2', {ensemble: 'e1'});
+        storage.addJob('j1');
+        response.onResponse = function() {
+            scheduler.addTask(new Response(), projectName, 'j1');
+            var task = startTask(scheduler, 'w1', [taskTypes.simulation]);
+            assert.strictEqual(task.job, 'r1');
+            storage.ensembles.e1.converged = true;
+
+            var finished = new Response();
+            scheduler.taskFinished(finished, 'w1', task.sig);
+            setTimeout(function() {
+                // Neither next batch of r1 nor waiting r2 are simulated.
+                assert.deepEqual(finished.errors, [{type: 'EnsembleConverged'}]);
+                assert.deepEqual(scheduler.waitingQueue.map(function(task) {
+                    return task.job;
+                }), ['j1']);
+
+                var again = new Response();
+                scheduler.addTask(again, projectName, 'e1');
+                setTimeout(function() {
+                    assert.deepEqual(again.errors, [{type: 'AlreadyDone'}]);
+                    done();
+                }, 10);
+            }, 10);
+        };
+        scheduler.addTask(response, projectName, 'e1');
+    },
+
+    fullStatisticsAfterLastBatch: function(done) {
+        var scheduler = createScheduler(),
+            response = new Response(),
+            job = scheduler.projectStorage.addJob('j1', {done: 500});
+        response.onResponse = function() {
+            var task = startTask(scheduler, 'w1', [taskTypes.simulation]);
+            assert.strictEqual(task.startState, 500);
+            job.done = job.totalSteps;
+
+            var finished = new Response(),
+                statisticsWorker = new Response();
+            scheduler.waitTask(statisticsWorker, 'w2', [taskTypes.fullStatistics], 60000);
+            statisticsWorker.onResponse = function(task) {
+                assert.strictEqual(task.empty, false);
+                assert.strictEqual(task.job, 'j1');
+                assert.strictEqual(task.type, taskTypes.fullStatistics);
+                assert.deepEqual(scheduler.waitingQueue, []);
+                assert.deepEqual(finished.errors, []);
+                done();
+            };
+            scheduler.taskFinished(finished, 'w1', task.sig);
+        };
+        scheduler.addTask(response, projectName, 'j1');
+    },
+
+    separateStatisticsAfterPartialStatistics: function(done) {
+        var scheduler = createScheduler(),
+            response = new Response();
+        scheduler.projectStorage.addJob('j1', {done: 1000, basicStatistics: true});
+        response.onResponse = function() {
+            assert.deepEqual(scheduler.waitingQueue.map(function(task) {
+                return task.type;
+            }), [taskTypes.idleTimes, taskTypes.throughput]);
+            done();
+        };
+        scheduler.addTask(response, projectName, 'j1');
+    }
+};
+
+
+// Tests are run one after another. Test fails if it hasn't finished in time.
+var names = Object.keys(tests),
+    failed = 0;
+var runNext = function() {
+    if (names.length === 0) {
+        console.log(failed === 0 ? 'OK' : failed + ' test(s) failed');
+        process.exit(failed === 0 ? 0 : 1);
+    }
+    var name = names.shift(),
+        finished = false;
+    var timer = setTimeout(function() {
+        finished = true;
+        failed += 1;
+        console.log(name + ': timeout');
+        runNext();
+    }, 2000);
+    var onDone = function() {
+        if (finished) return;
+        finished = true;
+        clearTimeout(timer);
+        console.log(name + ': ok');
+        process.nextTick(runNext);
+    };
+    try {
+        tests[name](onDone);
+    } catch (err) {
+        finished = true;
+        clearTimeout(timer);
+        failed += 1;
+        console.log(name + ': ' + err.stack);
+        runNext();
+    }
+};
+
+// Assertions in callbacks are thrown outside of try block.
+process.on('uncaughtException', function(err) {
+    failed += 1;
+    console.log(err.stack);
+    process.exit(1);
+});
+
+runNext();